@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
-"""Create an application, with random API key."""
+"""Create an application, with random API key and, optionally, a retry
+  policy for its tasks, e.g.::
+  
+      $ python create_application.py --name foo --retry-on 5xx,429
+"""
 
 import argparse
 import os
@@ -8,6 +12,8 @@ import transaction
 
 from torque.model import CreateApplication
 from torque.model import GetActiveKey
+from torque.model.due import BACKOFF_ALGORITHMS
+from torque.model.due import JITTER_ALGORITHMS
 
 from torque.work.main import Bootstrap
 
@@ -16,6 +22,13 @@ def parse_args():
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--name')
+    parser.add_argument('--backoff', choices=BACKOFF_ALGORITHMS)
+    parser.add_argument('--jitter', choices=JITTER_ALGORITHMS)
+    parser.add_argument('--max-delay', type=int)
+    parser.add_argument('--max-retries', type=int)
+    parser.add_argument('--min-delay', type=int)
+    parser.add_argument('--retry-on',
+            help='Status codes to retry on, e.g.: 5xx,429')
     args = parser.parse_args()
     if not args.name:
         raise ValueError(parser.format_help())
@@ -32,12 +45,16 @@ def main():
     # Parse the command line args.
     args = parse_args()
     name = args.name
+    keys = ('backoff', 'jitter', 'max_delay', 'max_retries', 'min_delay',
+            'retry_on')
+    retry_policy = dict((k, getattr(args, k)) for k in keys
+            if getattr(args, k) is not None)
     
-    # Create the app.
+    # Create the app, validating the retry policy.
     create_app = CreateApplication()
     get_key = GetActiveKey()
     with transaction.manager:
-        app = create_app(name)
+        app = create_app(name, retry_policy=retry_policy)
         api_key = get_key(app).value
     
     print u'Created application with API key: {0}\n'.format(api_key)
@@ -0,0 +1,26 @@
+"""Add lifecycle timestamps to tasks.
+  
+  Revision ID: 2b7f4c1d8e60
+  Revises: 5d1e0b7a93f2
+  Create Date: 2026-10-18 16:41:05.218376
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '2b7f4c1d8e60'
+down_revision = '5d1e0b7a93f2'
+
+from alembic import op
+import sqlalchemy as sa
+
+COLUMNS = ('first_acquired', 'attempt_started', 'attempt_ended', 'completed')
+
+def upgrade():
+    for name in COLUMNS:
+        op.add_column('tasks', sa.Column(name, sa.DateTime))
+    op.create_index('ix_tasks_completed', 'tasks', ['completed'],
+            postgresql_where=sa.text('completed IS NOT NULL'))
+
+def downgrade():
+    op.drop_index('ix_tasks_completed', 'tasks')
+    for name in reversed(COLUMNS):
+        op.drop_column('tasks', name)
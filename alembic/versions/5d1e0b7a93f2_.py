@@ -0,0 +1,23 @@
+"""Add retry policies to applications and tasks.
+  
+  Revision ID: 5d1e0b7a93f2
+  Revises: c8936c10ec01
+  Create Date: 2026-10-18 14:02:17.553094
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '5d1e0b7a93f2'
+down_revision = 'c8936c10ec01'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sqlalchemy.dialects.postgresql import JSONB
+
+def upgrade():
+    op.add_column('applications', sa.Column('retry_policy', JSONB))
+    op.add_column('tasks', sa.Column('retry_policy', JSONB))
+
+def downgrade():
+    op.drop_column('tasks', 'retry_policy')
+    op.drop_column('applications', 'retry_policy')
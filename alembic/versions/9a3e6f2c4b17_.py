@@ -0,0 +1,57 @@
+"""Add the task attempt log, partitioned by day on postgres >= 11. Older
+  servers get a plain table, which ``torque_requeue`` prunes by deleting the
+  expired rows, rather than by dropping partitions.
+  
+  Revision ID: 9a3e6f2c4b17
+  Revises: 2b7f4c1d8e60
+  Create Date: 2026-10-18 19:25:48.730512
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '9a3e6f2c4b17'
+down_revision = '2b7f4c1d8e60'
+
+from alembic import op
+import sqlalchemy as sa
+
+from datetime import datetime
+from datetime import timedelta
+
+# Declarative partitioning, with a primary key, needs postgres 11.
+MIN_PARTITIONED_VERSION = 110000
+
+CREATE_TABLE_SQL = u"""
+    CREATE TABLE task_attempts (
+        task_id INTEGER NOT NULL,
+        attempt INTEGER NOT NULL,
+        c TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        status_code SMALLINT,
+        error VARCHAR(64),
+        latency DOUBLE PRECISION,
+        body TEXT,
+        PRIMARY KEY (task_id, attempt, c)
+    ){0}
+"""
+
+def upgrade():
+    bind = op.get_bind()
+    version = int(bind.execute(u'SHOW server_version_num').scalar())
+    if version < MIN_PARTITIONED_VERSION:
+        op.execute(CREATE_TABLE_SQL.format(u''))
+        op.create_index('ix_task_attempts_c', 'task_attempts', ['c'])
+        return
+    op.execute(CREATE_TABLE_SQL.format(u' PARTITION BY RANGE (c)'))
+    
+    # Create the first few days' partitions. After that, ``torque_requeue``
+    # creates them ahead of time.
+    today = datetime.utcnow().date()
+    for i in range(3):
+        start = today + timedelta(days=i)
+        end = start + timedelta(days=1)
+        op.execute(u"""
+            CREATE TABLE task_attempts_{0:%Y%m%d} PARTITION OF task_attempts
+               FOR VALUES FROM ('{0}') TO ('{1}')
+        """.format(start, end))
+
+def downgrade():
+    op.execute(u'DROP TABLE task_attempts')
@@ -0,0 +1,48 @@
+"""Store task headers as JSONB and task statuses as small integer codes.
+  
+  Revision ID: c8936c10ec01
+  Revises: 4ae58a31c179
+  Create Date: 2026-10-18 09:12:31.402118
+"""
+
+# Revision identifiers, used by Alembic.
+revision = 'c8936c10ec01'
+down_revision = '4ae58a31c179'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    op.execute(u"""
+        ALTER TABLE tasks
+            ALTER COLUMN headers DROP DEFAULT,
+            ALTER COLUMN headers TYPE JSONB USING headers::jsonb,
+            ALTER COLUMN status TYPE SMALLINT USING (
+                CASE status
+                    WHEN 'PENDING' THEN 0
+                    WHEN 'COMPLETED' THEN 1
+                    ELSE 2
+                END
+            )
+    """)
+    op.execute(u'DROP TYPE task_statuses')
+    op.execute(u'DROP INDEX IF EXISTS ix_tasks_status')
+    op.create_index('ix_tasks_pending_due', 'tasks', ['due'],
+            postgresql_where=sa.text('status = 0'))
+
+def downgrade():
+    op.drop_index('ix_tasks_pending_due', 'tasks')
+    op.execute(u"""
+        CREATE TYPE task_statuses AS ENUM ('FAILED', 'COMPLETED', 'PENDING')
+    """)
+    op.execute(u"""
+        ALTER TABLE tasks
+            ALTER COLUMN headers TYPE TEXT USING headers::text,
+            ALTER COLUMN status TYPE task_statuses USING (
+                CASE status
+                    WHEN 0 THEN 'PENDING'
+                    WHEN 1 THEN 'COMPLETED'
+                    ELSE 'FAILED'
+                END
+            )::task_statuses
+    """)
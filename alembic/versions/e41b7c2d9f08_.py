@@ -0,0 +1,28 @@
+"""Index the pending tasks by their url's host, so deferring the tasks for
+  a host that's down is an index lookup rather than a scan.
+  
+  Revision ID: e41b7c2d9f08
+  Revises: 9a3e6f2c4b17
+  Create Date: 2026-10-18 23:41:05.218334
+"""
+
+# Revision identifiers, used by Alembic.
+revision = 'e41b7c2d9f08'
+down_revision = '9a3e6f2c4b17'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Must match ``torque.model.constants.URL_HOST_SQL`` exactly, for postgres to
+# use the index.
+URL_HOST_SQL = (u"lower(substring(url from "
+        u"'^[A-Za-z][A-Za-z0-9+.-]*://(?:[^@/]*@)?([^/:?#]+)'))")
+
+def upgrade():
+    op.execute(u"""
+        CREATE INDEX ix_tasks_pending_host ON tasks ({0}, due)
+         WHERE status = 0
+    """.format(URL_HOST_SQL))
+
+def downgrade():
+    op.drop_index('ix_tasks_pending_host', 'tasks')
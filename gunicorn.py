@@ -13,6 +13,37 @@ from pyramid.settings import asbool
 def _post_fork(server, worker):
     import gevent_psycopg2
     gevent_psycopg2.monkey_patch()
+    if block_threshold:
+        _monitor_hub()
+    if metrics_port:
+        _serve_metrics(server, worker)
+
+def _monitor_hub():
+    """Log the stack of any code that blocks the worker's gevent hub for
+      longer than ``TORQUE_BLOCK_THRESHOLD`` milliseconds.
+    """
+    
+    from torque.work.metrics import REGISTRY
+    from torque.work.monitor import HubMonitor
+    monitor = HubMonitor(threshold=float(block_threshold) / 1000)
+    monitor.start()
+    REGISTRY.report(monitor)
+
+def _serve_metrics(server, worker):
+    """Serve the worker's request timing metrics on the first free port
+      from ``TORQUE_WEB_METRICS_PORT``, so each worker gets its own.
+    """
+    
+    import socket
+    from torque.work.metrics import MetricsServer
+    port = int(metrics_port)
+    for offset in range(server.cfg.workers):
+        try:
+            MetricsServer(metrics_host, port + offset).start()
+        except socket.error:
+            continue
+        return
+    logging.warn('No free metrics port for worker %s', worker.pid)
 
 def _on_starting(server):
     import gevent.monkey
@@ -46,9 +77,12 @@ def _when_ready(server):
 
 
 backlog = int(os.environ.get('GUNICORN_BACKLOG', 64))
+block_threshold = os.environ.get('TORQUE_BLOCK_THRESHOLD', '')
 bind = '0.0.0.0:{0}'.format(os.environ.get('PORT', 5100))
 daemon = asbool(os.environ.get('GUNICORN_DAEMON', False))
 max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 24000))
+metrics_host = os.environ.get('TORQUE_WEB_METRICS_HOST', '127.0.0.1')
+metrics_port = os.environ.get('TORQUE_WEB_METRICS_PORT', '')
 mode = os.environ.get('MODE', 'development')
 preload_app = asbool(os.environ.get('GUNICORN_PRELOAD_APP', False))
 timeout = int(os.environ.get('GUNICORN_TIMEOUT', 10))
@@ -26,6 +26,8 @@ setup(
         ],
         'console_scripts': [
             'torque_consume = torque.work.consume:main',
+            'torque_latency = torque.work.latency:main',
+            'torque_loadgen = torque.bench.loadgen:main',
             'torque_requeue = torque.work.requeue:main'
         ]
     }
@@ -18,6 +18,8 @@ from pyramid.settings import asbool
 from torque import model
 
 from . import auth
+from . import notify
+from . import timing
 from . import tree
 
 DEFAULTS = {
@@ -26,6 +28,8 @@ DEFAULTS = {
     'enable_hsts': os.environ.get('TORQUE_ENABLE_HSTS', False),
     'mode': os.environ.get('MODE', 'development'),
     'redis_channel': os.environ.get('TORQUE_REDIS_CHANNEL', 'torque'),
+    'request_timing': os.environ.get('TORQUE_REQUEST_TIMING', False),
+    'server_timing': os.environ.get('TORQUE_SERVER_TIMING', False),
 }
 
 class IncludeMe(object):
@@ -36,8 +40,12 @@ class IncludeMe(object):
         self.authz_policy = kwargs.get('authz_policy', ACLAuthorizationPolicy())
         self.default_settings = kwargs.get('default_settings', DEFAULTS)
         self.get_app = kwargs.get('get_app', auth.GetAuthenticatedApplication())
+        self.get_notifier = kwargs.get('get_notifier', notify.GetNotifier())
         self.root_factory = kwargs.get('root_factory', tree.APIRoot)
         self.tasks_root = kwargs.get('tasks_root', tree.TaskRoot)
+        self.timed_method_cls = kwargs.get('timed_method_cls',
+                timing.TimedRequestMethod)
+        self.timed_redis_cls = kwargs.get('timed_redis_cls', timing.TimedRedis)
     
     def __call__(self, config):
         """Configure, lock down and expose the API."""
@@ -53,20 +61,33 @@ class IncludeMe(object):
         # Configure redis.
         config.include('pyramid_redis')
         
-        # Wrap everything with the transaction manager.
+        # Wrap everything with the transaction manager and provide
+        # ``request.notify`` to push instructions once it's committed.
         config.include('pyramid_tm')
+        config.add_request_method(self.get_notifier, 'notify', reify=True)
         
         # If configured, enforce HSTS.
         should_enable_hsts = settings.get('torque.enable_hsts')
         if asbool(should_enable_hsts):
             config.include('pyramid_hsts')
         
+        # If configured, time the phases of each request, wrapping the
+        # redis client and application lookup so they're timed too.
+        get_app = self.get_app
+        should_time = settings.get('torque.request_timing')
+        should_emit = settings.get('torque.server_timing')
+        if asbool(should_time) or asbool(should_emit):
+            config.include('torque.api.timing')
+            config.add_request_method(self.timed_redis_cls(), 'redis',
+                    reify=True)
+            get_app = self.timed_method_cls(u'auth', get_app)
+        
         # If configured, enforce authentication.
         should_authenticate = settings.get('torque.authenticate')
         if asbool(should_authenticate):
             config.set_authorization_policy(self.authz_policy)
             config.set_authentication_policy(self.authn_policy)
-        config.add_request_method(self.get_app, 'application', reify=True)
+        config.add_request_method(get_app, 'application', reify=True)
         
         # Expose the API using traversal from the APIRoot.
         config.add_route('api', '/*traverse', factory=self.root_factory,
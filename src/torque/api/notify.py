@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""Notify workers about new tasks once the transaction that stores them has
+  been committed, so a worker can never pop an instruction for a task that it
+  can't yet see.
+"""
+
+__all__ = [
+    'GetNotifier',
+    'Notifier',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import transaction
+
+class Notifier(object):
+    """Collects instructions and pushes them onto their redis channels, with
+      a single round trip per channel, after the transaction has been
+      committed.
+    """
+    
+    def __init__(self, redis, tx, **kwargs):
+        self.redis = redis
+        self.tx = tx
+        self.logger = kwargs.get('logger', logger)
+        self.instructions = None
+    
+    def __call__(self, channel, instruction):
+        """Add an instruction, registering the commit hook the first time."""
+        
+        if self.instructions is None:
+            self.tx.addAfterCommitHook(self.push)
+            self.instructions = {}
+        self.instructions.setdefault(channel, []).append(instruction)
+    
+    def push(self, status):
+        """If the transaction was committed, push the instructions. If not, or
+          if the push fails, the tasks will be picked up by the requeue poller.
+        """
+        
+        instructions, self.instructions = self.instructions, None
+        if not status:
+            return
+        for channel, values in instructions.items():
+            try:
+                self.redis.rpush(channel, *values)
+            except Exception as err:
+                self.logger.warn(err, exc_info=True)
+    
+
+class GetNotifier(object):
+    """A Pyramid request method that provides a ``Notifier`` bound to the
+      current transaction.
+    """
+    
+    def __init__(self, **kwargs):
+        self.get_tx = kwargs.get('get_tx', transaction.get)
+        self.notifier_cls = kwargs.get('notifier_cls', Notifier)
+    
+    def __call__(self, request):
+        return self.notifier_cls(request.redis, self.get_tx())
+    
+
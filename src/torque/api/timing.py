@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""Time the phases of each request -- authenticating the application,
+  traversal, flushing and querying the db, committing the transaction and
+  pushing to redis -- using Pyramid, SQLAlchemy, transaction and redis client
+  hooks, so a slow request can be explained without attaching a profiler.
+  
+  The timings are recorded as histograms in the metrics registry and, if
+  the ``torque.server_timing`` setting is on, returned in a
+  ``Server-Timing`` response header.
+"""
+
+__all__ = [
+    'RequestTimings',
+    'TimedRedis',
+    'TimedRequestMethod',
+    'TimingHooks',
+    'TimingTween',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import time
+import transaction
+
+from pyramid import events
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_request
+from pyramid_redis.hooks import GetRedisClient
+from sqlalchemy import event
+
+from torque import model
+from torque.work.metrics import REGISTRY
+
+class RequestTimings(object):
+    """Accumulates the seconds a request spends in each phase."""
+    
+    __slots__ = ('durations', 'marks')
+    
+    def __init__(self):
+        self.durations = collections.OrderedDict()
+        self.marks = {}
+    
+    def add(self, phase, seconds):
+        self.durations[phase] = self.durations.get(phase, 0) + seconds
+    
+    def start(self, phase, now):
+        self.marks[phase] = now
+    
+    def stop(self, phase, now):
+        started = self.marks.pop(phase, None)
+        if started is not None:
+            self.add(phase, now - started)
+    
+    def header(self):
+        """Format the durations as a ``Server-Timing`` header value."""
+        
+        return u', '.join(u'{0};dur={1:.2f}'.format(phase, seconds * 1000)
+                for phase, seconds in self.durations.items())
+    
+
+def current_timings(get_request=get_current_request):
+    """Return the current request's timings, if it's being timed."""
+    
+    return getattr(get_request(), 'timings', None)
+
+class TimedRequestMethod(object):
+    """Wrap a request method, e.g.: ``GetAuthenticatedApplication``, timing
+      it as a ``phase``.
+    """
+    
+    def __init__(self, phase, func, **kwargs):
+        self.phase = phase
+        self.func = func
+        self.time = kwargs.get('time', time.time)
+    
+    def __call__(self, request):
+        start = self.time()
+        try:
+            return self.func(request)
+        finally:
+            timings = getattr(request, 'timings', None)
+            if timings is not None:
+                timings.add(self.phase, self.time() - start)
+    
+
+class TimedRedis(object):
+    """A ``request.redis`` method that times the client's commands."""
+    
+    def __init__(self, **kwargs):
+        self.get_redis = kwargs.get('get_redis', GetRedisClient())
+        self.time = kwargs.get('time', time.time)
+    
+    def __call__(self, request):
+        client = self.get_redis(request)
+        execute_command = client.execute_command
+        get_time = self.time
+        def timed_execute_command(*args, **kwargs):
+            start = get_time()
+            try:
+                return execute_command(*args, **kwargs)
+            finally:
+                timings = getattr(request, 'timings', None)
+                if timings is not None:
+                    timings.add(u'redis', get_time() - start)
+        client.execute_command = timed_execute_command
+        return client
+    
+
+class TimingHooks(object):
+    """Pyramid subscribers and SQLAlchemy event listeners that attribute
+      time to the current request's phases.
+    """
+    
+    def __init__(self, **kwargs):
+        self.current_timings = kwargs.get('current_timings', current_timings)
+        self.get_tx = kwargs.get('get_tx', transaction.get)
+        self.time = kwargs.get('time', time.time)
+    
+    def new_request(self, event):
+        """Traversal starts once the request has been created."""
+        
+        timings = getattr(event.request, 'timings', None)
+        if timings is not None:
+            timings.start(u'traversal', self.time())
+    
+    def context_found(self, event):
+        """Traversal has finished. Time the commit from the transaction's
+          hooks. The after commit hook is added before the view can add the
+          notifier's, so the redis push isn't counted as part of the commit.
+        """
+        
+        timings = getattr(event.request, 'timings', None)
+        if timings is None:
+            return
+        timings.stop(u'traversal', self.time())
+        tx = self.get_tx()
+        tx.addBeforeCommitHook(self.before_commit, (timings,))
+        tx.addAfterCommitHook(self.after_commit, (timings,))
+    
+    def before_commit(self, timings):
+        timings.start(u'commit', self.time())
+    
+    def after_commit(self, status, timings):
+        timings.stop(u'commit', self.time())
+    
+    def before_flush(self, session, flush_context, instances):
+        timings = self.current_timings()
+        if timings is not None:
+            timings.start(u'flush', self.time())
+    
+    def after_flush(self, session, flush_context):
+        timings = self.current_timings()
+        if timings is not None:
+            timings.stop(u'flush', self.time())
+    
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+            context, executemany):
+        conn.info.setdefault('torque_query_start', []).append(self.time())
+    
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+            context, executemany):
+        stack = conn.info.get('torque_query_start')
+        if not stack:
+            return
+        start = stack.pop()
+        timings = self.current_timings()
+        if timings is not None:
+            timings.add(u'db', self.time() - start)
+    
+
+class TimingTween(object):
+    """Times each request, records its phases in the metrics ``registry``
+      and, if ``emit_header``, returns them in a ``Server-Timing`` header.
+    """
+    
+    def __init__(self, handler, emit_header=False, **kwargs):
+        self.handler = handler
+        self.emit_header = emit_header
+        self.registry = kwargs.get('registry', REGISTRY)
+        self.timings_cls = kwargs.get('timings_cls', RequestTimings)
+        self.time = kwargs.get('time', time.time)
+    
+    def __call__(self, request):
+        timings = request.timings = self.timings_cls()
+        start = self.time()
+        status = u'5xx'
+        try:
+            response = self.handler(request)
+            status = u'{0}xx'.format(response.status_int // 100)
+        finally:
+            timings.add(u'total', self.time() - start)
+            self.observe(request.method, status, timings)
+        if self.emit_header:
+            response.headers['Server-Timing'] = timings.header()
+        return response
+    
+    def observe(self, method, status, timings):
+        labels = ((u'method', method), (u'status_class', status))
+        for phase, seconds in timings.durations.items():
+            if phase == u'total':
+                self.registry.observe(u'request_seconds', seconds, labels)
+            else:
+                self.registry.observe(u'request_phase_seconds', seconds,
+                        ((u'phase', phase),))
+    
+
+def timing_tween_factory(handler, registry):
+    emit_header = asbool(registry.settings.get('torque.server_timing'))
+    return TimingTween(handler, emit_header=emit_header)
+
+class IncludeMe(object):
+    """Add the timing tween, outside the transaction manager so the commit
+      and redis push are included, and register the hooks.
+      
+      The session and engine listeners are global, so they're only
+      registered if they aren't already, e.g.: by a previous app
+      configuration in the same process.
+    """
+    
+    def __init__(self, **kwargs):
+        self.hooks = kwargs.get('hooks', TimingHooks())
+        self.base = kwargs.get('base', model.Base)
+        self.contains = kwargs.get('contains', event.contains)
+        self.listen = kwargs.get('listen', event.listen)
+        self.session_cls = kwargs.get('session_cls', model.Session)
+    
+    def __call__(self, config):
+        hooks = self.hooks
+        config.add_tween('torque.api.timing.timing_tween_factory',
+                over='pyramid_tm.tm_tween_factory')
+        config.add_subscriber(hooks.new_request, events.NewRequest)
+        config.add_subscriber(hooks.context_found, events.ContextFound)
+        engine = self.base.metadata.bind
+        listeners = (
+            (self.session_cls, 'before_flush', hooks.before_flush),
+            (self.session_cls, 'after_flush_postexec', hooks.after_flush),
+            (engine, 'before_cursor_execute', hooks.before_cursor_execute),
+            (engine, 'after_cursor_execute', hooks.after_cursor_execute),
+        )
+        for target, identifier, fn in listeners:
+            if not self.contains(target, identifier, fn):
+                self.listen(target, identifier, fn)
+    
+
+includeme = IncludeMe().__call__
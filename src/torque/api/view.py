@@ -41,6 +41,8 @@ class EnqueTask(object):
         self.request = request
         self.bad_request = kwargs.get('bad_request', httpexceptions.HTTPBadRequest)
         self.create_task = kwargs.get('create_task', model.CreateTask())
+        self.parse_policy = kwargs.get('parse_policy',
+                model.due.ParseRetryPolicy())
         self.valid_int = kwargs.get('valid_int', VALID_INT)
         self.valid_url = kwargs.get('valid_url', VALID_URL)
     
@@ -62,14 +64,19 @@ class EnqueTask(object):
             timeout = int(raw_timeout)
         except ValueError:
             raise self.bad_request(u'You must provide a valid integer timeout.')
+        try:
+            retry_policy = self.parse_policy(request.GET)
+        except ValueError as err:
+            raise self.bad_request(u'Invalid retry policy: {0}'.format(err))
         
         # Store the task.
-        task = self.create_task(request.application, url, timeout, request)
+        task = self.create_task(request.application, url, timeout, request,
+                retry_policy=retry_policy)
         
-        # Notify.
+        # Notify, once the task has been committed.
         channel = settings['torque.redis_channel']
         instruction = '{0}:0'.format(task.id)
-        request.redis.rpush(channel, instruction)
+        request.notify(channel, instruction)
         
         # Return a 201 response with the task url as the Location header.
         response = request.response
@@ -98,3 +105,28 @@ class TaskStatus(object):
         return task
     
 
+
+@view_config(context=model.Task, name='attempts', permission='view',
+        request_method='GET', renderer='json')
+class TaskAttempts(object):
+    """``GET /tasks/task:id/attempts`` endpoint."""
+    
+    def __init__(self, request, **kwargs):
+        self.request = request
+        self.get_attempts = kwargs.get('get_attempts',
+                model.GetTaskAttempts())
+    
+    def __call__(self):
+        """Return a 200 response with a JSON list of the task's attempts."""
+        
+        # Unpack.
+        request = self.request
+        task = request.context
+        
+        # Return the attempt log.
+        return {
+            'attempts': self.get_attempts(task.id),
+            'task_id': task.id,
+        }
+    
+
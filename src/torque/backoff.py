@@ -54,6 +54,19 @@
       >>> b.exponential()
       5
   
+  The value after ``n`` steps can be calculated in one go, without changing
+  the current value::
+  
+      >>> b = Backoff(2, max_value=100)
+      >>> b.nth_linear(3)
+      8
+      >>> b.nth_exponential(3)
+      16
+      >>> b.nth_exponential(300)
+      100
+      >>> b.value
+      2
+  
 """
 
 __all__ = [
@@ -108,4 +121,24 @@ class Backoff(object):
         self.value = self.limit(value)
         return self.value
     
+    def nth_linear(self, n, incr=None):
+        """Return the value after ``n`` calls to ``linear()``."""
+        
+        if incr is None:
+            incr = self.default_incr
+        
+        return self.limit(self.value + incr * n)
+    
+    def nth_exponential(self, n, factor=None):
+        """Return the value after ``n`` calls to ``exponential()``."""
+        
+        if factor is None:
+            factor = self.default_factor
+        
+        try:
+            value = self.value * factor ** n
+        except OverflowError:
+            value = float('inf')
+        return self.limit(value)
+    
 
@@ -0,0 +1 @@
+# Having an ``__init__.py`` file in it makes a directory a Python package.
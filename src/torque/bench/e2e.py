@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+"""Measures Torque's end to end throughput and latency::
+  
+      $ python -m torque.bench.e2e --rate 500 --latency lognormal:-3,0.5
+  
+  Starts the web app, ``torque_consume`` and ``torque_requeue`` against the
+  local Postgres and Redis configured by ``DATABASE_URL`` and ``REDIS_URL``,
+  enqueues ``tasks`` at ``rate`` tasks per second and has them performed
+  against a stub web hook server, running in this process, that responds
+  after a random latency and fails a configurable fraction of requests.
+  
+  Writes the enqueue and dispatch rates and the time to first attempt and
+  completion latency percentiles to stdout as a line of JSON, with the git
+  commit, so runs can be compared across commits.
+"""
+
+__all__ = [
+    'ConsoleScript',
+    'EndToEndBenchmark',
+    'StubWebHook',
+    'parse_distribution',
+]
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import gevent
+import gevent.pool
+import gevent.pywsgi
+import json
+import os
+import random
+import requests
+import subprocess
+import sys
+import time
+import urllib
+
+from .histogram import LatencyHistogram
+
+BENCH_ID_HEADER = 'Torque-Passthrough-Bench-Id'
+
+def parse_distribution(spec, rand=None):
+    """Parse a latency distribution, in seconds, like ``fixed:0.05``,
+      ``uniform:0.01,0.1``, ``exponential:0.05`` (the mean) or
+      ``lognormal:-3,0.5`` (the mu and sigma of the underlying normal), into
+      a function that returns a sample.
+    """
+    
+    rand = random.Random() if rand is None else rand
+    name, _, args = spec.partition(':')
+    try:
+        params = [float(v) for v in args.split(',') if v]
+    except ValueError:
+        raise ValueError(u'Invalid latency distribution: {0}'.format(spec))
+    samplers = {
+        'exponential': (1, lambda mean: rand.expovariate(1.0 / mean)),
+        'fixed': (1, lambda value: value),
+        'lognormal': (2, rand.lognormvariate),
+        'uniform': (2, rand.uniform),
+    }
+    if name not in samplers or len(params) != samplers[name][0]:
+        raise ValueError(u'Invalid latency distribution: {0}'.format(spec))
+    sample = samplers[name][1]
+    return lambda: max(0, sample(*params))
+
+class StubWebHook(object):
+    """A WSGI web hook that responds after a ``latency`` sampled from a
+      distribution. A ``timeout_fraction`` of requests are held for
+      ``timeout_latency`` seconds, longer than the tasks' timeout, and a
+      ``slow_fraction`` for ``slow_latency`` seconds. Of the rest, an
+      ``error_rate`` fraction respond with a 500.
+      
+      Records when each task, identified by its bench id header, was first
+      attempted and when it first succeeded. Timed out requests respond
+      with a 504 and, given a ``task_timeout``, any response slower than
+      it isn't counted as a success, as the worker has given up on it.
+    """
+    
+    def __init__(self, latency, error_rate=0, slow_fraction=0,
+            slow_latency=1, timeout_fraction=0, timeout_latency=30,
+            **kwargs):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.timeout_fraction = timeout_fraction
+        self.timeout_latency = timeout_latency
+        self.random = kwargs.get('random', random.random)
+        self.task_timeout = kwargs.get('task_timeout', None)
+        self.sleep = kwargs.get('sleep', gevent.sleep)
+        self.time = kwargs.get('time', time.time)
+        self.attempts = 0
+        self.completed = {}
+        self.first_attempted = {}
+    
+    def __call__(self, environ, start_response):
+        """Record the attempt, then respond."""
+        
+        bench_id = environ.get('HTTP_BENCH_ID')
+        self.attempts += 1
+        if bench_id is not None:
+            self.first_attempted.setdefault(bench_id, self.time())
+        
+        # Consume the body, then pick the outcome.
+        wsgi_input = environ.get('wsgi.input')
+        if wsgi_input is not None:
+            wsgi_input.read()
+        started = self.time()
+        r = self.random()
+        if r < self.timeout_fraction:
+            self.sleep(self.timeout_latency)
+            status = '504 Gateway Timeout'
+        elif r < self.timeout_fraction + self.slow_fraction:
+            self.sleep(self.slow_latency)
+            status = '200 OK'
+        else:
+            self.sleep(self.latency())
+            if self.random() < self.error_rate:
+                status = '500 Internal Server Error'
+            else:
+                status = '200 OK'
+        
+        # Only count responses the worker could have received in time.
+        now = self.time()
+        timed_out = (self.task_timeout is not None and
+                now - started >= self.task_timeout)
+        if status.startswith('200') and bench_id is not None and not timed_out:
+            self.completed.setdefault(bench_id, now)
+        start_response(status, [('Content-Type', 'text/plain'),
+                ('Content-Length', '0')])
+        return [b'']
+    
+
+class EndToEndBenchmark(object):
+    """Starts the Torque processes and the stub web hook, enqueues ``tasks``
+      at an open loop ``rate`` per second, so slow enqueues don't slow the
+      arrivals, and waits up to ``drain_timeout`` seconds for them to be
+      performed.
+    """
+    
+    def __init__(self, webhook, tasks=1000, rate=100, **kwargs):
+        self.webhook = webhook
+        self.tasks = tasks
+        self.rate = rate
+        self.api_port = kwargs.get('api_port', 5199)
+        self.drain_timeout = kwargs.get('drain_timeout', 120)
+        self.env = kwargs.get('env', os.environ)
+        self.gunicorn_config = kwargs.get('gunicorn_config', 'gunicorn.py')
+        self.max_concurrency = kwargs.get('max_concurrency', 200)
+        self.popen = kwargs.get('popen', subprocess.Popen)
+        self.redis_channel = kwargs.get('redis_channel', 'torque:bench')
+        self.server_cls = kwargs.get('server_cls', gevent.pywsgi.WSGIServer)
+        self.session = kwargs.get('session', requests.Session())
+        self.sleep = kwargs.get('sleep', gevent.sleep)
+        self.task_timeout = kwargs.get('task_timeout', 5)
+        self.time = kwargs.get('time', time.time)
+        self.warmup = kwargs.get('warmup', 3)
+        self.webhook_port = kwargs.get('webhook_port', 5198)
+    
+    def __call__(self):
+        """Run the benchmark and return a dict of results."""
+        
+        server = self.server_cls(('127.0.0.1', self.webhook_port),
+                self.webhook, log=None)
+        server.start()
+        processes = self.start_processes()
+        try:
+            self.wait_until_ready()
+            enqueued, enqueue_errors, started, ended = self.enqueue()
+            self.drain(enqueued)
+            return self.results(enqueued, enqueue_errors, started, ended)
+        finally:
+            self.stop_processes(processes)
+            server.stop()
+    
+    def start_processes(self):
+        """Start the web app, consumer and requeue poller, isolated on their
+          own redis channel.
+        """
+        
+        env = dict(self.env)
+        env.update({
+            'PORT': str(self.api_port),
+            'TORQUE_AUTHENTICATE': 'false',
+            'TORQUE_REDIS_CHANNEL': self.redis_channel,
+        })
+        commands = (
+            ['gunicorn', '-c', self.gunicorn_config, 'torque.api:main'],
+            ['torque_consume'],
+            ['torque_requeue'],
+        )
+        return [self.popen(cmd, env=env) for cmd in commands]
+    
+    def stop_processes(self, processes):
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+    
+    def wait_until_ready(self, timeout=30):
+        """Wait for the web app to respond, then give the workers time to
+          start consuming.
+        """
+        
+        url = 'http://127.0.0.1:{0}/'.format(self.api_port)
+        give_up = self.time() + timeout
+        while True:
+            try:
+                if self.session.get(url).status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            if self.time() > give_up:
+                raise RuntimeError(u'The web app did not start.')
+            self.sleep(0.25)
+        self.sleep(self.warmup)
+    
+    def enqueue(self):
+        """Enqueue the tasks, each at its scheduled arrival time, and return
+          a dict of when each was enqueued, the number that failed and when
+          enqueuing started and ended.
+        """
+        
+        hook = 'http://127.0.0.1:{0}/hook'.format(self.webhook_port)
+        endpoint = 'http://127.0.0.1:{0}/?{1}'.format(self.api_port,
+                urllib.urlencode({'url': hook, 'timeout': self.task_timeout}))
+        pool = gevent.pool.Pool(self.max_concurrency)
+        enqueued = {}
+        errors = [0]
+        def post(bench_id):
+            headers = {BENCH_ID_HEADER: bench_id}
+            sent = self.time()
+            try:
+                r = self.session.post(endpoint, data={'id': bench_id},
+                        headers=headers)
+            except requests.RequestException:
+                errors[0] += 1
+            else:
+                if r.status_code == 201:
+                    enqueued[bench_id] = sent
+                else:
+                    errors[0] += 1
+        
+        started = self.time()
+        for i in range(self.tasks):
+            delay = started + i / float(self.rate) - self.time()
+            if delay > 0:
+                self.sleep(delay)
+            pool.spawn(post, str(i))
+        pool.join()
+        return enqueued, errors[0], started, self.time()
+    
+    def drain(self, enqueued):
+        """Wait for every enqueued task to complete, or the timeout."""
+        
+        give_up = self.time() + self.drain_timeout
+        while self.time() < give_up:
+            if len(self.webhook.completed) >= len(enqueued):
+                break
+            self.sleep(0.1)
+    
+    def results(self, enqueued, enqueue_errors, started, ended):
+        ttfa = LatencyHistogram()
+        completion = LatencyHistogram()
+        first_attempts = []
+        for bench_id, sent in enqueued.items():
+            first = self.webhook.first_attempted.get(bench_id)
+            if first is not None:
+                ttfa.record(first - sent)
+                first_attempts.append(first)
+            done = self.webhook.completed.get(bench_id)
+            if done is not None:
+                completion.record(done - sent)
+        
+        dispatch_rate = None
+        if len(first_attempts) > 1:
+            window = max(first_attempts) - min(first_attempts)
+            if window > 0:
+                dispatch_rate = (len(first_attempts) - 1) / window
+        return {
+            'attempts': self.webhook.attempts,
+            'completed': completion.count,
+            'completion_seconds': completion.summary(),
+            'dispatch_rate': dispatch_rate,
+            'enqueue_errors': enqueue_errors,
+            'enqueue_rate': len(enqueued) / max(ended - started, 1e-9),
+            'enqueued': len(enqueued),
+            'target_rate': self.rate,
+            'tasks': self.tasks,
+            'ttfa_seconds': ttfa.summary(),
+        }
+    
+
+def git_commit():
+    """Return the current git commit, if any."""
+    
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.strip().decode('utf-8')
+
+def parse_args(argv=None):
+    """Parse the command line arguments."""
+    
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=100,
+            help='Tasks enqueued per second.')
+    parser.add_argument('--latency', default='fixed:0.05',
+            help='The web hook latency distribution, e.g.: uniform:0.01,0.1')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--slow-fraction', type=float, default=0)
+    parser.add_argument('--slow-latency', type=float, default=1)
+    parser.add_argument('--timeout-fraction', type=float, default=0)
+    parser.add_argument('--task-timeout', type=int, default=5)
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    parser.add_argument('--api-port', type=int, default=5199)
+    parser.add_argument('--webhook-port', type=int, default=5198)
+    parser.add_argument('--gunicorn-config', default='gunicorn.py')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output',
+            help='Also append the results line to this file.')
+    return parser.parse_args(argv)
+
+class ConsoleScript(object):
+    """Parse the command line arguments and run the benchmark."""
+    
+    def __init__(self, **kwargs):
+        self.benchmark_cls = kwargs.get('benchmark_cls', EndToEndBenchmark)
+        self.git_commit = kwargs.get('git_commit', git_commit)
+        self.parse_args = kwargs.get('parse_args', parse_args)
+        self.stdout = kwargs.get('stdout', sys.stdout)
+        self.webhook_cls = kwargs.get('webhook_cls', StubWebHook)
+    
+    def __call__(self, argv=None):
+        args = self.parse_args(argv)
+        rand = random.Random(args.seed)
+        webhook = self.webhook_cls(parse_distribution(args.latency, rand),
+                error_rate=args.error_rate, slow_fraction=args.slow_fraction,
+                slow_latency=args.slow_latency,
+                timeout_fraction=args.timeout_fraction,
+                timeout_latency=args.task_timeout + 1,
+                task_timeout=args.task_timeout, random=rand.random)
+        benchmark = self.benchmark_cls(webhook, tasks=args.tasks,
+                rate=args.rate, api_port=args.api_port,
+                drain_timeout=args.drain_timeout,
+                gunicorn_config=args.gunicorn_config,
+                task_timeout=args.task_timeout,
+                webhook_port=args.webhook_port)
+        results = benchmark()
+        results['commit'] = self.git_commit()
+        results['config'] = dict((k, v) for k, v in vars(args).items()
+                if k != 'output')
+        line = json.dumps(results, sort_keys=True) + '\n'
+        self.stdout.write(line)
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(line)
+        return 0
+    
+
+main = ConsoleScript()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``LatencyHistogram``, an HDR style histogram that records
+  latencies with a bounded relative error in a bounded amount of memory, no
+  matter how many are recorded or how widely they range.
+"""
+
+__all__ = [
+    'LatencyHistogram',
+]
+
+import collections
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.95, 0.99, 0.999)
+
+class LatencyHistogram(object):
+    """Counts latencies, in seconds, in log-linear buckets: values are
+      converted to integer multiples of ``unit`` and values below
+      ``2 ** sub_bits`` units are counted exactly. Above that, each power of
+      two range is split into ``2 ** (sub_bits - 1)`` equal buckets, so the
+      relative error is at most ``2 ** (1 - sub_bits)``, i.e.: under 1% with
+      the default of 8 bits.
+    """
+    
+    def __init__(self, unit=1e-6, sub_bits=8):
+        self.unit = unit
+        self.sub_bits = sub_bits
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def record(self, seconds):
+        """Count a latency."""
+        
+        value = max(0, int(seconds / self.unit))
+        shift = value.bit_length() - self.sub_bits
+        if shift > 0:
+            value = (value >> shift) << shift
+        self.counts[value] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    
+    def merge(self, other):
+        """Add the counts recorded by ``other``."""
+        
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+    
+    def percentile(self, quantile):
+        """Return the lower bound of the bucket holding the ``quantile``."""
+        
+        if not self.count:
+            return None
+        rank = quantile * self.count
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if seen >= rank:
+                return value * self.unit
+        return self.max
+    
+    def summary(self, quantiles=DEFAULT_QUANTILES):
+        """Return a dict of the count, mean, max and percentiles, keyed like
+          ``p99``, in seconds.
+        """
+        
+        data = {
+            'count': self.count,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+        }
+        for quantile in quantiles:
+            key = u'p{0:g}'.format(quantile * 100)
+            data[key] = self.percentile(quantile)
+        return data
+    
+
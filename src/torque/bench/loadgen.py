@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``ConsoleScript``, which sends ``POST /`` enqueue requests to a
+  Torque web app at fixed arrival rates, to find the rate at which its
+  latency collapses::
+  
+      $ torque_loadgen http://localhost:5100 --rate 100,200,400,800
+  
+  The load is open loop: requests are sent at their scheduled arrival times,
+  whether or not earlier requests have responded, and latency is measured
+  from when each request should have been sent, so a stalled server shows
+  up as latency rather than as a lower request rate.
+  
+  Writes a line of JSON per rate with the error rate and the HDR style
+  latency histogram percentiles, overall and per tenant.
+"""
+
+__all__ = [
+    'ConsoleScript',
+    'LoadGenerator',
+]
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import collections
+import gevent
+import gevent.pool
+import json
+import random
+import requests
+import requests.adapters
+import sys
+import time
+import urllib
+
+from .histogram import LatencyHistogram
+
+API_KEY_HEADER = 'TORQUE_API_KEY'
+PASSTHROUGH_PREFIX = 'Torque-Passthrough-'
+
+def parse_tenant(spec):
+    """Parse ``API_KEY[:WEIGHT]`` into ``(api_key, weight)``. The api key
+      ``anonymous`` sends requests without one.
+    """
+    
+    api_key, _, weight = spec.partition(':')
+    try:
+        weight = float(weight) if weight else 1.0
+    except ValueError:
+        raise argparse.ArgumentTypeError(u'Invalid tenant: {0}'.format(spec))
+    if weight <= 0:
+        raise argparse.ArgumentTypeError(u'Invalid tenant: {0}'.format(spec))
+    return (None if api_key == 'anonymous' else api_key, weight)
+
+def parse_header(spec):
+    """Parse ``NAME:VALUE`` into a pass-through header, adding the
+      ``Torque-Passthrough-`` prefix unless it's already there.
+    """
+    
+    name, sep, value = spec.partition(':')
+    name = name.strip()
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(u'Invalid header: {0}'.format(spec))
+    if not name.lower().startswith(PASSTHROUGH_PREFIX.lower()):
+        name = PASSTHROUGH_PREFIX + name
+    return (name, value.strip())
+
+def parse_rates(value):
+    """Parse a comma separated list of positive rates."""
+    
+    try:
+        rates = [float(v) for v in value.split(',')]
+    except ValueError:
+        rates = []
+    if not rates or min(rates) <= 0:
+        raise argparse.ArgumentTypeError(u'Invalid rates: {0}'.format(value))
+    return rates
+
+def make_session(pool_size):
+    """Return a session that keeps up to ``pool_size`` connections alive
+      per host, rather than opening a new one for each request once more
+      than the default 10 are in flight.
+    """
+    
+    session = requests.Session()
+    for prefix in 'http://', 'https://':
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        session.mount(prefix, adapter)
+    return session
+
+class TenantStats(object):
+    """The responses and latencies for a tenant, or overall."""
+    
+    __slots__ = ('errors', 'latency', 'responses', 'sent', 'service')
+    
+    def __init__(self):
+        self.errors = collections.Counter()
+        self.latency = LatencyHistogram()
+        self.responses = collections.Counter()
+        self.sent = 0
+        self.service = LatencyHistogram()
+    
+    def summary(self):
+        failed = sum(self.errors.values()) + sum(v for k, v in
+                self.responses.items() if k != 201)
+        return {
+            'error_rate': failed / float(self.sent) if self.sent else None,
+            'errors': dict(self.errors),
+            'latency_seconds': self.latency.summary(),
+            'responses': dict((str(k), v) for k, v in self.responses.items()),
+            'sent': self.sent,
+            'service_seconds': self.service.summary(),
+        }
+    
+
+class LoadGenerator(object):
+    """Sends enqueue requests to the web app at ``url`` at ``rate`` per second
+      for ``duration`` seconds, each with a ``body_size`` byte body, the
+      pass-through ``headers`` and the api key of a tenant picked at random,
+      by weight, from ``tenants``.
+      
+      Records each request's latency, from its scheduled arrival time, and
+      its service time, from when it was actually sent. If ``max_in_flight``
+      requests are outstanding, arrivals are counted as ``dropped`` rather
+      than delaying the schedule.
+    """
+    
+    def __init__(self, url, hook_url, body_size=1024, headers=(),
+            tenants=((None, 1.0),), **kwargs):
+        self.url = url
+        self.hook_url = hook_url
+        self.body_size = body_size
+        self.headers = headers
+        self.tenants = tenants
+        self.arrivals = kwargs.get('arrivals', 'uniform')
+        self.max_in_flight = kwargs.get('max_in_flight', 1000)
+        self.random = kwargs.get('random', random.Random())
+        self.request_timeout = kwargs.get('request_timeout', 30)
+        self.session = kwargs.get('session',
+                make_session(self.max_in_flight))
+        self.sleep = kwargs.get('sleep', gevent.sleep)
+        self.time = kwargs.get('time', time.time)
+    
+    def __call__(self, rate, duration):
+        """Run at ``rate`` for ``duration`` seconds and return a dict of
+          results.
+        """
+        
+        # Unpack.
+        endpoint = '{0}/?{1}'.format(self.url.rstrip('/'),
+                urllib.urlencode({'url': self.hook_url}))
+        body = self.make_body()
+        overall = TenantStats()
+        tenants = collections.OrderedDict((self.label(k), TenantStats())
+                for k, _ in self.tenants)
+        pool = gevent.pool.Pool(self.max_in_flight)
+        dropped = 0
+        
+        # Schedule and send.
+        started = self.time()
+        scheduled = started
+        until = started + duration
+        while True:
+            scheduled += self.interval(rate)
+            if scheduled >= until:
+                break
+            delay = scheduled - self.time()
+            if delay > 0:
+                self.sleep(delay)
+            if pool.full():
+                dropped += 1
+                continue
+            api_key = self.pick_tenant()
+            stats = (overall, tenants[self.label(api_key)])
+            pool.spawn(self.send, endpoint, body, api_key, scheduled, stats)
+        pool.join()
+        elapsed = self.time() - started
+        
+        results = overall.summary()
+        results.update({
+            'achieved_rate': overall.sent / elapsed if elapsed else None,
+            'body_size': self.body_size,
+            'dropped': dropped,
+            'duration': duration,
+            'rate': rate,
+            'tenants': dict((k, v.summary()) for k, v in tenants.items()),
+        })
+        return results
+    
+    def send(self, endpoint, body, api_key, scheduled, stats):
+        """Send an enqueue request and record the outcome."""
+        
+        headers = dict(self.headers)
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        if api_key is not None:
+            headers[API_KEY_HEADER] = api_key
+        sent = self.time()
+        try:
+            r = self.session.post(endpoint, data=body, headers=headers,
+                    timeout=self.request_timeout)
+            r.content
+        except requests.RequestException as err:
+            outcome = None
+            error = type(err).__name__
+        else:
+            outcome = r.status_code
+            error = None
+        now = self.time()
+        for item in stats:
+            item.sent += 1
+            item.latency.record(now - scheduled)
+            item.service.record(now - sent)
+            if error is None:
+                item.responses[outcome] += 1
+            else:
+                item.errors[error] += 1
+    
+    def make_body(self):
+        """Return a JSON body padded to ``body_size`` bytes."""
+        
+        prefix, suffix = '{"pad": "', '"}'
+        padding = max(0, self.body_size - len(prefix) - len(suffix))
+        return prefix + 'x' * padding + suffix
+    
+    def interval(self, rate):
+        """Return the seconds until the next arrival: fixed, or
+          exponentially distributed for Poisson arrivals.
+        """
+        
+        if self.arrivals == 'poisson':
+            return self.random.expovariate(rate)
+        return 1.0 / rate
+    
+    def pick_tenant(self):
+        """Pick a tenant's api key at random, by weight."""
+        
+        total = sum(weight for _, weight in self.tenants)
+        r = self.random.random() * total
+        for api_key, weight in self.tenants:
+            r -= weight
+            if r < 0:
+                return api_key
+        return self.tenants[-1][0]
+    
+    def label(self, api_key):
+        """Label a tenant without writing out its whole api key."""
+        
+        return u'anonymous' if api_key is None else api_key[:8]
+    
+
+def parse_args(argv=None):
+    """Parse the command line arguments."""
+    
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', nargs='?', default='http://localhost:5100',
+            help='The Torque web app.')
+    parser.add_argument('--rate', type=parse_rates, default=[100],
+            help='Requests per second, or a comma separated list to step '
+                 'through, e.g.: 100,200,400')
+    parser.add_argument('--duration', type=float, default=30,
+            help='Seconds to run each rate for.')
+    parser.add_argument('--arrivals', choices=('uniform', 'poisson'),
+            default='uniform')
+    parser.add_argument('--body-size', type=int, default=1024)
+    parser.add_argument('--header', type=parse_header, action='append',
+            default=[], help='A pass-through header, NAME:VALUE.')
+    parser.add_argument('--tenant', type=parse_tenant, action='append',
+            default=[], help='API_KEY[:WEIGHT], or anonymous[:WEIGHT].')
+    parser.add_argument('--hook-url', default='http://localhost:5198/hook',
+            help='The web hook url to enqueue the tasks with.')
+    parser.add_argument('--max-in-flight', type=int, default=1000)
+    parser.add_argument('--seed', type=int)
+    return parser.parse_args(argv)
+
+class ConsoleScript(object):
+    """Parse the command line arguments and step through the rates."""
+    
+    def __init__(self, **kwargs):
+        self.generator_cls = kwargs.get('generator_cls', LoadGenerator)
+        self.parse_args = kwargs.get('parse_args', parse_args)
+        self.stdout = kwargs.get('stdout', sys.stdout)
+    
+    def __call__(self, argv=None):
+        args = self.parse_args(argv)
+        generator = self.generator_cls(args.url, args.hook_url,
+                body_size=args.body_size, headers=args.header,
+                tenants=args.tenant or [(None, 1.0)],
+                arrivals=args.arrivals, max_in_flight=args.max_in_flight,
+                random=random.Random(args.seed))
+        for rate in args.rate:
+            results = generator(rate, args.duration)
+            results['arrivals'] = args.arrivals
+            self.stdout.write(json.dumps(results, sort_keys=True) + '\n')
+            self.stdout.flush()
+        return 0
+    
+
+main = ConsoleScript()
+
+if __name__ == '__main__':
+    sys.exit(main())
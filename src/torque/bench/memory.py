@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""Measures the memory held per in-flight task by the ``TaskPerformer``,
+  using ``tracemalloc``::
+  
+      $ python -m torque.bench.memory --concurrency 10000
+  
+  Performs ``concurrency`` tasks against a web hook that doesn't respond until
+  every task is in flight, so the traced memory can be divided by the number
+  of tasks. Writes the results to stdout as a line of JSON.
+"""
+
+__all__ = [
+    'ConsoleScript',
+    'InFlightMemoryBenchmark',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import gevent
+import gevent.event
+import json
+import sys
+import threading
+
+try: # Python >= 3.4, or 2.7 patched with ``pytracemalloc``.
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from torque import model
+from torque.work.perform import TaskPerformer
+
+class HeldResponse(object):
+    """A successful response, without a body."""
+    
+    status_code = 200
+    
+    def close(self):
+        pass
+    
+
+class NullTaskManager(object):
+    """Confirms status updates without writing them, so only the memory
+      held by the performer is measured.
+    """
+    
+    def __init__(self, **kwargs):
+        self.statuses = kwargs.get('statuses', model.TASK_STATUSES)
+    
+    def complete(self, handle):
+        return self.statuses['completed']
+    
+    def fail(self, handle):
+        return self.statuses['failed']
+    
+    def reschedule(self, handle):
+        return self.statuses['pending']
+    
+
+class InFlightMemoryBenchmark(object):
+    """Traces the memory allocated whilst ``concurrency`` tasks, each with a
+      ``body_size`` character body, are in flight at once.
+    """
+    
+    def __init__(self, concurrency=10000, body_size=1024, **kwargs):
+        self.concurrency = concurrency
+        self.body_size = body_size
+        self.event_cls = kwargs.get('event_cls', gevent.event.Event)
+        self.flag_cls = kwargs.get('flag_cls', threading.Event)
+        self.handle_cls = kwargs.get('handle_cls', model.TaskHandle)
+        self.performer_cls = kwargs.get('performer_cls', TaskPerformer)
+        self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.task_manager = kwargs.get('task_manager', NullTaskManager())
+        self.tracemalloc = kwargs.get('tracemalloc', tracemalloc)
+    
+    def __call__(self):
+        """Run the benchmark and return a dict of results."""
+        
+        self.is_released = self.event_cls()
+        self.num_waiting = 0
+        control_flag = self.flag_cls()
+        control_flag.set()
+        performer = self.performer_cls(acquire_task=self.task_manager,
+                post=self.post)
+        
+        # Trace from before the tasks are acquired.
+        self.tracemalloc.start()
+        try:
+            baseline, _ = self.tracemalloc.get_traced_memory()
+            greenlets = []
+            for i in range(self.concurrency):
+                handle = self.acquire(i)
+                greenlets.append(self.spawn(performer.perform, handle,
+                        control_flag))
+                del handle
+            
+            # Measure once every request is waiting for its response.
+            while self.num_waiting < self.concurrency:
+                gevent.sleep(0)
+            in_flight, _ = self.tracemalloc.get_traced_memory()
+            
+            # Then let them all complete.
+            self.is_released.set()
+            gevent.joinall(greenlets)
+            _, peak = self.tracemalloc.get_traced_memory()
+        finally:
+            self.tracemalloc.stop()
+        
+        return {
+            'body_size': self.body_size,
+            'bytes_per_task': (in_flight - baseline) // self.concurrency,
+            'completed': sum(1 for g in greenlets if g.value is not None),
+            'concurrency': self.concurrency,
+            'peak_bytes': peak - baseline,
+        }
+    
+    def acquire(self, i):
+        """Return a handle like the one the task manager would, with its own
+          body and headers.
+        """
+        
+        data = {
+            'body': u'{0}'.format(i).ljust(self.body_size, u'x'),
+            'charset': u'utf8',
+            'enctype': u'application/x-www-form-urlencoded',
+            'headers': {u'Torque-Passthrough-Request-Id': u'{0}'.format(i)},
+            'url': u'http://localhost/hooks/{0}'.format(i),
+        }
+        return self.handle_cls(i, 1, 20, data)
+    
+    def post(self, url, **kwargs):
+        """Hold the request open until every task is in flight."""
+        
+        self.num_waiting += 1
+        self.is_released.wait()
+        return HeldResponse()
+    
+
+class ConsoleScript(object):
+    """Parse the command line arguments and run the benchmark."""
+    
+    def __init__(self, **kwargs):
+        self.benchmark_cls = kwargs.get('benchmark_cls',
+                InFlightMemoryBenchmark)
+        self.stderr = kwargs.get('stderr', sys.stderr)
+        self.stdout = kwargs.get('stdout', sys.stdout)
+        self.tracemalloc = kwargs.get('tracemalloc', tracemalloc)
+    
+    def __call__(self, argv=None):
+        parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+        parser.add_argument('--concurrency', type=int, default=10000)
+        parser.add_argument('--body-size', type=int, default=1024)
+        args = parser.parse_args(argv)
+        if self.tracemalloc is None:
+            self.stderr.write('tracemalloc is not available: run under a '
+                    'Python with tracemalloc support.\n')
+            return 1
+        benchmark = self.benchmark_cls(concurrency=args.concurrency,
+                body_size=args.body_size, tracemalloc=self.tracemalloc)
+        self.stdout.write(json.dumps(benchmark(), sort_keys=True) + '\n')
+        return 0
+    
+
+main = ConsoleScript()
+
+if __name__ == '__main__':
+    sys.exit(main())
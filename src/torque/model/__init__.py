@@ -9,26 +9,39 @@ logger = logging.getLogger(__name__)
 
 import os
 
+from pyramid.settings import asbool
 from sqlalchemy import engine_from_config
 
 from .api import *
 from .constants import *
 from .orm import *
+from . import due
+from . import profile
 
 DEFAULTS = {
+    'explain_sample_rate': os.environ.get('DATABASE_EXPLAIN_SAMPLE_RATE',
+            0.01),
     'max_overflow': os.environ.get('DATABASE_MAX_OVERFLOW', 3),
     'pool_size': os.environ.get('DATABASE_POOL_SIZE', 3),
     'pool_recycle': os.environ.get('DATABASE_POOL_RECYCLE', 300),
+    'profile': os.environ.get('DATABASE_PROFILE', False),
+    'slow_query_ms': os.environ.get('DATABASE_SLOW_QUERY_MS', 100),
     'url': os.environ.get('DATABASE_URL', 'postgresql:///torque'),
 }
 
+# The ``sqlalchemy.*`` settings that configure the ``QueryProfiler`` rather
+# than the engine.
+PROFILE_SETTINGS = ('explain_sample_rate', 'profile', 'slow_query_ms')
+
 class IncludeMe(object):
     """Configure the db engine and provide ``request.db_session``."""
     
     def __init__(self, **kwargs):
         self.base = kwargs.get('base', Base)
+        self.configure_due = kwargs.get('configure_due', due.configure)
         self.default_settings = kwargs.get('default_settings', DEFAULTS)
         self.engine_factory = kwargs.get('engine_factory', engine_from_config)
+        self.profiler_cls = kwargs.get('profiler_cls', profile.QueryProfiler)
         self.session_cls = kwargs.get('session_cls', Session)
     
     def __call__(self, config):
@@ -39,8 +52,25 @@ class IncludeMe(object):
         for key, value in self.default_settings.items():
             settings.setdefault('sqlalchemy.{0}'.format(key), value)
         
-        # Create db engine.
-        engine = self.engine_factory(settings, 'sqlalchemy.')
+        # Merge any retry schedule settings into the defaults, for the due,
+        # status and should retry factories to look up.
+        config.registry.due_settings = self.configure_due(settings)
+        
+        # Create db engine, without the profiler settings, which it
+        # wouldn't recognise.
+        profile_keys = ['sqlalchemy.{0}'.format(k) for k in PROFILE_SETTINGS]
+        engine_settings = dict((k, v) for k, v in settings.items()
+                if k not in profile_keys)
+        engine = self.engine_factory(engine_settings, 'sqlalchemy.')
+        
+        # If configured, time the statements and explain the slow ones.
+        if asbool(settings.get('sqlalchemy.profile')):
+            threshold = float(settings.get('sqlalchemy.slow_query_ms')) / 1000
+            sample_rate = float(settings.get('sqlalchemy.explain_sample_rate'))
+            profiler = self.profiler_cls(threshold=threshold,
+                    sample_rate=sample_rate)
+            profiler.install(engine)
+            config.registry.query_profiler = profiler
         
         # Bind session and declarative base to the db engine.
         self.session_cls.configure(bind=engine)
@@ -5,20 +5,30 @@
 __all__ = [
     'CreateApplication',
     'CreateTask',
+    'DeferTasks',
     'GetActiveKey',
     'GetDueTasks',
+    'GetLatencyStats',
+    'GetTaskAttempts',
+    'InsertAttempts',
     'LookupApplication',
     'LookupTask',
+    'ManageAttemptPartitions',
+    'TaskHandle',
     'TaskManager',
+    'UpdateTasks',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
-import json
 import transaction
 
 from datetime import datetime
+from datetime import timedelta
+
+from sqlalchemy.sql import text
+from zope.sqlalchemy import mark_changed
 
 from pyramid.security import ALL_PERMISSIONS
 from pyramid.security import Allow, Deny
@@ -28,19 +38,113 @@ from . import constants
 from . import due
 from . import orm as model
 
+ACQUIRE_TASKS_SQL = u"""
+    UPDATE {table} SET retry_count = v.retry_count + 1, status = v.status,
+           due = v.due, m = :now,
+           first_acquired = COALESCE({table}.first_acquired, :now)
+      FROM (VALUES {values}) AS v (id, retry_count, status, due)
+     WHERE {table}.id = v.id AND {table}.retry_count = v.retry_count
+ RETURNING {table}.*
+"""
+
+# Matches the pending tasks on a host using the ``ix_tasks_pending_host``
+# index, so the host expression is inlined, rather than bound, to match it.
+DEFER_TASKS_SQL = u"""
+    UPDATE {table} SET due = :due, m = :now
+     WHERE status = :pending AND due < :due
+       AND {url_host} = :host
+"""
+
+# The stages of a task's lifecycle, as the columns they start and end with.
+# Note that ``retrying`` is from when the task was first acquired until its
+# last attempt started, so it's only non-zero for tasks that were retried.
+LATENCY_STAGES = (
+    ('queued', 'c', 'first_acquired'),
+    ('retrying', 'first_acquired', 'attempt_started'),
+    ('webhook', 'attempt_started', 'attempt_ended'),
+    ('recorded', 'attempt_ended', 'completed'),
+    ('total', 'c', 'completed'),
+)
+
+LATENCY_STATS_SQL = u"""
+    SELECT app_id, count(*), {columns}
+      FROM {table}
+     WHERE completed >= :since AND completed < :until {app_clause}
+  GROUP BY app_id
+  ORDER BY app_id
+"""
+
+LATENCY_STAGE_COLUMN = (u'percentile_cont(CAST(:quantiles AS FLOAT[])) '
+        u'WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM {1} - {0}))')
+
+INSERT_ATTEMPTS_SQL = u"""
+    INSERT INTO {table}
+                (task_id, attempt, c, status_code, error, latency, body)
+         VALUES {values}
+"""
+
+# The attempt log is partitioned by day, into tables named by date.
+ATTEMPT_PARTITION_FORMAT = u'{table}_%Y%m%d'
+
+CREATE_PARTITION_SQL = u"""
+    CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table}
+       FOR VALUES FROM ('{start}') TO ('{end}')
+"""
+
+DELETE_EXPIRED_ATTEMPTS_SQL = u"""
+    DELETE FROM {table} WHERE c < :expired_before
+"""
+
+IS_PARTITIONED_SQL = u"""
+    SELECT relkind = 'p' FROM pg_class WHERE relname = :table
+"""
+
+LIST_PARTITIONS_SQL = u"""
+    SELECT child.relname FROM pg_inherits
+      JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+      JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+     WHERE parent.relname = :table
+"""
+
+SELECT_FOR_ACQUIRE_SQL = u"""
+    SELECT id, retry_count, timeout, retry_policy FROM {table}
+     WHERE (id, retry_count) IN ({values})
+  ORDER BY id
+       FOR UPDATE
+"""
+
+UPDATE_TASKS_SQL = u"""
+    UPDATE {table} SET status = v.status, due = v.due, m = :now,
+           attempt_started = COALESCE(v.started, {table}.attempt_started),
+           attempt_ended = COALESCE(v.ended, {table}.attempt_ended),
+           completed = CASE WHEN v.status = :completed THEN :now
+                            ELSE {table}.completed END
+      FROM (VALUES {values})
+        AS v (id, retry_count, status, due, started, ended)
+     WHERE {table}.id = v.id AND {table}.retry_count = v.retry_count
+ RETURNING {table}.id
+"""
+
 class CreateApplication(object):
     """Create an application."""
     
     def __init__(self, **kwargs):
         self.app_cls = kwargs.get('app_cls', model.Application)
         self.key_cls = kwargs.get('key_cls', model.APIKey)
+        self.parse_policy = kwargs.get('parse_policy', due.ParseRetryPolicy())
         self.session = kwargs.get('session', model.Session)
     
-    def __call__(self, name):
-        """Create a named application with an auto-generated api_key."""
+    def __call__(self, name, retry_policy=None):
+        """Create a named application with an auto-generated api_key and,
+          optionally, a retry policy for its tasks, which is validated,
+          raising a ``ValueError`` if invalid.
+        """
         
+        if retry_policy:
+            retry_policy = self.parse_policy(retry_policy)
         key = self.key_cls()
-        app = self.app_cls(name=name, api_keys=[key])
+        app = self.app_cls(name=name, api_keys=[key],
+                retry_policy=retry_policy or None)
         self.session.add(app)
         self.session.flush()
         return app
@@ -54,14 +158,18 @@ class CreateTask(object):
                 constants.DEFAULT_CHARSET)
         self.default_enctype = kwargs.get('default_enctype',
                 constants.DEFAULT_ENCTYPE)
+        self.logger = kwargs.get('logger', logger)
+        self.parse_policy = kwargs.get('parse_policy', due.ParseRetryPolicy())
         self.proxy_header_prefix = kwargs.get('proxy_header_prefix',
                 constants.PROXY_HEADER_PREFIX)
         self.task_cls = kwargs.get('task_cls', model.Task)
         self.session = kwargs.get('session', model.Session)
     
-    def __call__(self, app, url, timeout, request):
+    def __call__(self, app, url, timeout, request, retry_policy=None):
         """Create and return a task belonging to the given ``app`` using the
-          ``url`` and ``request`` provided.
+          ``url`` and ``request`` provided. The ``retry_policy`` provided
+          overrides the app's, which is validated, and ignored if invalid,
+          as it may have been stored by hand.
         """
         
         # Get the content type and parse the encoding type out of it.
@@ -84,12 +192,22 @@ class CreateTask(object):
             if key.startswith(self.proxy_header_prefix):
                 k = key[len(self.proxy_header_prefix):]
                 headers[k] = value
-        headers_json = json.dumps(headers)
+        
+        # Merge the retry policies.
+        policy = {}
+        if app is not None and app.retry_policy:
+            try:
+                policy.update(self.parse_policy(app.retry_policy))
+            except ValueError as err:
+                msg = u'Ignoring invalid retry policy of application {0}: {1}'
+                self.logger.warn(msg.format(app.id, err))
+        if retry_policy:
+            policy.update(retry_policy)
         
         # Create, save and return.
         task = self.task_cls(app=app, body=body, charset=charset,
-                enctype=enctype, headers=headers_json, timeout=timeout,
-                url=url)
+                enctype=enctype, headers=headers, retry_policy=policy or None,
+                timeout=timeout, url=url)
         self.session.add(task)
         self.session.flush()
         return task
@@ -168,6 +286,42 @@ class GetDueTasks(object):
         return query.all()
     
 
+class GetLatencyStats(object):
+    """Get percentiles of how long the tasks completed in a time window spent
+      in each stage of their lifecycle, per application.
+    """
+    
+    def __init__(self, **kwargs):
+        self.session = kwargs.get('session', model.Session)
+        self.stages = kwargs.get('stages', LATENCY_STAGES)
+        self.task_cls = kwargs.get('task_cls', model.Task)
+    
+    def __call__(self, since, until, app_id=None, quantiles=(0.5, 0.95, 0.99)):
+        """Return a list of dicts with the ``app_id``, the ``count`` of tasks
+          completed and, for each stage, a dict of seconds by quantile.
+        """
+        
+        # Build the query.
+        columns = [LATENCY_STAGE_COLUMN.format(start, end)
+                for _, start, end in self.stages]
+        params = {'quantiles': list(quantiles), 'since': since, 'until': until}
+        app_clause = u''
+        if app_id is not None:
+            app_clause = u'AND app_id = :app_id'
+            params['app_id'] = app_id
+        sql = LATENCY_STATS_SQL.format(app_clause=app_clause,
+                columns=u', '.join(columns), table=self.task_cls.__tablename__)
+        
+        # Return the results.
+        stats = []
+        for row in self.session.execute(text(sql), params):
+            item = {'app_id': row[0], 'count': row[1], 'stages': {}}
+            for (name, _, _), values in zip(self.stages, row[2:]):
+                item['stages'][name] = dict(zip(quantiles, values or []))
+            stats.append(item)
+        return stats
+    
+
 class LookupApplication(object):
     """Lookup an application by ``api_key``."""
     
@@ -237,82 +391,441 @@ class PatchTaskACL(object):
     
 
 
+class TaskHandle(object):
+    """The state of a single acquisition of a task: the ``id``, the (already
+      incremented) ``retry_count`` and ``timeout`` that status updates are
+      guarded on, the ``data`` needed to make the request and the task's
+      ``retry_policy``. The performer records when the attempt ``started``
+      and ``ended`` on it, so they're written along with the status.
+      
+      Handles are owned by whoever acquired the task, so any number of tasks
+      can be in flight through the same ``TaskManager`` at once.
+    """
+    
+    __slots__ = ('id', 'retry_count', 'timeout', 'data', 'retry_policy',
+            'started', 'ended')
+    
+    def __init__(self, id_, retry_count, timeout, data=None,
+            retry_policy=None):
+        self.id = id_
+        self.retry_count = retry_count
+        self.timeout = timeout
+        self.data = data
+        self.retry_policy = retry_policy
+        self.started = None
+        self.ended = None
+    
+    def __repr__(self):
+        return '<TaskHandle {0}:{1}>'.format(self.id, self.retry_count)
+    
+
 class TaskManager(object):
     """Provide methods to ``acquire`` a task and then ``reschedule``,
       ``complete`` or ``fail`` it.
       
-      Encapsulates the ``task_data`` returned from ``__json__()``ing the
-      instance returned from the ``acquire`` query and uses this data to
-      update the right task with the right values when setting the status.
+      Acquiring returns a ``TaskHandle`` holding the data ``__json__()``ed
+      from the acquired instance, which is then passed back in to update the
+      right task with the right values when setting the status. The manager
+      itself holds no per task state, so it can be shared between threads.
+      
+      If provided with a ``write_status`` callable, e.g.: a worker's
+      ``StatusWriter``, status updates are handed off to it rather than
+      being written in their own transaction.
     """
     
     def __init__(self, **kwargs):
         self.due_factory = kwargs.get('due_factory', due.DueFactory())
+        self.handle_cls = kwargs.get('handle_cls', TaskHandle)
+        self.mark_changed = kwargs.get('mark_changed', mark_changed)
         self.session = kwargs.get('session', model.Session)
+        self.status_factory = kwargs.get('status_factory', due.StatusFactory())
         self.statuses = kwargs.get('statuses', constants.TASK_STATUSES)
         self.task_cls = kwargs.get('task_cls', model.Task)
         self.tx_manager = kwargs.get('tx_manager', transaction.manager)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.write_status = kwargs.get('write_status', None)
     
-    def _update(self, **values):
+    def _handle(self, task):
+        """Return a handle on an acquired task instance."""
+        
+        data = task.__json__(include_request_data=True)
+        return self.handle_cls(task.id, task.retry_count, task.timeout, data,
+                retry_policy=task.retry_policy)
+    
+    def _update(self, handle, status, due=None):
         """Consistent logic to update the task. Note that it includes
-          the retry_count and timeout as these are used by the onupdate
-          functions and thus need to be in the sqlalchemy execution
-          context's current params.
+          the retry_count, timeout and retry_policy as these are used by the
+          onupdate functions and thus need to be in the sqlalchemy execution
+          context's current params. Any attempt timestamps on the handle
+          are written too.
+          
+          Returns whether the task was updated, i.e.: ``False`` if it has
+          since been re-acquired.
         """
         
         # Unpack.
-        retry_count = self.task_data['retry_count']
-        timeout = self.task_data['timeout']
-        
-        # Merge the values with a consistent values dict.
+        task_id = handle.id
+        retry_count = handle.retry_count
+        timeout = handle.timeout
+        policy = handle.retry_policy
+        
+        # If we have a status writer, explicitly generate the due date that
+        # the onupdate machinery would otherwise have and hand off to it.
+        if self.write_status is not None:
+            if due is None:
+                due = self.due_factory(timeout, retry_count, policy=policy)
+            return self.write_status(task_id, retry_count, status, due,
+                    started=handle.started, ended=handle.ended)
+        
+        # Otherwise merge the values with a consistent values dict.
         values_dict = {
             'retry_count': retry_count,
+            'retry_policy': policy,
+            'status': status,
             'timeout': timeout,
         }
-        values_dict.update(values)
-        query = self.task_cls.query.filter_by(id=self.task_id,
+        if due is not None:
+            values_dict['due'] = due
+        if handle.started is not None:
+            values_dict['attempt_started'] = handle.started
+        if handle.ended is not None:
+            values_dict['attempt_ended'] = handle.ended
+        if status == self.statuses['completed']:
+            values_dict['completed'] = self.utcnow()
+        query = self.task_cls.query.filter_by(id=task_id,
                 retry_count=retry_count)
         with self.tx_manager:
-            query.update(values_dict)
+            return bool(query.update(values_dict))
     
     def acquire(self, id_, retry_count):
         """Get a task by ``id`` and ``retry_count``, transactionally setting the
           status to ``in_progress`` and incrementing the ``retry_count``.
+          
+          Returns a ``TaskHandle``, or ``None`` if the task wasn't acquired.
         """
         
-        self.task_id = id_
-        self.task_data = None
         query = self.task_cls.query
         query = query.filter_by(id=id_, retry_count=retry_count)
         with self.tx_manager:
             task = query.first()
             if task:
+                # Explicitly generate the status and due date, as the
+                # onupdate machinery can't see the task's retry policy.
+                policy = task.retry_policy
                 task.retry_count = retry_count + 1
+                task.status = self.status_factory(retry_count + 1,
+                        policy=policy)
+                task.due = self.due_factory(task.timeout, retry_count + 1,
+                        policy=policy)
+                if task.first_acquired is None:
+                    task.first_acquired = self.utcnow()
                 self.session.add(task)
-                self.task_data = task.__json__(include_request_data=True)
-        return self.task_data
+                return self._handle(task)
+    
+    def acquire_many(self, pairs):
+        """Acquire the tasks matching a list of ``(id, retry_count)`` pairs,
+          doing the same as ``acquire`` for each task that's matched.
+          
+          Locks the matching rows to read their timeouts and retry policies
+          and then updates them all with a single ``UPDATE ... FROM (VALUES
+          ...) RETURNING``, all in one transaction.
+          
+          Returns a list of ``TaskHandle``s. Stale pairs, i.e.: for tasks
+          that have since been acquired, are silently dropped.
+        """
+        
+        pairs = sorted(set(pairs))
+        if not pairs:
+            return []
+        table = self.task_cls.__tablename__
+        
+        # Select the rows to lock.
+        params = {}
+        values = []
+        for i, pair in enumerate(pairs):
+            keys = ['id_{0}'.format(i), 'rc_{0}'.format(i)]
+            params.update(zip(keys, pair))
+            values.append(u'(:{0}, :{1})'.format(*keys))
+        select_sql = SELECT_FOR_ACQUIRE_SQL.format(table=table,
+                values=u', '.join(values))
+        
+        with self.tx_manager:
+            rows = self.session.execute(text(select_sql), params).fetchall()
+            if not rows:
+                return []
+            
+            # Build a ``VALUES`` list with a set of bind params per row,
+            # generating the status and due date for the incremented retry
+            # count using the task's retry policy.
+            names = ('id', 'rc', 'status', 'due')
+            params = {'now': self.utcnow()}
+            values = []
+            for i, (id_, retry_count, timeout, policy) in enumerate(rows):
+                row = (id_, retry_count,
+                        self.status_factory(retry_count + 1, policy=policy),
+                        self.due_factory(timeout, retry_count + 1,
+                                policy=policy))
+                keys = ['{0}_{1}'.format(name, i) for name in names]
+                params.update(zip(keys, row))
+                values.append(u'(:{0}, :{1}, :{2}, :{3})'.format(*keys))
+            sql = ACQUIRE_TASKS_SQL.format(table=table,
+                    values=u', '.join(values))
+            
+            # Load the returned rows as instances so they're serialised
+            # exactly as by ``acquire``, making sure the transaction manager
+            # knows to commit.
+            query = self.task_cls.query.from_statement(text(sql))
+            tasks = query.params(params).all()
+            self.mark_changed(self.session())
+            return [self._handle(task) for task in tasks]
     
-    def reschedule(self):
+    def reschedule(self, handle, delay=None):
         """Reschedule a task by setting the due date -- does the same as the
-          default / onupdate machinery but with a timeout of 0.
+          default / onupdate machinery but with a timeout of 0. If provided,
+          e.g.: from a ``Retry-After`` header, the task is due in ``delay``
+          seconds instead.
+        """
+        
+        policy = handle.retry_policy
+        status = self.status_factory(handle.retry_count, policy=policy)
+        if delay is None:
+            due = self.due_factory(0, handle.retry_count, policy=policy)
+        else:
+            due = self.utcnow() + timedelta(seconds=delay)
+        if self._update(handle, status, due=due):
+            return status
+    
+    def defer(self, handle, due):
+        """Push a task back until ``due`` without attempting it, undoing the
+          increment of the ``retry_count`` so the attempt isn't counted.
+          
+          Deferring changes the ``retry_count``, so it isn't handed off to
+          the status writer.
         """
         
-        retry_count = self.task_data['retry_count']
-        self._update(due=self.due_factory(0, retry_count))
-        return self.statuses['pending']
+        values_dict = {
+            'due': due,
+            'retry_count': handle.retry_count - 1,
+            'status': self.statuses['pending'],
+            'timeout': handle.timeout,
+        }
+        query = self.task_cls.query.filter_by(id=handle.id,
+                retry_count=handle.retry_count)
+        with self.tx_manager:
+            if query.update(values_dict):
+                return self.statuses['pending']
     
-    def complete(self):
+    def complete(self, handle):
         """Flag a task as completed."""
         
         status = self.statuses['completed']
-        self._update(status=status)
-        return status
+        if self._update(handle, status):
+            return status
     
-    def fail(self):
+    def fail(self, handle):
         """Flag a task as failed."""
         
         status = self.statuses['failed']
-        self._update(status=status)
-        return status
+        if self._update(handle, status):
+            return status
+    
+
+class DeferTasks(object):
+    """Push back the due date of all of the pending tasks for a host."""
+    
+    def __init__(self, **kwargs):
+        self.mark_changed = kwargs.get('mark_changed', mark_changed)
+        self.session = kwargs.get('session', model.Session)
+        self.statuses = kwargs.get('statuses', constants.TASK_STATUSES)
+        self.task_cls = kwargs.get('task_cls', model.Task)
+        self.tx_manager = kwargs.get('tx_manager', transaction.manager)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+    
+    def __call__(self, host, due):
+        """Set the due date of the pending tasks whose url is on ``host``
+          and that are due before ``due`` to ``due``, in a single statement.
+          Returns the number of tasks deferred.
+        """
+        
+        params = {
+            'due': due,
+            'host': host.lower(),
+            'now': self.utcnow(),
+            'pending': self.statuses['pending'],
+        }
+        sql = DEFER_TASKS_SQL.format(table=self.task_cls.__tablename__,
+                url_host=constants.URL_HOST_SQL)
+        with self.tx_manager:
+            result = self.session.execute(text(sql), params)
+            self.mark_changed(self.session())
+            return result.rowcount
+    
+
+class UpdateTasks(object):
+    """Set the status and due date of many tasks in a single statement."""
+    
+    def __init__(self, **kwargs):
+        self.mark_changed = kwargs.get('mark_changed', mark_changed)
+        self.session = kwargs.get('session', model.Session)
+        self.statuses = kwargs.get('statuses', constants.TASK_STATUSES)
+        self.task_cls = kwargs.get('task_cls', model.Task)
+        self.tx_manager = kwargs.get('tx_manager', transaction.manager)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+    
+    def __call__(self, rows):
+        """Update the tasks matching a list of ``(id, retry_count, status,
+          due[, started, ended])`` tuples using a single ``UPDATE ... FROM
+          (VALUES ...)``, recording the attempt times, if given, and when
+          completed tasks were completed.
+          
+          The update is guarded on the ``retry_count``, so tasks that have
+          since been re-acquired are left alone. Returns the set of ids of
+          the tasks that were updated.
+        """
+        
+        if not rows:
+            return set()
+        
+        # Build a ``VALUES`` list with a set of bind params per row.
+        # The timestamps are cast so the column types are known even if
+        # they're all null.
+        names = ('id', 'rc', 'status', 'due', 'started', 'ended')
+        params = {
+            'completed': self.statuses['completed'],
+            'now': self.utcnow(),
+        }
+        values = []
+        for i, row in enumerate(rows):
+            keys = ['{0}_{1}'.format(name, i) for name in names]
+            params.update(zip(keys, tuple(row) + (None, None)))
+            values.append(u'(:{0}, :{1}, :{2}, :{3}, CAST(:{4} AS TIMESTAMP), '
+                    u'CAST(:{5} AS TIMESTAMP))'.format(*keys))
+        table = self.task_cls.__tablename__
+        sql = UPDATE_TASKS_SQL.format(table=table, values=u', '.join(values))
+        
+        # Execute, making sure the transaction manager knows to commit.
+        with self.tx_manager:
+            result = self.session.execute(text(sql), params)
+            self.mark_changed(self.session())
+            return set(row[0] for row in result)
+    
+
+class GetTaskAttempts(object):
+    """Get a task's attempt log."""
+    
+    def __init__(self, **kwargs):
+        self.attempt_cls = kwargs.get('attempt_cls', model.TaskAttempt)
+    
+    def __call__(self, task_id, limit=100):
+        """Return up to ``limit`` of the task's most recent attempts, in the
+          order they were made.
+        """
+        
+        model_cls = self.attempt_cls
+        query = model_cls.query.filter(model_cls.task_id==task_id)
+        query = query.order_by(model_cls.created.desc(),
+                model_cls.attempt.desc()).limit(limit)
+        return list(reversed(query.all()))
+    
+
+class InsertAttempts(object):
+    """Append many entries to the attempt log in a single statement."""
+    
+    def __init__(self, **kwargs):
+        self.attempt_cls = kwargs.get('attempt_cls', model.TaskAttempt)
+        self.mark_changed = kwargs.get('mark_changed', mark_changed)
+        self.session = kwargs.get('session', model.Session)
+        self.tx_manager = kwargs.get('tx_manager', transaction.manager)
+    
+    def __call__(self, rows):
+        """Insert a list of ``(task_id, attempt, created, status_code, error,
+          latency, body)`` tuples. Returns the number inserted.
+        """
+        
+        if not rows:
+            return 0
+        
+        # Build a ``VALUES`` list with a set of bind params per row.
+        names = ('id', 'attempt', 'c', 'code', 'error', 'latency', 'body')
+        params = {}
+        values = []
+        for i, row in enumerate(rows):
+            keys = ['{0}_{1}'.format(name, i) for name in names]
+            params.update(zip(keys, row))
+            values.append(u'({0})'.format(u', '.join(u':' + k for k in keys)))
+        sql = INSERT_ATTEMPTS_SQL.format(table=self.attempt_cls.__tablename__,
+                values=u', '.join(values))
+        
+        # Execute, making sure the transaction manager knows to commit.
+        with self.tx_manager:
+            self.session.execute(text(sql), params)
+            self.mark_changed(self.session())
+        return len(rows)
+    
+
+class ManageAttemptPartitions(object):
+    """Create the attempt log's daily partitions ``days_ahead`` of time and
+      drop the ones older than ``retention_days``. If the attempt log isn't
+      partitioned, i.e.: on postgres < 11, delete the older rows instead.
+    """
+    
+    def __init__(self, days_ahead=2, retention_days=7, **kwargs):
+        self.days_ahead = days_ahead
+        self.retention_days = retention_days
+        self.attempt_cls = kwargs.get('attempt_cls', model.TaskAttempt)
+        self.mark_changed = kwargs.get('mark_changed', mark_changed)
+        self.session = kwargs.get('session', model.Session)
+        self.tx_manager = kwargs.get('tx_manager', transaction.manager)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+    
+    def __call__(self):
+        """Make sure there are partitions from today until ``days_ahead`` and
+          drop those for the days before the last ``retention_days``. Returns
+          the names of the partitions created and dropped.
+        """
+        
+        # Unpack.
+        days_ahead = self.days_ahead
+        retention_days = self.retention_days
+        table = self.attempt_cls.__tablename__
+        name_format = ATTEMPT_PARTITION_FORMAT.format(table=table)
+        today = self.utcnow().replace(hour=0, minute=0, second=0,
+                microsecond=0)
+        oldest = (today - timedelta(days=retention_days)).strftime(name_format)
+        
+        with self.tx_manager:
+            is_partitioned = self.session.execute(text(IS_PARTITIONED_SQL),
+                    {'table': table}).scalar()
+            if not is_partitioned:
+                sql = DELETE_EXPIRED_ATTEMPTS_SQL.format(table=table)
+                expired_before = today - timedelta(days=retention_days)
+                self.session.execute(text(sql),
+                        {'expired_before': expired_before})
+                self.mark_changed(self.session())
+                return [], []
+            result = self.session.execute(text(LIST_PARTITIONS_SQL),
+                    {'table': table})
+            existing = set(row[0] for row in result)
+            
+            # Create the partitions that are missing.
+            created = []
+            for i in range(days_ahead + 1):
+                start = today + timedelta(days=i)
+                name = start.strftime(name_format)
+                if name in existing:
+                    continue
+                end = start + timedelta(days=1)
+                sql = CREATE_PARTITION_SQL.format(name=name, table=table,
+                        start=start.date(), end=end.date())
+                self.session.execute(text(sql))
+                created.append(name)
+            
+            # Drop the expired ones. Note that the names sort by date.
+            dropped = sorted(name for name in existing if name < oldest)
+            for name in dropped:
+                self.session.execute(text(u'DROP TABLE {0}'.format(name)))
+            
+            self.mark_changed(self.session())
+        return created, dropped
     
 
@@ -5,8 +5,32 @@
 DEFAULT_CHARSET = u'utf8'
 DEFAULT_ENCTYPE = u'application/x-www-form-urlencoded'
 PROXY_HEADER_PREFIX = u'Torque-Passthrough-'
+
+# Task statuses are stored as small integer codes, which keeps the rows narrow
+# and lets the indexes be partial on ``status`` (see ``orm.Task``). The labels
+# are what the API exposes.
 TASK_STATUSES = {
-    'completed': u'COMPLETED',
-    'failed': u'FAILED',
-    'pending': u'PENDING', 
+    'completed': 1,
+    'failed': 2,
+    'pending': 0,
+}
+TASK_STATUS_LABELS = {
+    0: u'PENDING',
+    1: u'COMPLETED',
+    2: u'FAILED',
 }
+
+# Matches the host part of a url, e.g.: ``example.com`` in
+# ``https://user@example.com:8080/hook``. The pending tasks are indexed by
+# their url's lower cased host (see ``orm.Task``) so they can be deferred by
+# host. Postgres only uses the index for this exact expression.
+URL_HOST_PATTERN = u'^[A-Za-z][A-Za-z0-9+.-]*://(?:[^@/]*@)?([^/:?#]+)'
+URL_HOST_SQL = u"lower(substring(url from '{0}'))".format(URL_HOST_PATTERN)
+
+# The task columns that record when it passed through each stage, in order.
+LIFECYCLE_TIMESTAMPS = (
+    'first_acquired',
+    'attempt_started',
+    'attempt_ended',
+    'completed',
+)
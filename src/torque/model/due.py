@@ -6,7 +6,11 @@
 
 __all__ = [
     'DueFactory',
+    'ParseRetryPolicy',
+    'ShouldRetry',
     'StatusFactory',
+    'configure',
+    'get_due_settings',
 ]
 
 import logging
@@ -14,74 +18,243 @@ logger = logging.getLogger(__name__)
 
 import datetime
 import os
+import random
+import re
 import transaction
 
+from pyramid.threadlocal import get_current_registry
+
 from torque import backoff
 from . import constants
 
 DEFAULT_SETTINGS = {
     'backoff': os.environ.get('TORQUE_BACKOFF', u'exponential'),
-    'min_delay': os.environ.get('TORQUE_MIN_DUE_DELAY', 2),
-    'max_delay': os.environ.get('TORQUE_MAX_DUE_DELAY', 7200),
-    'max_retries': os.environ.get('TORQUE_MAX_RETRIES', 36),
+    'jitter': os.environ.get('TORQUE_BACKOFF_JITTER', u'equal'),
+    'min_delay': float(os.environ.get('TORQUE_MIN_DUE_DELAY', 2)),
+    'max_delay': float(os.environ.get('TORQUE_MAX_DUE_DELAY', 7200)),
+    'max_retries': int(os.environ.get('TORQUE_MAX_RETRIES', 36)),
+    'retry_on': os.environ.get('TORQUE_RETRY_ON', u'5xx,429').split(','),
+}
+
+# Map ``torque.*`` Pyramid settings to the ``DEFAULT_SETTINGS`` they override.
+SETTINGS_KEYS = {
+    'torque.backoff': ('backoff', unicode),
+    'torque.backoff_jitter': ('jitter', unicode),
+    'torque.min_due_delay': ('min_delay', float),
+    'torque.max_due_delay': ('max_delay', float),
+    'torque.max_retries': ('max_retries', int),
+    'torque.retry_on': ('retry_on', lambda value: value.split(',')),
 }
 
+BACKOFF_ALGORITHMS = (u'exponential', u'linear')
+JITTER_ALGORITHMS = (u'decorrelated', u'equal', u'full', u'none')
+VALID_STATUS_CODE = re.compile(r'^[1-5]([0-9]{2}|xx)$')
+
+def configure(settings, defaults=None):
+    """Return a copy of the ``defaults``, by default the ``DEFAULT_SETTINGS``,
+      overridden by any provided in the Pyramid ``settings``.
+    """
+    
+    if defaults is None:
+        defaults = DEFAULT_SETTINGS
+    merged = dict(defaults)
+    for setting, (key, coerce) in SETTINGS_KEYS.items():
+        value = settings.get(setting)
+        if value is not None:
+            merged[key] = coerce(value)
+    return merged
+
+def get_due_settings(get_registry=get_current_registry):
+    """Return the current registry's ``due_settings``, as configured by the
+      ``torque.model`` includeme, or, if there aren't any, the defaults.
+    """
+    
+    return getattr(get_registry(), 'due_settings', DEFAULT_SETTINGS)
+
+def get_settings(settings, policy):
+    """Return the ``settings``, or, if ``None``, the current registry's,
+      overridden by a task's retry ``policy``.
+    """
+    
+    if settings is None:
+        settings = get_due_settings()
+    if not policy:
+        return settings
+    merged = dict(settings)
+    merged.update(policy)
+    return merged
+
+class ParseRetryPolicy(object):
+    """Parse and validate retry policy values, e.g.: from query params or an
+      application's stored policy. Returns a dict of just the values
+      provided, coerced, or raises a ``ValueError``. The ``retry_on`` codes
+      can be a comma separated string or a list, e.g.: ``[429, "5xx"]``.
+    """
+    
+    def __init__(self, **kwargs):
+        self.backoff_algorithms = kwargs.get('backoff_algorithms',
+                BACKOFF_ALGORITHMS)
+        self.jitter_algorithms = kwargs.get('jitter_algorithms',
+                JITTER_ALGORITHMS)
+        self.valid_status_code = kwargs.get('valid_status_code',
+                VALID_STATUS_CODE)
+    
+    def __call__(self, params):
+        policy = {}
+        for key in 'max_retries', 'min_delay', 'max_delay':
+            value = params.get(key)
+            if value is None:
+                continue
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                value = -1
+            if value < 0:
+                msg = u'{0} must be a non-negative integer.'
+                raise ValueError(msg.format(key))
+            policy[key] = value
+        for key, choices in (('backoff', self.backoff_algorithms),
+                ('jitter', self.jitter_algorithms)):
+            value = params.get(key)
+            if value is None:
+                continue
+            if value not in choices:
+                msg = u'{0} must be one of: {1}.'
+                raise ValueError(msg.format(key, u', '.join(choices)))
+            policy[key] = value
+        value = params.get('retry_on')
+        if value is not None:
+            if isinstance(value, basestring):
+                value = value.split(',')
+            elif not isinstance(value, (list, tuple)):
+                value = [value]
+            codes = [unicode(code).strip().lower() for code in value]
+            codes = [code for code in codes if code]
+            for code in codes:
+                if not self.valid_status_code.match(code):
+                    msg = u'retry_on must be status codes, like 503 or 5xx.'
+                    raise ValueError(msg)
+            policy['retry_on'] = codes
+        if policy.get('min_delay', 0) > policy.get('max_delay', float('inf')):
+            raise ValueError(u'min_delay must not be greater than max_delay.')
+        return policy
+    
+
 class DueFactory(object):
     """Simple callable that uses the current datetime and a task's timeout,
       and retry count to generate a future datetime when the task should
       be retried.
+      
+      The backoff delay is calculated in one step and then jittered, so that
+      tasks that failed together don't all retry together. The ``jitter``
+      setting is one of:
+      
+      * ``none``: use the backoff delay as is
+      * ``full``: a random delay between zero and the backoff delay
+      * ``equal``: half the backoff delay plus a random delay up to the
+        other half
+      * ``decorrelated``: a random delay between the ``min_delay`` and
+        three times the previous retry's backoff delay
+      
+      A task's retry ``policy`` overrides the settings.
     """
     
     def __init__(self, **kwargs):
         self.backoff_cls = kwargs.get('backoff', backoff.Backoff)
         self.datetime = kwargs.get('datetime', datetime.datetime)
+        self.random = kwargs.get('random', random.random)
         self.timedelta = kwargs.get('timedelta', datetime.timedelta)
-        self.settings = kwargs.get('settings', DEFAULT_SETTINGS)
+        self.settings = kwargs.get('settings', None)
     
-    def __call__(self, timeout, retry_count):
+    def __call__(self, timeout, retry_count, policy=None):
         """Return a datetime instance ``timeout + min_delay`` seconds in the
           future, plus, if there's a retry count, generate additional seconds
-          into the future using an exponential backoff algorithm.
+          into the future using the backoff algorithm.
         """
         
         # Unpack.
-        settings = self.settings
-        algorithm = settings.get('backoff')
-        min_delay = settings.get('min_delay')
+        settings = get_settings(self.settings, policy)
         max_delay = settings.get('max_delay')
         
         # Coerce.
         if not timeout:
             timeout = 0
         
-        # Use the ``retry_count`` to exponentially backoff from the ``min_delay``.
-        backoff = self.backoff_cls(min_delay)
-        backoff_method = getattr(backoff, algorithm)
-        for i in range(retry_count):
-            backoff_method()
-        
-        # Add the timeout and limit at the ``max_delay``.
-        delay = backoff.value + timeout
+        # Add the timeout to the backoff delay and limit at the ``max_delay``.
+        delay = self.delay(retry_count, policy=policy) + timeout
         if delay > max_delay:
             delay = max_delay
         
         # Generate a datetime ``delay`` seconds in the future.
         return self.datetime.utcnow() + self.timedelta(seconds=delay)
     
+    def delay(self, retry_count, policy=None):
+        """Return the number of seconds to backoff from the ``min_delay``
+          for the ``retry_count``, excluding the task's timeout.
+        """
+        
+        # Unpack.
+        settings = get_settings(self.settings, policy)
+        algorithm = settings.get('backoff')
+        jitter = settings.get('jitter', u'none')
+        min_delay = settings.get('min_delay')
+        max_delay = settings.get('max_delay')
+        
+        # Calculate the delay after ``retry_count`` steps in one go.
+        backoff = self.backoff_cls(min_delay, max_value=max_delay)
+        nth_value = getattr(backoff, 'nth_{0}'.format(algorithm))
+        delay = nth_value(retry_count)
+        
+        # Spread it out.
+        if jitter == u'full':
+            delay = delay * self.random()
+        elif jitter == u'equal':
+            delay = delay / 2.0 + delay / 2.0 * self.random()
+        elif jitter == u'decorrelated':
+            previous = nth_value(retry_count - 1) if retry_count else min_delay
+            upper = min(previous * 3, max_delay)
+            delay = min_delay + (upper - min_delay) * self.random()
+        return delay
+    
 
 class StatusFactory(object):
-    """Simple callable that uses a retry count to choose a task status."""
+    """Simple callable that uses a retry count, and optionally a task's retry
+      policy, to choose a task status code.
+    """
     
     def __init__(self, **kwargs):
-        self.settings = kwargs.get('settings', DEFAULT_SETTINGS)
+        self.settings = kwargs.get('settings', None)
         self.statuses = kwargs.get('statuses', constants.TASK_STATUSES)
     
-    def __call__(self, retry_count):
-        """Return pending if within the retry limit, else failed."""
+    def __call__(self, retry_count, policy=None):
+        """Return the pending code if within the retry limit, else failed."""
         
+        settings = get_settings(self.settings, policy)
         key = 'pending'
-        if retry_count > self.settings.get('max_retries'):
+        if retry_count > settings.get('max_retries'):
             key = 'failed'
         return self.statuses[key]
     
 
+class ShouldRetry(object):
+    """Simple callable that uses the ``retry_on`` setting, optionally
+      overridden by a task's retry policy, to decide whether a response
+      status code means the task should be retried. Codes can be given
+      exactly, e.g.: ``503``, or by class, e.g.: ``5xx``.
+    """
+    
+    def __init__(self, **kwargs):
+        self.settings = kwargs.get('settings', None)
+    
+    def __call__(self, status_code, policy=None):
+        """No response is always worth retrying."""
+        
+        if status_code is None:
+            return True
+        codes = get_settings(self.settings, policy).get('retry_on')
+        if any(not isinstance(code, basestring) for code in codes):
+            codes = [unicode(code) for code in codes]
+        return (str(status_code) in codes or
+                '{0}xx'.format(status_code // 100) in codes)
+    
+
@@ -8,12 +8,12 @@ __all__ = [
     'Base',
     'Session',
     'Task',
+    'TaskAttempt',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
-import json
 from datetime import datetime
 
 from zope.sqlalchemy import ZopeTransactionExtension
@@ -25,10 +25,16 @@ from sqlalchemy.schema import Column
 from sqlalchemy.schema import Index
 from sqlalchemy.schema import ForeignKey
 
+from sqlalchemy.sql import func
+from sqlalchemy.sql import literal
+
+from sqlalchemy.dialects.postgresql import JSONB
+
 from sqlalchemy.types import Boolean
 from sqlalchemy.types import DateTime
-from sqlalchemy.types import Enum
+from sqlalchemy.types import Float
 from sqlalchemy.types import Integer
+from sqlalchemy.types import SmallInteger
 from sqlalchemy.types import Unicode
 from sqlalchemy.types import UnicodeText
 
@@ -43,7 +49,10 @@ Base = declarative.declarative_base()
 
 from .constants import DEFAULT_CHARSET
 from .constants import DEFAULT_ENCTYPE
+from .constants import LIFECYCLE_TIMESTAMPS
 from .constants import TASK_STATUSES
+from .constants import TASK_STATUS_LABELS
+from .constants import URL_HOST_PATTERN
 
 from .due import DueFactory
 from .due import StatusFactory
@@ -59,9 +68,10 @@ def next_due(context, get_due=None):
     params = context.current_parameters
     retry_count = params.get('retry_count')
     timeout = params.get('timeout')
+    policy = params.get('retry_policy')
     
     # Return the next due date.
-    return get_due(timeout, retry_count)
+    return get_due(timeout, retry_count, policy=policy)
 
 def next_status(context, get_status=None):
     """Tie the status factory into the SQLAlchemy onupdate machinery."""
@@ -73,9 +83,10 @@ def next_status(context, get_status=None):
     # Unpack.
     params = context.current_parameters
     retry_count = params.get('retry_count')
+    policy = params.get('retry_policy')
     
     # Return the next due date.
-    return get_status(retry_count)
+    return get_status(retry_count, policy=policy)
 
 
 class BaseMixin(object):
@@ -150,6 +161,10 @@ class Application(Base, BaseMixin, LifeCycleMixin):
     __tablename__ = 'applications'
     
     name = Column(Unicode(96), nullable=False)
+    
+    # Overrides the default retry settings for the app's tasks, see
+    # ``due.ParseRetryPolicy``.
+    retry_policy = Column(JSONB)
 
 
 class APIKey(Base, BaseMixin, LifeCycleMixin):
@@ -197,37 +212,113 @@ class Task(Base, BaseMixin):
     # How long to wait before assuming task execution wasn't sucessful.
     timeout = Column(Integer, default=20, nullable=False) # in seconds
     
+    # The app's retry policy merged with any given when the task was enqueued.
+    # Note that it's used by the due and status onupdate functions, so it
+    # needs to be in the params of any update that relies on them.
+    retry_policy = Column(JSONB)
+    
     # When should the task be retried? By default, this is the current time
     # plus the timeout, plus one second.
     due = Column(DateTime, default=next_due, onupdate=next_due, nullable=False)
     
-    # Is it completed or not?
-    status = Column(Enum(*TASK_STATUSES.values(), name='task_statuses'),
-            default=next_status, onupdate=next_status, index=True,
+    # Is it completed or not? Stored as a ``TASK_STATUSES`` code and indexed
+    # partially, see ``ix_tasks_pending_due`` below.
+    status = Column(SmallInteger, default=next_status, onupdate=next_status,
             nullable=False)
     
     # The web hook url and POST body with charset and content type. Note that
-    # the data is decoded from the charset to unicode.
+    # the data is decoded from the charset to unicode and that the headers are
+    # stored as JSONB, so they're encoded and decoded by the driver.
     url = Column(Unicode(256), nullable=False)
     charset = Column(Unicode(24), default=DEFAULT_CHARSET, nullable=False)
     enctype = Column(Unicode(256), default=DEFAULT_ENCTYPE, nullable=False)
-    headers = Column(UnicodeText, default=u'{}')
+    headers = Column(JSONB, default=lambda: {})
     body = Column(UnicodeText)
     
+    # Lifecycle timestamps, so the latency of each stage can be measured:
+    # the task is enqueued when it's created, then first acquired, then each
+    # attempt starts and ends when the web hook request is sent and responds.
+    # The last attempt's times are kept, along with when it was completed.
+    first_acquired = Column(DateTime)
+    attempt_started = Column(DateTime)
+    attempt_ended = Column(DateTime)
+    completed = Column(DateTime)
+    
     def __json__(self, request=None, include_request_data=False):
         data = {
             'due': self.due.isoformat(),
             'id': self.id,
             'retry_count': self.retry_count,
-            'status': self.status,
+            'status': TASK_STATUS_LABELS[self.status],
             'timeout': self.timeout,
             'url': self.url,
         }
+        if self.retry_policy:
+            data['retry_policy'] = dict(self.retry_policy)
+        for key in LIFECYCLE_TIMESTAMPS:
+            value = getattr(self, key)
+            if value is not None:
+                data[key] = value.isoformat()
         if include_request_data:
             data['charset'] = self.charset
             data['enctype'] = self.enctype
-            data['headers'] = json.loads(self.headers)
+            data['headers'] = dict(self.headers or {})
             data['body'] = self.body
         return data
     
 
+class TaskAttempt(Base):
+    """An entry in a task's attempt log: what the web hook responded with,
+      or the class of the error if it didn't, and how long it took.
+      
+      On postgres >= 11 the table is partitioned by day on ``created``, so
+      old attempts expire by dropping partitions (otherwise, by deleting
+      them), see ``api.ManageAttemptPartitions``. It has no
+      foreign key to the tasks, so the log can be written in batches without
+      checking them.
+    """
+    
+    __tablename__ = 'task_attempts'
+    
+    task_id = Column(Integer, primary_key=True, autoincrement=False)
+    attempt = Column(Integer, primary_key=True, autoincrement=False)
+    created = Column('c', DateTime, default=datetime.utcnow,
+            primary_key=True)
+    
+    # The response status code, or the name of the error's class.
+    status_code = Column(SmallInteger)
+    error = Column(Unicode(64))
+    
+    # Seconds from sending the request to getting a response, and the start
+    # of the response body.
+    latency = Column(Float)
+    body = Column(UnicodeText)
+    
+    query = Session.query_property()
+    
+    def __json__(self, request=None):
+        return {
+            'attempt': self.attempt,
+            'body': self.body,
+            'created': self.created.isoformat(),
+            'error': self.error,
+            'latency': self.latency,
+            'status_code': self.status_code,
+        }
+    
+
+# Only pending tasks are ever polled for by due date, so index just those rows.
+Index('ix_tasks_pending_due', Task.due,
+        postgresql_where=Task.status==TASK_STATUSES['pending'])
+
+# Tasks for a host that's down are deferred by the host part of their url,
+# so index the pending rows by it. The expression must match
+# ``constants.URL_HOST_SQL``, as used by ``api.DeferTasks``.
+Index('ix_tasks_pending_host',
+        func.lower(func.substring(Task.url, literal(URL_HOST_PATTERN))),
+        Task.due, postgresql_where=Task.status==TASK_STATUSES['pending'])
+
+# Latency stats are reported for the tasks completed in a time window, so
+# index just the completed rows by when they were completed.
+Index('ix_tasks_completed', Task.completed,
+        postgresql_where=Task.completed!=None)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``QueryProfiler``, which uses SQLAlchemy engine events to time
+  every statement, aggregating the timings by normalised statement, and logs
+  a sample of the query plans of the statements that are slower than a
+  threshold.
+"""
+
+__all__ = [
+    'QueryProfiler',
+    'is_analyzable',
+    'normalise',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import gevent
+import random
+import re
+import time
+
+from sqlalchemy import event
+
+PARAM = re.compile(r"%\(\w+\)s|%s|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+ROWS = re.compile(r'\(\?(?:, \?)*\)(?:, \(\?(?:, \?)*\))+')
+LISTS = re.compile(r'\(\?(?:, \?)+\)')
+WHITESPACE = re.compile(r'\s+')
+
+# Only read only statements are ``EXPLAIN ANALYZE``d, as analyzing runs the
+# statement. Anything that writes, e.g.: a ``WITH`` with a data modifying
+# clause or a ``SELECT ... FOR UPDATE``, is only ``EXPLAIN``ed.
+ANALYZABLE = ('SELECT', 'WITH')
+WRITES = re.compile(r'\b(?:INSERT|UPDATE|DELETE|MERGE|TRUNCATE)\b', re.I)
+
+def normalise(statement):
+    """Replace the parameters and literals in a ``statement`` with ``?`` and
+      collapse ``IN`` lists and ``VALUES`` rows, so statements that only
+      differ by their values are aggregated together.
+    """
+    
+    statement = WHITESPACE.sub(u' ', statement).strip()
+    statement = PARAM.sub(u'?', statement)
+    statement = ROWS.sub(u'(...), ...', statement)
+    return LISTS.sub(u'(...)', statement)
+
+def is_analyzable(statement):
+    """Is the ``statement`` a ``SELECT`` or ``WITH`` that doesn't write?"""
+    
+    verb = statement.lstrip().split(None, 1)[0].upper()
+    return verb in ANALYZABLE and WRITES.search(statement) is None
+
+class StatementStats(object):
+    """The count, total and max seconds of a normalised statement."""
+    
+    __slots__ = ('count', 'max', 'total')
+    
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self.total = 0.0
+    
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    
+
+class QueryProfiler(object):
+    """Times every statement executed by an engine. Statements slower than
+      ``threshold`` seconds are counted and a ``sample_rate`` fraction of
+      them have their plan captured with ``EXPLAIN (ANALYZE, BUFFERS)``, or
+      just ``EXPLAIN`` if they write, and logged. Every ``report_interval``
+      seconds the slowest statements, by total time, are logged.
+      
+      The plans are captured in the background, by up to ``max_explains``
+      greenlets at a time, on connections of their own, so the statement's
+      connection, and the request or task that's using it, never waits on
+      an explain.
+      
+      Up to ``max_statements`` normalised statements are aggregated. Any
+      more are aggregated together as ``other``.
+    """
+    
+    def __init__(self, threshold=0.1, sample_rate=0.01, **kwargs):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.listen = kwargs.get('listen', event.listen)
+        self.logger = kwargs.get('logger', logger)
+        self.max_explains = kwargs.get('max_explains', 1)
+        self.max_statements = kwargs.get('max_statements', 500)
+        self.normalise = kwargs.get('normalise', normalise)
+        self.random = kwargs.get('random', random.random)
+        self.report_interval = kwargs.get('report_interval', 300)
+        self.report_limit = kwargs.get('report_limit', 10)
+        self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.time = kwargs.get('time', time.time)
+        self.engine = None
+        self.explaining = 0
+        self.last_report = self.time()
+        self.normalised = {}
+        self.statements = {}
+        self.stats = collections.Counter()
+    
+    def install(self, engine):
+        """Listen to the ``engine``'s cursor events."""
+        
+        self.engine = engine
+        self.listen(engine, 'before_cursor_execute', self.before_execute)
+        self.listen(engine, 'after_cursor_execute', self.after_execute)
+    
+    def before_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        conn.info.setdefault('torque_profile_start', []).append(self.time())
+    
+    def after_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        """Aggregate the timing and, if slow, maybe explain the statement."""
+        
+        stack = conn.info.get('torque_profile_start')
+        if not stack:
+            return
+        now = self.time()
+        seconds = now - stack.pop()
+        self.stats['queries'] += 1
+        self.aggregate(statement).add(seconds)
+        if seconds >= self.threshold:
+            self.stats['slow_queries'] += 1
+            if not executemany and self.random() < self.sample_rate:
+                self.sample(statement, parameters, seconds)
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.report()
+    
+    def aggregate(self, statement):
+        """Return the stats for the ``statement``'s normalised form, caching
+          the normalisation, as the same few statements are run repeatedly.
+        """
+        
+        key = self.normalised.get(statement)
+        if key is None:
+            key = self.normalise(statement)
+            if len(self.normalised) < self.max_statements * 10:
+                self.normalised[statement] = key
+        stats = self.statements.get(key)
+        if stats is None:
+            if len(self.statements) >= self.max_statements:
+                key = u'other'
+                stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+        return stats
+    
+    def sample(self, statement, parameters, seconds):
+        """Explain the statement in the background, unless ``max_explains``
+          are already running.
+        """
+        
+        if self.explaining >= self.max_explains:
+            self.stats['explains_skipped'] += 1
+            return
+        self.explaining += 1
+        self.spawn(self.explain, statement, parameters, seconds)
+    
+    def explain(self, statement, parameters, seconds):
+        """Log the statement's plan."""
+        
+        try:
+            plan = self.get_plan(statement, parameters)
+        except Exception as err:
+            self.logger.warn(err, exc_info=True)
+            return
+        finally:
+            self.explaining -= 1
+        self.stats['explained_queries'] += 1
+        msg = u'Slow query ({0:.0f}ms): {1}\n{2}'
+        self.logger.warn(msg.format(seconds * 1000, self.normalise(statement),
+                plan))
+    
+    def get_plan(self, statement, parameters):
+        """Explain the statement on a raw connection from the engine's pool,
+          so the explain isn't itself profiled, in a transaction that's
+          always rolled back.
+        """
+        
+        if is_analyzable(statement):
+            prefix = u'EXPLAIN (ANALYZE, BUFFERS) '
+        else:
+            prefix = u'EXPLAIN '
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(prefix + statement, parameters)
+                return u'\n'.join(row[0] for row in cursor.fetchall())
+            finally:
+                cursor.close()
+        finally:
+            try:
+                conn.rollback()
+            finally:
+                conn.close()
+    
+    def report(self):
+        """Log the statements that have taken the most time in total."""
+        
+        items = sorted(self.statements.items(), key=lambda item: item[1].total,
+                reverse=True)[:self.report_limit]
+        lines = [u'{0:>8} {1:>10.1f} {2:>10.1f} {3}'.format(stats.count,
+                stats.total * 1000, stats.max * 1000, key)
+                for key, stats in items]
+        header = u'{0:>8} {1:>10} {2:>10} {3}'.format(u'count', u'total_ms',
+                u'max_ms', u'statement')
+        self.logger.info(u'\n'.join([header] + lines))
+    
+
@@ -200,6 +200,33 @@ class TestRootEndpoint(unittest.TestCase):
         self.assertEquals(task_enctype, u'application/json')
         self.assertTrue(json.loads(task_body), params)
     
+    def test_post_task_with_passthrough_headers(self):
+        """Prefixed headers should be stored, unprefixed, as a JSON object."""
+        
+        from torque import model
+        get_task = model.LookupTask()
+        
+        # Create the wsgi app, which also sets up the db.
+        settings = {'torque.authenticate': False}
+        api = self.app_factory(**settings)
+        
+        # Setup a request with a passthrough header.
+        url = u'http://example.com/hook'
+        endpoint = '/?url=' + urllib.quote_plus(url.encode('utf-8'))
+        headers = {'Torque-Passthrough-Foo': 'bar'}
+        
+        # Enquing the task should respond with 201.
+        r = api.post(endpoint, headers=headers, status=201)
+        
+        # The header should be stored without its prefix.
+        task_id = int(r.headers['Location'].split('/')[-1])
+        with transaction.manager:
+            task = get_task(task_id)
+            task_headers = task.headers
+            task_data = task.__json__()
+        self.assertEquals(task_headers, {u'Foo': u'bar'})
+        self.assertEquals(task_data['status'], u'PENDING')
+    
 
 class TestGetCreatedTaskLocation(unittest.TestCase):
     """Test that the task location returned by ``POST /`` works."""
@@ -228,6 +255,71 @@ class TestGetCreatedTaskLocation(unittest.TestCase):
         # Getting that location should return JSON and a 200.
         r = api.get_json(location, status=200)
     
+    def test_get_task_attempts(self):
+        """A task's attempt log is gettable, in order."""
+        
+        from datetime import datetime
+        from torque import model
+        
+        # Create the wsgi app and enque a task.
+        settings = {'torque.authenticate': False}
+        api = self.app_factory(**settings)
+        url = u'http://example.com/hook'
+        endpoint = '/?url=' + urllib.quote_plus(url.encode('utf-8'))
+        r = api.post(endpoint, status=201)
+        location = r.headers['Location']
+        task_id = int(location.split('/')[-1])
+        
+        # Log a couple of attempts.
+        now = datetime.utcnow()
+        model.InsertAttempts()([
+            (task_id, 1, now, None, u'ConnectionError', 0.5, None),
+            (task_id, 2, now, 200, None, 0.1, u'ok'),
+        ])
+        
+        # They're returned as JSON.
+        r = api.get_json(location + '/attempts', status=200)
+        attempts = r.json['attempts']
+        self.assertEquals([a['attempt'] for a in attempts], [1, 2])
+        self.assertEquals(attempts[0]['error'], u'ConnectionError')
+        self.assertEquals(attempts[1]['status_code'], 200)
+    
+    def test_server_timing(self):
+        """With server timing on, enqueing a task returns the time spent in
+          each phase in a ``Server-Timing`` header.
+        """
+        
+        # Create the wsgi app, with server timing on.
+        settings = {'torque.authenticate': False, 'torque.server_timing': True}
+        api = self.app_factory(**settings)
+        
+        # Enque a task.
+        url = u'http://example.com/hook'
+        endpoint = '/?url=' + urllib.quote_plus(url.encode('utf-8'))
+        r = api.post(endpoint, status=201)
+        
+        # The phases are in the header, in milliseconds.
+        phases = [item.split(';')[0] for item in
+                r.headers['Server-Timing'].split(', ')]
+        expected = ('auth', 'traversal', 'flush', 'commit', 'redis', 'total')
+        for phase in expected:
+            self.assertIn(phase, phases)
+    
+    def test_timing_listeners_are_registered_once(self):
+        """Configuring the app again doesn't register the session and engine
+          listeners again.
+        """
+        
+        from mock import Mock
+        from torque.api.timing import IncludeMe
+        registered = set()
+        listen = Mock(side_effect=lambda *args: registered.add(args))
+        include = IncludeMe(base=Mock(), session_cls=Mock(), listen=listen,
+                contains=lambda *args: args in registered)
+        for i in range(2):
+            include(Mock())
+        self.assertEquals(listen.call_count, 4)
+    
     def test_get_created_task_access_control(self):
         """When using authentication, the task is only accessible to the app
           that created it.
@@ -326,4 +418,45 @@ class TestCreatedTaskNotification(unittest.TestCase):
         self.assertTrue(location1.endswith(str(id1)))
         self.assertTrue(location2.endswith(str(id2)))
     
+    def test_notification_after_commit(self):
+        """Instructions should only be pushed once the task has been committed,
+          otherwise a fast consumer can pop an instruction for a task that it
+          can't acquire.
+        """
+        
+        import redis
+        from mock import patch
+        from torque import model
+        
+        # Setup.
+        api = self.app_factory(**{'torque.authenticate': False})
+        settings = self.app_factory.settings
+        channel = settings.get('torque.redis_channel')
+        
+        # Patch ``rpush`` to look the task up, as a consumer would, using a
+        # new db connection, before pushing the instruction.
+        engine = model.Session.get_bind()
+        visible = []
+        rpush = redis.StrictRedis.rpush
+        def mock_rpush(client, name, *values):
+            for value in values:
+                task_id = int(value.split(':')[0])
+                connection = engine.connect()
+                try:
+                    sql = 'SELECT count(*) FROM tasks WHERE id = %s'
+                    count = connection.execute(sql, task_id).scalar()
+                finally:
+                    connection.close()
+                visible.append(count)
+            return rpush(client, name, *values)
+        
+        # Enque the task.
+        url = u'http://example.com/hook'
+        endpoint = '/?url=' + urllib.quote_plus(url.encode('utf-8'))
+        with patch.object(redis.StrictRedis, 'rpush', mock_rpush):
+            r = api.post(endpoint, status=201)
+        
+        # The task was visible when the instruction was pushed.
+        self.assertEquals(visible, [1])
+    
 
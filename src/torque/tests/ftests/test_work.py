@@ -27,6 +27,127 @@ class TestChannelConsumer(unittest.TestCase):
     #    
     #    self.assertTrue('foo' == 'foo')
     
+    def test_stop_drains(self):
+        """Stopping waits for tasks in flight and pushes back instructions
+          that were popped but not acquired.
+        """
+        
+        from torque.work.consume import ChannelConsumer
+        
+        # Setup.
+        redis = self.config_factory.redis_client
+        channel = self.config_factory.settings.get('torque.redis_channel')
+        redis.rpush(channel, '1:0', '2:0')
+        
+        # Consume one at a time with a handler that stops the consumer when
+        # performing a task.
+        handled = []
+        class Handler(object):
+            def acquire_many(self, instructions):
+                return dict((i, {'instruction': i}) for i in instructions)
+            def perform(self, task_data, control_flag):
+                consumer.stop()
+                handled.append(task_data['instruction'])
+        consumer = ChannelConsumer(redis, [channel], batch_size=1, timeout=1,
+                grace=1, handler=Handler(), sleep=lambda delay: None)
+        consumer.start()
+        
+        # The first instruction was handled and the second pushed back.
+        self.assertEquals(handled, ['1:0'])
+        self.assertEquals(redis.lrange(channel, 0, -1), ['2:0'])
+    
+    def test_max_in_flight(self):
+        """Popping pauses whilst ``max_in_flight`` tasks are in flight."""
+        
+        import threading
+        import time
+        from torque.work.consume import ChannelConsumer
+        
+        # Setup.
+        redis = self.config_factory.redis_client
+        channel = self.config_factory.settings.get('torque.redis_channel')
+        redis.rpush(channel, '1:0', '2:0', '3:0', '4:0', '5:0')
+        
+        # Consume with a handler that holds tasks in flight until released.
+        acquired = []
+        release = threading.Event()
+        class Handler(object):
+            def acquire_many(self, instructions):
+                acquired.extend(instructions)
+                return dict((i, {'instruction': i}) for i in instructions)
+            def perform(self, task_data, control_flag):
+                release.wait()
+        consumer = ChannelConsumer(redis, [channel], batch_size=10, timeout=1,
+                grace=1, max_in_flight=2, handler=Handler())
+        thread = threading.Thread(target=consumer.start)
+        thread.start()
+        try:
+            time.sleep(0.5)
+            
+            # Only two were popped and the consumer is paused.
+            self.assertEquals(acquired, ['1:0', '2:0'])
+            self.assertEquals(consumer.in_flight, 2)
+            self.assertEquals(redis.llen(channel), 3)
+            self.assertTrue(consumer.stats['paused'] >= 1)
+        finally:
+            consumer.stop()
+            release.set()
+            thread.join()
+    
+    def test_pop_batch(self):
+        """Instructions are popped in batches, in order."""
+        
+        from torque.work.consume import ChannelConsumer
+        
+        # Setup.
+        redis = self.config_factory.redis_client
+        channel = self.config_factory.settings.get('torque.redis_channel')
+        redis.rpush(channel, '1:0', '2:0', '3:0')
+        
+        # Pop two at a time.
+        consumer = ChannelConsumer(redis, [channel], batch_size=2, timeout=1,
+                handler=None)
+        self.assertEquals(consumer.pop(), [(channel, '1:0'), (channel, '2:0')])
+        self.assertEquals(consumer.pop(), [(channel, '3:0')])
+        self.assertEquals(consumer.pop(), [])
+    
+
+class TestReliableChannelConsumer(unittest.TestCase):
+    """Test reclaiming the instructions of dead consumers."""
+    
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+    
+    def tearDown(self):
+        self.config_factory.drop()
+    
+    def test_reclaim(self):
+        """Instructions popped by a dead worker are pushed back."""
+        
+        from torque.work.consume import ReliableChannelConsumer
+        
+        # Setup.
+        redis = self.config_factory.redis_client
+        channel = self.config_factory.settings.get('torque.redis_channel')
+        redis.rpush(channel, '1:0', '2:0')
+        
+        # A worker pops an instruction and then dies.
+        dead = ReliableChannelConsumer(redis, [channel], batch_size=1,
+                ttl=5, worker_id='dead', time=lambda: 0, handler=None)
+        dead.beat()
+        self.assertEquals(dead.pop(), [(channel, '1:0')])
+        self.assertEquals(redis.llen(dead.processing_key(channel)), 1)
+        
+        # Another worker reaps it after the ttl.
+        live = ReliableChannelConsumer(redis, [channel], ttl=5,
+                worker_id='live', time=lambda: 10, handler=None)
+        live.reap()
+        
+        # The instruction is back at the head of the channel.
+        self.assertEquals(redis.lrange(channel, 0, -1), ['1:0', '2:0'])
+        self.assertEquals(redis.llen(dead.processing_key(channel)), 0)
+    
 
 class TestTaskPerformer(unittest.TestCase):
     """Test performing tasks."""
@@ -47,6 +168,44 @@ class TestTaskPerformer(unittest.TestCase):
         status = performer('1234:0', None)
         self.assertIsNone(status)
     
+    def test_acquire_many(self):
+        """Acquiring many tasks in one go skips stale instructions."""
+        
+        from pyramid.request import Request
+        
+        from torque.model import CreateTask
+        from torque.model import LookupTask
+        from torque.work.perform import TaskPerformer
+        
+        # Create some tasks.
+        req = Request.blank('/')
+        create_task = CreateTask()
+        with transaction.manager:
+            task_ids = []
+            for i in range(3):
+                task = create_task(None, 'http://example.com', 20, req)
+                task_ids.append(task.id)
+        
+        # Acquire them, with one instruction stale and one malformed.
+        instructions = ['{0}:0'.format(task_ids[0]),
+                '{0}:0'.format(task_ids[1]), '{0}:1'.format(task_ids[2]),
+                'foo']
+        performer = TaskPerformer()
+        acquired = performer.acquire_many(instructions)
+        
+        # Only the valid, current instructions acquired their tasks.
+        self.assertEquals(sorted(acquired.keys()), sorted(instructions[:2]))
+        for instruction, task_id in zip(instructions, task_ids[:2]):
+            self.assertEquals(acquired[instruction].id, task_id)
+            self.assertEquals(acquired[instruction].retry_count, 1)
+            self.assertEquals(acquired[instruction].data['body'], u'')
+        with transaction.manager:
+            self.assertEquals(LookupTask()(task_ids[0]).retry_count, 1)
+            self.assertEquals(LookupTask()(task_ids[2]).retry_count, 0)
+        
+        # Acquiring them again does nothing.
+        self.assertEquals(performer.acquire_many(instructions), {})
+    
     def test_performing_task(self):
         """Performing a task successfully marks it as completed."""
         
@@ -172,6 +331,234 @@ class TestTaskPerformer(unittest.TestCase):
         status = performer(instruction, flag)
         self.assertTrue(status is TASK_STATUSES[u'failed'])
     
+    def test_performing_task_retry_policy(self):
+        """Tasks are only retried on the status codes in their policy."""
+        
+        from mock import Mock
+        from pyramid.request import Request
+        from threading import Event
+        flag = Event()
+        flag.set()
+        
+        from torque.model import TASK_STATUSES
+        from torque.model import CreateTask
+        from torque.work.perform import TaskPerformer
+        
+        # Create a task that's retried on 429 but not 5xx.
+        req = Request.blank('/')
+        create_task = CreateTask()
+        policy = {'retry_on': [u'429'], 'max_retries': 3}
+        instructions = []
+        with transaction.manager:
+            for i in range(2):
+                task = create_task(None, 'http://example.com', 20, req,
+                        retry_policy=policy)
+                instructions.append('{0}:0'.format(task.id))
+        
+        # A 429 is retried, a 500 fails the task.
+        mock_post = Mock()
+        performer = TaskPerformer(post=mock_post)
+        mock_post.return_value.status_code = 429
+        status = performer(instructions[0], flag)
+        self.assertTrue(status is TASK_STATUSES[u'pending'])
+        mock_post.return_value.status_code = 500
+        status = performer(instructions[1], flag)
+        self.assertTrue(status is TASK_STATUSES[u'failed'])
+    
+    def test_application_retry_policy(self):
+        """An application's policy is validated when it's created and when
+          it's merged into its tasks' policies, coercing integer codes, so
+          that stored codes like ``[429]`` match.
+        """
+        
+        from mock import Mock
+        from pyramid.request import Request
+        from torque.model import CreateApplication
+        from torque.model import CreateTask
+        from torque.model.due import ShouldRetry
+        
+        create_app = CreateApplication()
+        with transaction.manager:
+            self.assertRaises(ValueError, create_app, u'bad',
+                    retry_policy={'retry_on': u'oops'})
+        
+        # An integer code stored by hand matches.
+        req = Request.blank('/')
+        logger = Mock()
+        create_task = CreateTask(logger=logger)
+        should_retry = ShouldRetry(settings={'retry_on': [u'5xx']})
+        with transaction.manager:
+            app = create_app(u'foo')
+            app.retry_policy = {'retry_on': [429], 'max_retries': 3}
+            task = create_task(app, 'http://example.com', 20, req)
+            self.assertEquals(task.retry_policy['retry_on'], [u'429'])
+            self.assertTrue(should_retry(429, policy=task.retry_policy))
+            self.assertFalse(should_retry(500, policy=task.retry_policy))
+            
+            # An invalid one is ignored.
+            app.retry_policy = {'max_retries': u'lots'}
+            task = create_task(app, 'http://example.com', 20, req)
+            self.assertEquals(task.retry_policy, None)
+            self.assertTrue(logger.warn.called)
+    
+    def test_performing_task_retry_after(self):
+        """Tasks are retried when a 429 response's Retry-After header asks,
+          and the host is held off for as long.
+        """
+        
+        import time
+        from datetime import datetime
+        from datetime import timedelta
+        from mock import Mock
+        from pyramid.request import Request
+        from threading import Event
+        flag = Event()
+        flag.set()
+        
+        from torque.model import TASK_STATUSES
+        from torque.model import CreateTask
+        from torque.model import LookupTask
+        from torque.work.breaker import CircuitBreaker
+        from torque.work.perform import TaskPerformer
+        
+        # Create a task.
+        req = Request.blank('/')
+        create_task = CreateTask()
+        with transaction.manager:
+            task = create_task(None, 'http://example.com', 20, req)
+            task_id = task.id
+        
+        # Respond with a 429, asking for a two minute wait.
+        mock_post = Mock()
+        mock_post.return_value.status_code = 429
+        mock_post.return_value.headers = {'retry-after': '120'}
+        breaker = CircuitBreaker(spawn=Mock(), time=time.time)
+        performer = TaskPerformer(post=mock_post, breaker=breaker)
+        
+        # The task is pending, due after the wait and the host is held.
+        status = performer('{0}:0'.format(task_id), flag)
+        self.assertTrue(status is TASK_STATUSES[u'pending'])
+        with transaction.manager:
+            due = LookupTask()(task_id).due
+        now = datetime.utcnow()
+        self.assertTrue(now + timedelta(seconds=100) < due)
+        self.assertTrue(due < now + timedelta(seconds=140))
+        self.assertFalse(breaker.allow('example.com'))
+        self.assertEquals(breaker.stats['breaker_held'], 1)
+    
+    def test_parse_retry_after(self):
+        """Retry-After headers can be seconds or HTTP dates."""
+        
+        from torque.work.client import ParseRetryAfter
+        parse = ParseRetryAfter(time=lambda: 784111777 - 30)
+        self.assertEquals(parse({'retry-after': '120'}), 120)
+        date = 'Sun, 06 Nov 1994 08:49:37 GMT'
+        self.assertEquals(parse({'retry-after': date}), 30)
+        self.assertEquals(parse({'retry-after': 'soon'}), None)
+        self.assertEquals(parse({}), None)
+    
+    def test_lifecycle_timestamps(self):
+        """Performing a task records when it passed through each stage, which
+          the latency stats are calculated from.
+        """
+        
+        from datetime import datetime
+        from datetime import timedelta
+        from mock import Mock
+        from pyramid.request import Request
+        from threading import Event
+        flag = Event()
+        flag.set()
+        
+        from torque.model import CreateTask
+        from torque.model import GetLatencyStats
+        from torque.model import LookupTask
+        from torque.work.perform import TaskPerformer
+        
+        # Create and perform a task.
+        req = Request.blank('/')
+        create_task = CreateTask()
+        with transaction.manager:
+            task = create_task(None, 'http://example.com', 20, req)
+            task_id = task.id
+        mock_post = Mock()
+        mock_post.return_value.status_code = 200
+        performer = TaskPerformer(post=mock_post)
+        performer('{0}:0'.format(task_id), flag)
+        
+        # The timestamps are in order.
+        with transaction.manager:
+            task = LookupTask()(task_id)
+            times = [task.created, task.first_acquired, task.attempt_started,
+                    task.attempt_ended, task.completed]
+        self.assertTrue(None not in times)
+        self.assertEquals(times, sorted(times))
+        
+        # And the task is counted in the stats.
+        now = datetime.utcnow()
+        stats = GetLatencyStats()(now - timedelta(hours=1), now)
+        self.assertEquals([item['count'] for item in stats], [1])
+        self.assertTrue(stats[0]['stages']['total'][0.5] >= 0)
+    
+    def test_attempt_log(self):
+        """Attempts are buffered and written in a batch."""
+        
+        from mock import Mock
+        from pyramid.request import Request
+        from threading import Event
+        flag = Event()
+        flag.set()
+        
+        from torque.model import CreateTask
+        from torque.model import GetTaskAttempts
+        from torque.work.attempts import AttemptWriter
+        from torque.work.perform import TaskPerformer
+        
+        # Create a task.
+        req = Request.blank('/')
+        create_task = CreateTask()
+        with transaction.manager:
+            task = create_task(None, 'http://example.com', 20, req)
+            task_id = task.id
+        
+        # Perform it with a 500 and then a 200 response.
+        writer = AttemptWriter()
+        mock_post = Mock()
+        mock_post.return_value.body = b'Oops'
+        performer = TaskPerformer(post=mock_post, write_attempt=writer)
+        for retry_count, status_code in enumerate((500, 200)):
+            mock_post.return_value.status_code = status_code
+            performer('{0}:{1}'.format(task_id, retry_count), flag)
+        
+        # Nothing's written until the writer flushes.
+        self.assertEquals(GetTaskAttempts()(task_id), [])
+        writer.flush()
+        attempts = GetTaskAttempts()(task_id)
+        self.assertEquals([a.status_code for a in attempts], [500, 200])
+        self.assertEquals([a.attempt for a in attempts], [1, 2])
+        self.assertEquals(attempts[0].body, u'Oops')
+        self.assertEquals(writer.stats['attempts_written'], 2)
+    
+    def test_attempt_log_errors(self):
+        """Entries that fail to write, e.g.: because the log's partitions
+          have run out, are dropped and logged as an error.
+        """
+        
+        from mock import Mock
+        from torque.work.attempts import AttemptWriter
+        error = Exception('no partition of relation "task_attempts" found')
+        logger = Mock()
+        writer = AttemptWriter(batch_size=2, logger=logger,
+                insert_attempts=Mock(side_effect=error))
+        for i in range(3):
+            writer(1, i + 1, 500, None, 0.1, b'')
+        writer.flush()
+        self.assertEquals(writer.stats['attempts_dropped'], 3)
+        self.assertEquals(logger.error.call_count, 2)
+        self.assertFalse(logger.warn.called)
+        msg = logger.error.call_args[0][0]
+        self.assertTrue(u'torque_requeue' in msg)
+    
     def test_performing_task_waits(self):
         """Performing a task exponentially backs off polling the greenlet
           to see whether it has completed.
@@ -219,3 +606,696 @@ class TestTaskPerformer(unittest.TestCase):
         self.assertTrue(0.2249 < counter.call_args_list[2][0][0] < 0.2251)
     
 
+class TestWebhookClient(unittest.TestCase):
+    """Test streaming web hook responses."""
+    
+    def setUp(self):
+        from gevent.pywsgi import WSGIServer
+        def app(environ, start_response):
+            size = int(environ['PATH_INFO'].strip('/'))
+            start_response('500 Internal Server Error', [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(size)),
+            ])
+            return ['x' * size]
+        self.server = WSGIServer(('127.0.0.1', 0), app, log=None)
+        self.server.start()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_body_is_capped(self):
+        """Only a prefix of the response body is kept."""
+        
+        from torque.work.client import WebhookClient
+        client = WebhookClient(max_body=10, max_drain=100)
+        
+        # Small bodies are drained, large ones discarded with the connection.
+        for size in 50, 5000:
+            response = client(self.url + '/{0}'.format(size), data='a=b')
+            self.assertEquals(response.status_code, 500)
+            self.assertEquals(response.body, 'x' * 10)
+        
+        # Either way, the next request works.
+        response = client(self.url + '/5', data='a=b')
+        self.assertEquals(response.body, 'x' * 5)
+    
+    def test_resolver(self):
+        """Given a resolver, the client's connections resolve with it and
+          the global ``getaddrinfo`` is left alone.
+        """
+        
+        import socket
+        from torque.work.client import WebhookClient
+        from torque.work.resolve import CachingResolver
+        getaddrinfo = socket.getaddrinfo
+        port = self.server.server_port
+        resolver = CachingResolver(dns_resolver=None,
+                getaddrinfo=lambda host, *args: getaddrinfo('127.0.0.1',
+                        *args))
+        client = WebhookClient(resolver=resolver)
+        url = 'http://hook.example:{0}/5'.format(port)
+        for i in range(2):
+            self.assertEquals(client(url, data='a=b').body, 'x' * 5)
+        self.assertEquals(resolver.stats['dns_misses'], 1)
+        self.assertTrue(socket.getaddrinfo is getaddrinfo)
+    
+
+class TestSupervisor(unittest.TestCase):
+    """Test supervising consumer processes."""
+    
+    def setUp(self):
+        from mock import Mock
+        from torque.backoff import Backoff
+        from torque.work.supervise import Supervisor
+        pids = iter(range(10, 20))
+        fds = iter(range(100, 200))
+        self.now = 100
+        self.close = Mock()
+        self.kill = Mock()
+        self.logger = Mock()
+        self.select = Mock()
+        self.sleep = Mock()
+        self.waitpid = Mock()
+        self.supervisor = Supervisor(Mock(), 2, close=self.close,
+                fork_process=lambda: next(pids), kill=self.kill,
+                logger=self.logger, max_delay=30, min_uptime=5,
+                pipe=lambda: (next(fds), next(fds)), select=self.select,
+                sleep=self.sleep, time=lambda: self.now,
+                waitpid=self.waitpid)
+        for slot in range(2):
+            self.supervisor.fork(slot, Backoff(1, max_value=30))
+    
+    def exit(self, pid, status=256):
+        """Have ``reap`` find that the child ``pid`` has exited."""
+        
+        self.waitpid.side_effect = [(pid, status), (0, 0)]
+        self.supervisor.reap()
+    
+    def test_reap_restarts_with_backoff(self):
+        """Children that die straight away are restarted in the same slot
+          after an exponentially increasing delay, which is reset once a
+          child has stayed up.
+        """
+        
+        supervisor = self.supervisor
+        self.now = 101
+        self.exit(10)
+        self.close.assert_any_call(100)
+        self.assertEquals(sorted(supervisor.children), [11, 12])
+        self.assertEquals(supervisor.children[12][0], 0)
+        self.now = 102
+        self.exit(12)
+        delays = [c[0][0] for c in self.sleep.call_args_list]
+        self.assertEquals(delays, [1, 2])
+        
+        # A child that dies after ``min_uptime`` is restarted straight away.
+        self.now = 200
+        self.exit(13)
+        self.assertEquals(self.sleep.call_count, 2)
+        self.assertEquals(supervisor.children[14][3].value, 1)
+    
+    def test_report_merges_child_stats(self):
+        """The latest line of stats from each child is merged with the stats
+          of the children that have exited.
+        """
+        
+        from mock import Mock
+        data = {
+            100: '{"popped": 1}\n{"popped": 3}\n',
+            102: '{"failed": 1, "popped": 2}\n',
+        }
+        self.supervisor.read = Mock(side_effect=lambda fd, size: data[fd])
+        self.select.return_value = ([100, 102], [], [])
+        self.supervisor.read_stats(timeout=1)
+        self.supervisor.is_stopping = True
+        self.exit(10)
+        self.supervisor.report()
+        msg = self.logger.warn.call_args[0][0]
+        self.assertEquals(msg, u'1 consumers: failed=1, popped=5')
+    
+    def test_stop_signals_children(self):
+        """Stopping sends the children ``SIGTERM``, ignoring children that
+          have already gone, and they're then not restarted.
+        """
+        
+        import signal
+        self.kill.side_effect = [OSError(), None]
+        self.supervisor.stop()
+        calls = sorted(c[0] for c in self.kill.call_args_list)
+        self.assertEquals(calls, [(10, signal.SIGTERM), (11, signal.SIGTERM)])
+        self.exit(10)
+        self.assertEquals(list(self.supervisor.children), [11])
+    
+    def test_pool_split(self):
+        """The db connection pool is split between the processes, unless
+          explicitly sized.
+        """
+        
+        from mock import Mock
+        from torque.work.consume import ConsoleScript
+        args = Mock(processes=4, pool_size=None, max_overflow=None,
+                stats_interval=60)
+        supervisor_cls = Mock()
+        script = ConsoleScript(parse_args=lambda argv: args,
+                pool_defaults={'pool_size': 10, 'max_overflow': 2},
+                supervisor_cls=supervisor_cls)
+        script([])
+        settings = {'sqlalchemy.pool_size': 2, 'sqlalchemy.max_overflow': 1}
+        supervisor_cls.assert_called_with(script.run, 4, settings=settings,
+                stats_interval=60)
+        self.assertTrue(supervisor_cls.return_value.start.called)
+        args.pool_size = 7
+        script([])
+        settings['sqlalchemy.pool_size'] = 7
+        supervisor_cls.assert_called_with(script.run, 4, settings=settings,
+                stats_interval=60)
+    
+
+class TestMetrics(unittest.TestCase):
+    """Test serving worker metrics."""
+    
+    def test_serve_metrics(self):
+        """Counters, gauges, histograms and reporters' stats are served in the
+          Prometheus text format, with the series per histogram limited.
+        """
+        
+        import collections
+        import requests
+        from torque.work.metrics import MetricsServer
+        from torque.work.metrics import Registry
+        
+        class Reporter(object):
+            stats = collections.Counter(popped=3)
+        
+        registry = Registry(max_series=1)
+        registry.report(Reporter())
+        registry.gauge(u'in_flight', lambda: 2)
+        for host in u'a.com', u'b.com':
+            registry.observe(u'webhook_host_seconds', 0.2,
+                    labels=((u'host', host),))
+        server = MetricsServer('127.0.0.1', 0, registry=registry)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:{0}'.format(server.server.server_port)
+            response = requests.get(url + '/metrics')
+            self.assertEquals(requests.get(url + '/').status_code, 404)
+        finally:
+            server.stop()
+        lines = response.text.splitlines()
+        self.assertTrue(u'torque_popped_total 3' in lines)
+        self.assertTrue(u'torque_in_flight 2' in lines)
+        bucket = (u'torque_webhook_host_seconds_bucket'
+                u'{{host="{0}",le="0.25"}} 1')
+        self.assertTrue(bucket.format(u'a.com') in lines)
+        self.assertTrue(bucket.format(u'other') in lines)
+    
+
+class TestHubMonitor(unittest.TestCase):
+    """Test detecting calls that block the gevent hub."""
+    
+    def test_blocking_call(self):
+        """Blocking the hub for longer than the threshold is counted once and
+          logged, with the blocking stack, once the hub runs again.
+        """
+        
+        import gevent
+        from mock import Mock
+        from torque.work.monitor import HubMonitor
+        from torque.work.monitor import get_original
+        
+        logger = Mock()
+        monitor = HubMonitor(threshold=0.05, logger=logger)
+        monitor.start()
+        try:
+            gevent.sleep(0.1)
+            get_original('time', 'sleep')(0.3)
+            gevent.sleep(0.1)
+        finally:
+            monitor.stop()
+        self.assertEquals(monitor.stats['hub_blocked'], 1)
+        self.assertTrue(monitor.stats['hub_blocked_ms'] >= 200)
+        msg = logger.warn.call_args[0][0]
+        self.assertTrue(u'test_blocking_call' in msg)
+    
+
+class TestStackSampler(unittest.TestCase):
+    """Test the sampling profiler."""
+    
+    def test_profile(self):
+        """Once triggered, the running and waiting greenlets' stacks are
+          sampled and written in the collapsed stack format.
+        """
+        
+        import os
+        import shutil
+        import tempfile
+        from torque.work.sampler import StackSampler
+        
+        output_dir = tempfile.mkdtemp()
+        try:
+            sampler = StackSampler(seconds=0.2, greenlet_interval=0.05,
+                    output_dir=output_dir)
+            sampler().join()
+            filenames = os.listdir(output_dir)
+            with open(os.path.join(output_dir, filenames[0])) as f:
+                lines = f.read().splitlines()
+        finally:
+            shutil.rmtree(output_dir)
+        self.assertEquals(len(filenames), 1)
+        self.assertTrue(all(l.split(';')[0] in ('running', 'waiting')
+                for l in lines))
+        self.assertTrue(all(l.rsplit(' ', 1)[1].isdigit() for l in lines))
+        self.assertTrue(any(l.startswith('waiting;') and 'test_profile' in l
+                for l in lines))
+    
+
+class TestQueryProfiler(unittest.TestCase):
+    """Test timing statements and explaining the slow ones."""
+    
+    def test_normalise(self):
+        """Statements that only differ by their values normalise the same."""
+        
+        from torque.model.profile import normalise
+        sql = (u"UPDATE tasks SET s = v.s FROM (VALUES (%(a_1)s, 2),\n"
+                u"  (%(a_2)s, 3)) AS v(id, s) WHERE id IN (1, 2) AND x = 'y'")
+        self.assertEquals(normalise(sql), u"UPDATE tasks SET s = v.s FROM "
+                u"(VALUES (...), ...) AS v(id, s) WHERE id IN (...) AND x = ?")
+    
+    def test_explain_slow_query(self):
+        """Statements are aggregated and the slow ones are explained."""
+        
+        from mock import Mock
+        from sqlalchemy import create_engine
+        from sqlalchemy import text
+        from torque.model.profile import QueryProfiler
+        from torque.tests.boilerplate import TEST_SETTINGS
+        
+        logger = Mock()
+        spawned = []
+        profiler = QueryProfiler(threshold=0, sample_rate=1, logger=logger,
+                spawn=lambda *args: spawned.append(args))
+        engine = create_engine(TEST_SETTINGS['sqlalchemy.url'])
+        profiler.install(engine)
+        with engine.connect() as conn:
+            for i in range(3):
+                conn.execute(text('SELECT :value'), value=i).fetchall()
+        self.assertEquals(profiler.statements[u'SELECT ?'].count, 3)
+        
+        # Only one explain runs at a time, in the background, on a
+        # connection of its own.
+        self.assertEquals(len(spawned), 1)
+        self.assertEquals(profiler.stats['explains_skipped'], 2)
+        func, args = spawned[0][0], spawned[0][1:]
+        func(*args)
+        self.assertEquals(profiler.stats['explained_queries'], 1)
+        self.assertEquals(profiler.explaining, 0)
+        msg = logger.warn.call_args[0][0]
+        self.assertTrue(u'actual time' in msg)
+    
+    def test_is_analyzable(self):
+        """Only statements that don't write are analyzed."""
+        
+        from torque.model.profile import is_analyzable
+        self.assertTrue(is_analyzable(u'  SELECT id FROM tasks'))
+        self.assertTrue(is_analyzable(u'WITH t AS (SELECT 1) SELECT * FROM t'))
+        for sql in (u'UPDATE tasks SET s = 1', u'SELECT id FROM tasks FOR '
+                u'UPDATE', u'WITH t AS (DELETE FROM tasks RETURNING id) '
+                u'SELECT * FROM t', u'INSERT INTO tasks VALUES (1)'):
+            self.assertFalse(is_analyzable(sql))
+    
+
+class TestCachingResolver(unittest.TestCase):
+    """Test caching DNS lookups."""
+    
+    def setUp(self):
+        from mock import Mock
+        from torque.work.resolve import CachingResolver
+        self.getaddrinfo = Mock()
+        self.getaddrinfo.return_value = [('addr',)]
+        self.spawned = []
+        self.now = 0
+        self.resolver = CachingResolver(ttl=10, negative_ttl=2, max_size=2,
+                dns_resolver=None, getaddrinfo=self.getaddrinfo,
+                spawn=lambda *args: self.spawned.append(args),
+                time=lambda: self.now)
+    
+    def test_cache(self):
+        """Lookups are cached until they expire and are refreshed in the
+          background when they're near expiry.
+        """
+        
+        resolver = self.resolver
+        for i in range(3):
+            self.assertEquals(resolver('a', 80), [('addr',)])
+        self.assertEquals(self.getaddrinfo.call_count, 1)
+        self.assertEquals(resolver.stats['dns_hits'], 2)
+        
+        # Near expiry, a hit spawns a refresh.
+        self.now = 8
+        resolver('a', 80)
+        self.assertEquals(len(self.spawned), 1)
+        func, key = self.spawned[0]
+        func(key)
+        self.assertEquals(self.getaddrinfo.call_count, 2)
+        self.assertEquals(resolver.stats['dns_refreshes'], 1)
+        
+        # The refreshed entry is good until ``8 + 10``.
+        self.now = 17
+        resolver('a', 80)
+        self.assertEquals(self.getaddrinfo.call_count, 2)
+        self.now = 19
+        resolver('a', 80)
+        self.assertEquals(self.getaddrinfo.call_count, 3)
+    
+    def test_negative_cache_and_eviction(self):
+        """Failed lookups are cached and the cache size is bounded."""
+        
+        import socket
+        resolver = self.resolver
+        self.getaddrinfo.side_effect = socket.gaierror('nope')
+        for i in range(2):
+            self.assertRaises(socket.gaierror, resolver, 'bad', 80)
+        self.assertEquals(self.getaddrinfo.call_count, 1)
+        self.assertEquals(resolver.stats['dns_negative_hits'], 1)
+        
+        # Fill the cache past its size.
+        self.getaddrinfo.side_effect = None
+        resolver('a', 80)
+        resolver('b', 80)
+        self.assertEquals(len(resolver.cache), 2)
+        self.assertEquals(resolver.stats['dns_evictions'], 1)
+    
+    def test_ttl_is_looked_up_in_the_background(self):
+        """A miss doesn't wait on the TTL lookup, which shortens the entry's
+          expiry once it's run, and IP addresses aren't looked up at all.
+        """
+        
+        from mock import Mock
+        dns_resolver = Mock()
+        dns_resolver.query.return_value.rrset.ttl = 4
+        resolver = self.resolver
+        resolver.dns_resolver = dns_resolver
+        resolver('a', 80)
+        self.assertFalse(dns_resolver.query.called)
+        func, key, result = self.spawned.pop()
+        func(key, result)
+        self.assertEquals(dns_resolver.query.call_count, 1)
+        self.now = 5
+        resolver('a', 80)
+        self.assertEquals(self.getaddrinfo.call_count, 2)
+        self.spawned.pop()
+        
+        # IP addresses are cached for the ``ttl``, without a TTL lookup.
+        for host in '10.0.0.1', '::1':
+            resolver(host, 80)
+        self.assertEquals(self.spawned, [])
+        self.assertEquals(resolver.get_ttl('10.0.0.1'), 10)
+        self.assertEquals(dns_resolver.query.call_count, 1)
+    
+    def test_connect(self):
+        """Connecting tries each of the host's addresses in turn."""
+        
+        import socket
+        from mock import Mock
+        self.getaddrinfo.return_value = [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', 80)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.2', 80)),
+        ]
+        create_connection = Mock()
+        create_connection.side_effect = [socket.error('refused'), 'sock']
+        self.resolver.create_connection = create_connection
+        self.assertEquals(self.resolver.connect(('a', 80), 5), 'sock')
+        addresses = [c[0][0] for c in create_connection.call_args_list]
+        self.assertEquals(addresses, [('10.0.0.1', 80), ('10.0.0.2', 80)])
+    
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Test deferring the tasks for hosts that are down."""
+    
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+    
+    def tearDown(self):
+        self.config_factory.drop()
+    
+    def test_open_breaker_defers_tasks(self):
+        """Once open, a host's due tasks are pushed back and its tasks are
+          deferred rather than attempted, without using up a retry.
+        """
+        
+        import time
+        from mock import Mock
+        from pyramid.request import Request
+        from threading import Event
+        flag = Event()
+        flag.set()
+        
+        from torque.model import TASK_STATUSES
+        from torque.model import CreateTask
+        from torque.model import LookupTask
+        from torque.work.breaker import CircuitBreaker
+        from torque.work.perform import TaskPerformer
+        
+        # Create a task for a host that's down and one for a host that's up.
+        req = Request.blank('/')
+        create_task = CreateTask()
+        with transaction.manager:
+            down = create_task(None, 'https://down.com:8080/hook', 20, req)
+            up = create_task(None, 'http://up.com/hook', 20, req)
+            down_id, down_due = down.id, down.due
+            up_id, up_due = up.id, up.due
+        
+        # Two failures open the breaker, pushing back just the down host's
+        # tasks.
+        now = [time.time()]
+        breaker = CircuitBreaker(threshold=2, reset_timeout=3600,
+                spawn=lambda func, *args: func(*args), time=lambda: now[0])
+        for i in range(2):
+            self.assertTrue(breaker.allow('down.com'))
+            breaker.record_failure('down.com')
+        self.assertFalse(breaker.allow('down.com'))
+        self.assertEquals(breaker.stats['breaker_bulk_deferred'], 1)
+        with transaction.manager:
+            self.assertTrue(LookupTask()(down_id).due > down_due)
+            self.assertEquals(LookupTask()(up_id).due, up_due)
+        
+        # Performing the down host's task defers it without a request.
+        mock_post = Mock()
+        performer = TaskPerformer(post=mock_post, breaker=breaker)
+        status = performer('{0}:0'.format(down_id), flag)
+        self.assertEquals(status, TASK_STATUSES[u'pending'])
+        self.assertFalse(mock_post.called)
+        with transaction.manager:
+            self.assertEquals(LookupTask()(down_id).retry_count, 0)
+        
+        # After the reset timeout, a successful probe closes the breaker.
+        now[0] += 3600
+        mock_post.return_value.status_code = 200
+        status = performer('{0}:0'.format(down_id), flag)
+        self.assertEquals(status, TASK_STATUSES[u'completed'])
+        self.assertTrue(breaker.allow('down.com'))
+    
+
+class TestDueFactory(unittest.TestCase):
+    """Test generating retry delays."""
+    
+    def make_factory(self, **settings):
+        from torque.model.due import DueFactory
+        defaults = {
+            'backoff': u'exponential',
+            'jitter': u'none',
+            'min_delay': 2,
+            'max_delay': 100,
+        }
+        defaults.update(settings)
+        return DueFactory(settings=defaults, random=lambda: 0.5)
+    
+    def test_closed_form(self):
+        """Delays match looping the backoff and are limited."""
+        
+        from torque.backoff import Backoff
+        for algorithm in u'exponential', u'linear':
+            factory = self.make_factory(backoff=algorithm, max_delay=10**9)
+            for retry_count in range(20):
+                backoff = Backoff(2)
+                for i in range(retry_count):
+                    getattr(backoff, algorithm)()
+                self.assertEquals(factory.delay(retry_count), backoff.value)
+        factory = self.make_factory()
+        self.assertEquals(factory.delay(5000), 100)
+    
+    def test_jitter(self):
+        """Jitter spreads the delay out."""
+        
+        delays = {}
+        for jitter in u'full', u'equal', u'decorrelated':
+            factory = self.make_factory(jitter=jitter)
+            delays[jitter] = factory.delay(3)
+        self.assertEquals(delays[u'full'], 8)
+        self.assertEquals(delays[u'equal'], 12)
+        self.assertEquals(delays[u'decorrelated'], 2 + (24 - 2) * 0.5)
+    
+    def test_policy(self):
+        """A task's retry policy overrides the settings."""
+        
+        factory = self.make_factory()
+        policy = {'backoff': u'linear', 'min_delay': 5, 'max_delay': 20}
+        self.assertEquals(factory.delay(3, policy=policy), 20)
+        self.assertEquals(factory.delay(2, policy=policy), 15)
+        self.assertEquals(factory.delay(2), 8)
+    
+    def test_configure(self):
+        """Configuring returns the merged settings, without changing the
+          defaults, and the factories look them up in the current registry.
+        """
+        
+        from mock import Mock
+        from torque.model import due
+        defaults = dict(due.DEFAULT_SETTINGS)
+        settings = due.configure({'torque.max_retries': '3',
+                'torque.retry_on': '503,429'})
+        self.assertEquals(settings['max_retries'], 3)
+        self.assertEquals(settings['retry_on'], ['503', '429'])
+        self.assertEquals(due.DEFAULT_SETTINGS, defaults)
+        
+        registry = Mock(due_settings=settings)
+        self.assertTrue(due.get_due_settings(lambda: registry) is settings)
+        self.assertTrue(due.get_due_settings(lambda: object()) is
+                due.DEFAULT_SETTINGS)
+    
+
+class TestStatusWriter(unittest.TestCase):
+    """Test group committing task status updates."""
+    
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+    
+    def tearDown(self):
+        self.config_factory.drop()
+    
+    def test_performing_tasks_with_writer(self):
+        """Tasks performed concurrently are completed in a single batch."""
+        
+        import gevent
+        from mock import Mock
+        from pyramid.request import Request
+        from threading import Event
+        flag = Event()
+        flag.set()
+        
+        from torque.model import TASK_STATUSES
+        from torque.model import CreateTask
+        from torque.model import TaskManager
+        from torque.model import UpdateTasks
+        from torque.work.perform import TaskPerformer
+        from torque.work.write import StatusWriter
+        
+        # Create some tasks.
+        req = Request.blank('/')
+        create_task = CreateTask()
+        with transaction.manager:
+            instructions = []
+            for i in range(3):
+                task = create_task(None, 'http://example.com', 20, req)
+                instructions.append('{0}:0'.format(task.id))
+        
+        # Instantiate a writer that spies on its updates.
+        update_tasks = Mock(wraps=UpdateTasks())
+        writer = StatusWriter(interval=0.05, update_tasks=update_tasks)
+        
+        # And a single performer that uses it, as a consumer would, with
+        # requests.post mocked to return 200 without making a request.
+        mock_post = Mock()
+        mock_post.return_value.status_code = 200
+        task_manager = TaskManager(write_status=writer)
+        performer = TaskPerformer(post=mock_post, acquire_task=task_manager)
+        
+        # Perform the tasks concurrently.
+        writer.start()
+        try:
+            greenlets = []
+            for instruction in instructions:
+                greenlets.append(gevent.spawn(performer, instruction, flag))
+            gevent.joinall(greenlets)
+        finally:
+            writer.stop()
+        
+        # They should all be completed, with a single update guarded on
+        # each task's own retry count.
+        for greenlet in greenlets:
+            self.assertTrue(greenlet.value is TASK_STATUSES[u'completed'])
+        self.assertEquals(update_tasks.call_count, 1)
+        rows = update_tasks.call_args[0][0]
+        updated = ['{0}:{1}'.format(row[0], row[1] - 1) for row in rows]
+        self.assertEquals(sorted(updated), sorted(instructions))
+    
+    def test_stale_updates_are_ignored(self):
+        """Updates guarded on a stale retry count are not confirmed."""
+        
+        from datetime import datetime
+        from pyramid.request import Request
+        
+        from torque.model import TASK_STATUSES
+        from torque.model import CreateTask
+        from torque.model import LookupTask
+        from torque.model import UpdateTasks
+        
+        # Create a task.
+        req = Request.blank('/')
+        create_task = CreateTask()
+        with transaction.manager:
+            task = create_task(None, 'http://example.com', 20, req)
+            task_id = task.id
+        
+        # Updating it with the wrong retry count does nothing.
+        update_tasks = UpdateTasks()
+        completed = TASK_STATUSES[u'completed']
+        now = datetime.utcnow()
+        updated = update_tasks([(task_id, 1, completed, now)])
+        self.assertEquals(updated, set())
+        
+        # Updating it with the right retry count does.
+        updated = update_tasks([(task_id, 0, completed, now)])
+        self.assertEquals(updated, set([task_id]))
+        with transaction.manager:
+            task = LookupTask()(task_id)
+            self.assertEquals(task.status, completed)
+    
+
+class TestStubWebHook(unittest.TestCase):
+    """Test the benchmark's stub web hook."""
+    
+    def test_timeouts_are_not_completed(self):
+        """Requests held past the task timeout are attempted but never
+          counted as completed.
+        """
+        
+        from mock import Mock
+        from torque.bench.e2e import StubWebHook
+        
+        clock = [0]
+        def sleep(seconds):
+            clock[0] += seconds
+        
+        webhook = StubWebHook(lambda: 0.01, timeout_fraction=1,
+                timeout_latency=6, task_timeout=5, random=lambda: 0.5,
+                sleep=sleep, time=lambda: clock[0])
+        start_response = Mock()
+        webhook({'HTTP_BENCH_ID': '1'}, start_response)
+        self.assertEquals(webhook.first_attempted, {'1': 0})
+        self.assertEquals(webhook.completed, {})
+        status = start_response.call_args[0][0]
+        self.assertFalse(status.startswith('2'))
+        
+        # Nor are successes slower than the task timeout.
+        webhook.timeout_fraction = 0
+        webhook.slow_fraction = 1
+        webhook.slow_latency = 5
+        webhook({'HTTP_BENCH_ID': '1'}, start_response)
+        self.assertEquals(webhook.completed, {})
+    
+
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``AttemptWriter``, a utility that buffers the performers' attempt
+  log entries and writes them in batches, so that performing a task never
+  waits on the log.
+"""
+
+__all__ = [
+    'AttemptWriter',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import gevent
+
+from datetime import datetime
+
+from torque import model
+
+# Postgres' error when a row is inserted into a partitioned table that
+# doesn't have a partition for it.
+MISSING_PARTITION = 'no partition of relation'
+MISSING_PARTITION_HINT = (u'The attempt log has no partition for them: '
+        u'is torque_requeue running, to create the partitions ahead of time?')
+
+class AttemptWriter(object):
+    """Buffers up to ``max_pending`` ``(task_id, attempt, created,
+      status_code, error, latency, body)`` entries and, every ``interval``
+      seconds, inserts them in batches of up to ``batch_size``.
+      
+      Recording an entry just appends it to the buffer. If the buffer is full,
+      or a write fails, entries are dropped and counted, as the log is only
+      for diagnostics. Failed writes are logged as errors though, as they
+      usually mean that the log's partitions have run out.
+    """
+    
+    def __init__(self, interval=1, batch_size=500, max_pending=10000,
+            **kwargs):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.insert_attempts = kwargs.get('insert_attempts',
+                model.InsertAttempts())
+        self.logger = kwargs.get('logger', logger)
+        self.sleep = kwargs.get('sleep', gevent.sleep)
+        self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.is_running = False
+        self.pending = []
+        self.stats = collections.Counter()
+    
+    def __call__(self, task_id, attempt, status_code, error, latency, body):
+        """Buffer an entry."""
+        
+        if len(self.pending) >= self.max_pending:
+            self.stats['attempts_dropped'] += 1
+            return
+        self.pending.append((task_id, attempt, self.utcnow(), status_code,
+                error, latency, body))
+    
+    def start(self):
+        """Start writing in a background greenlet."""
+        
+        self.is_running = True
+        self.greenlet = self.spawn(self.run)
+    
+    def stop(self):
+        """Stop, flushing any pending entries once the current interval is
+          up.
+        """
+        
+        self.is_running = False
+        self.greenlet.join()
+        self.flush()
+    
+    def run(self):
+        """Flush the buffer every ``interval`` seconds."""
+        
+        while self.is_running:
+            self.sleep(self.interval)
+            self.flush()
+    
+    def flush(self):
+        """Write the buffered entries in batches."""
+        
+        while self.pending:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            try:
+                self.stats['attempts_written'] += self.insert_attempts(batch)
+            except Exception as err:
+                self.stats['attempts_dropped'] += len(batch)
+                msg = u'Dropped {0} attempt log entries.'.format(len(batch))
+                if MISSING_PARTITION in str(err):
+                    msg += u' ' + MISSING_PARTITION_HINT
+                self.logger.error(msg, exc_info=True)
+    
+
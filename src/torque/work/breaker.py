@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``CircuitBreaker``, a utility that stops a worker from tying up
+  its capacity on web hook hosts that are down.
+"""
+
+__all__ = [
+    'CircuitBreaker',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import gevent
+import time
+
+from datetime import datetime
+
+from torque import model
+
+class HostState(object):
+    """The breaker state for a host: the number of consecutive failures,
+      when the breaker is ``open_until`` (``None`` if closed) and how many
+      probes have been let through since it half-opened.
+    """
+    
+    __slots__ = ('failures', 'open_until', 'probes')
+    
+    def __init__(self):
+        self.failures = 0
+        self.open_until = None
+        self.probes = 0
+    
+
+class CircuitBreaker(object):
+    """Opens a host's breaker after ``threshold`` consecutive failures, or
+      timeouts. Whilst open, tasks for the host aren't attempted and, so they
+      don't keep being popped and deferred, the host's due tasks are pushed
+      back with a single ``model.DeferTasks`` statement.
+      
+      After ``reset_timeout`` seconds the breaker half-opens, letting up to
+      ``max_probes`` requests through. If a probe succeeds, the breaker
+      closes. If it fails, the breaker opens again.
+      
+      The breaker can also be opened for as long as a host asks us to back
+      off for, with ``hold``.
+    """
+    
+    def __init__(self, threshold=5, reset_timeout=30, max_probes=1,
+            **kwargs):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_probes = max_probes
+        self.defer_tasks = kwargs.get('defer_tasks', model.DeferTasks())
+        self.logger = kwargs.get('logger', logger)
+        self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.time = kwargs.get('time', time.time)
+        self.utcfromtimestamp = kwargs.get('utcfromtimestamp',
+                datetime.utcfromtimestamp)
+        self.hosts = {}
+        self.stats = collections.Counter()
+    
+    def allow(self, host):
+        """Return whether a request to the ``host`` should be attempted."""
+        
+        state = self.hosts.get(host)
+        if state is None or state.open_until is None:
+            return True
+        if self.time() >= state.open_until:
+            if state.probes < self.max_probes:
+                state.probes += 1
+                return True
+        self.stats['breaker_deferred'] += 1
+        return False
+    
+    def retry_at(self, host):
+        """Return the datetime that a task for the ``host`` that wasn't
+          allowed should be deferred until.
+        """
+        
+        now = self.time()
+        state = self.hosts.get(host)
+        if state is None or state.open_until is None:
+            return self.utcfromtimestamp(now)
+        return self.utcfromtimestamp(max(state.open_until,
+                now + self.reset_timeout))
+    
+    def record_success(self, host):
+        """Close the ``host``'s breaker."""
+        
+        state = self.hosts.pop(host, None)
+        if state is not None and state.open_until is not None:
+            msg = u'Closed the circuit breaker for {0}'
+            self.logger.warn(msg.format(host))
+    
+    def record_failure(self, host):
+        """Count a failure, opening the breaker if the ``threshold`` has been
+          reached or if a probe failed.
+        """
+        
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState()
+        state.failures += 1
+        if state.open_until is None:
+            if state.failures >= self.threshold:
+                self.open(host, self.reset_timeout)
+        elif self.time() >= state.open_until:
+            self.open(host, self.reset_timeout)
+    
+    def hold(self, host, seconds):
+        """Open the ``host``'s breaker for ``seconds``, e.g.: because it
+          responded with a ``Retry-After`` header, unless it's already open
+          for longer.
+        """
+        
+        state = self.hosts.get(host)
+        if state is not None and state.open_until is not None:
+            if state.open_until >= self.time() + seconds:
+                return
+        self.stats['breaker_held'] += 1
+        self.open(host, seconds)
+    
+    def open(self, host, seconds):
+        """Open the ``host``'s breaker for ``seconds`` and defer its tasks."""
+        
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState()
+        state.open_until = self.time() + seconds
+        state.probes = 0
+        self.stats['breaker_opened'] += 1
+        msg = u'Opened the circuit breaker for {0} for {1} seconds'
+        self.logger.warn(msg.format(host, seconds))
+        self.spawn(self.defer, host, self.utcfromtimestamp(state.open_until))
+    
+    def defer(self, host, until):
+        """Push the ``host``'s due tasks back ``until`` the breaker
+          half-opens.
+        """
+        
+        try:
+            count = self.defer_tasks(host, until)
+        except Exception as err:
+            self.logger.warn(err, exc_info=True)
+        else:
+            self.stats['breaker_bulk_deferred'] += count
+    
+
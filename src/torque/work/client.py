@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``WebhookClient``, a utility that POSTs to web hooks, streaming
+  the response so that the memory and bandwidth used per request are bounded
+  no matter how much the web hook sends back.
+  
+  If given a resolver, e.g.: a ``CachingResolver``, the client's connections
+  look up the web hook hosts with it, via a ``ResolvingHTTPAdapter``.
+"""
+
+__all__ = [
+    'ParseRetryAfter',
+    'ResolvingHTTPAdapter',
+    'WebhookClient',
+    'WebhookResponse',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import email.utils
+import functools
+import requests
+import requests.adapters
+import socket
+import time
+
+from requests.packages.urllib3 import connection
+from requests.packages.urllib3 import exceptions
+from requests.packages.urllib3 import poolmanager
+from requests.packages.urllib3 import util
+
+class ParseRetryAfter(object):
+    """Parse a response's ``Retry-After`` header, which can be either a number
+      of seconds or an HTTP date, into a number of seconds from now. Returns
+      ``None`` if there isn't a valid header.
+    """
+    
+    def __init__(self, **kwargs):
+        self.time = kwargs.get('time', time.time)
+    
+    def __call__(self, headers):
+        value = headers.get('retry-after') if headers else None
+        if not isinstance(value, basestring):
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return int(value)
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        try:
+            timestamp = email.utils.mktime_tz(parsed)
+        except (OverflowError, ValueError):
+            return None
+        return max(0, timestamp - self.time())
+    
+
+class ResolvingConnectionMixin(object):
+    """Open the connection's socket using the ``resolver``'s ``connect``."""
+    
+    def __init__(self, *args, **kwargs):
+        self.resolver = kwargs.pop('resolver')
+        super(ResolvingConnectionMixin, self).__init__(*args, **kwargs)
+    
+    def _new_conn(self):
+        conn = self.resolver.connect((self.host, self.port), self.timeout,
+                self.source_address)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                self.tcp_nodelay)
+        return conn
+    
+
+class ResolvingHTTPConnection(ResolvingConnectionMixin,
+        connection.HTTPConnection):
+    """A plain HTTP connection that uses the resolver."""
+    
+
+class ResolvingHTTPSConnection(ResolvingConnectionMixin,
+        connection.VerifiedHTTPSConnection):
+    """A verified HTTPS connection that uses the resolver. The base class
+      opens its socket inline, so ``connect`` is repeated here, opening the
+      socket with ``_new_conn`` and then wrapping and verifying it in the
+      same way.
+    """
+    
+    def connect(self):
+        try:
+            sock = self._new_conn()
+        except socket.timeout:
+            msg = 'Connection to {0} timed out. (connect timeout={1})'
+            raise exceptions.ConnectTimeoutError(self, msg.format(self.host,
+                    self.timeout))
+        if getattr(self, '_tunnel_host', None):
+            self.sock = sock
+            self._tunnel()
+        cert_reqs = util.resolve_cert_reqs(self.cert_reqs)
+        self.sock = util.ssl_wrap_socket(sock, self.key_file, self.cert_file,
+                cert_reqs=cert_reqs, ca_certs=self.ca_certs,
+                server_hostname=self.host,
+                ssl_version=util.resolve_ssl_version(self.ssl_version))
+        if cert_reqs != connection.ssl.CERT_NONE:
+            if self.assert_fingerprint:
+                util.assert_fingerprint(self.sock.getpeercert(
+                        binary_form=True), self.assert_fingerprint)
+            elif self.assert_hostname is not False:
+                connection.match_hostname(self.sock.getpeercert(),
+                        self.assert_hostname or self.host)
+    
+
+class ResolvingPoolManager(poolmanager.PoolManager):
+    """Creates connection pools whose connections use the ``resolver``."""
+    
+    connection_classes = {
+        'http': ResolvingHTTPConnection,
+        'https': ResolvingHTTPSConnection,
+    }
+    
+    def __init__(self, resolver, **kwargs):
+        poolmanager.PoolManager.__init__(self, **kwargs)
+        self.resolver = resolver
+    
+    def _new_pool(self, scheme, host, port):
+        pool = poolmanager.PoolManager._new_pool(self, scheme, host, port)
+        pool.ConnectionCls = functools.partial(
+                self.connection_classes[scheme], resolver=self.resolver)
+        return pool
+    
+
+class ResolvingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """A transport adapter whose connections look up hosts with the
+      ``resolver``, leaving the ``socket`` module alone.
+    """
+    
+    def __init__(self, resolver, **kwargs):
+        self.resolver = resolver
+        super(ResolvingHTTPAdapter, self).__init__(**kwargs)
+    
+    def init_poolmanager(self, connections, maxsize,
+            block=requests.adapters.DEFAULT_POOLBLOCK):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = ResolvingPoolManager(self.resolver,
+                num_pools=connections, maxsize=maxsize, block=block)
+    
+
+class WebhookResponse(object):
+    """The parts of a web hook response that are kept: the status code,
+      the headers and, for diagnostics, a prefix of the body.
+    """
+    
+    __slots__ = ('status_code', 'headers', 'body')
+    
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+    
+    def close(self):
+        """The connection was released when the response was read, so there's
+          nothing left to close.
+        """
+    
+
+class WebhookClient(object):
+    """Makes requests in streaming mode, reads the status line and headers
+      and then keeps up to ``max_body`` bytes of the body.
+      
+      Bodies up to ``max_drain`` bytes longer than that are read and
+      discarded, so the connection can go back into the pool. Longer bodies
+      aren't worth downloading, so the connection is closed instead.
+    """
+    
+    def __init__(self, max_body=1024, max_drain=65536, pool_size=10,
+            resolver=None, **kwargs):
+        self.max_body = max_body
+        self.max_drain = max_drain
+        self.chunk_size = kwargs.get('chunk_size', 8192)
+        self.response_cls = kwargs.get('response_cls', WebhookResponse)
+        self.session = kwargs.get('session', None)
+        if self.session is None:
+            self.session = requests.Session()
+            if resolver is None:
+                adapter = requests.adapters.HTTPAdapter(
+                        pool_maxsize=pool_size)
+            else:
+                adapter = ResolvingHTTPAdapter(resolver,
+                        pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+    
+    def __call__(self, url, data=None, headers=None, timeout=None):
+        """POST to the ``url`` and return a ``WebhookResponse``."""
+        
+        response = self.session.post(url, data=data, headers=headers,
+                timeout=timeout, stream=True)
+        body, is_drained = b'', False
+        try:
+            body, is_drained = self.read(response)
+        finally:
+            self.release(response, is_drained)
+        return self.response_cls(response.status_code, response.headers, body)
+    
+    def read(self, response):
+        """Read the body, keeping the first ``max_body`` bytes and giving up
+          after another ``max_drain``. Returns the prefix and whether the
+          whole body was read.
+        """
+        
+        limit = self.max_body + self.max_drain
+        prefix = []
+        num_kept = num_read = 0
+        for chunk in response.iter_content(self.chunk_size):
+            num_read += len(chunk)
+            if num_kept < self.max_body:
+                chunk = chunk[:self.max_body - num_kept]
+                prefix.append(chunk)
+                num_kept += len(chunk)
+            if num_read > limit:
+                return b''.join(prefix), False
+        return b''.join(prefix), True
+    
+    def release(self, response, is_drained):
+        """Release the connection back to the pool. If the body wasn't fully
+          read, close the connection first, so that the rest of the body is
+          discarded with it and the next request opens a fresh connection.
+        """
+        
+        raw = response.raw
+        if not is_drained:
+            raw.close()
+            connection = getattr(raw, '_connection', None)
+            if connection is not None:
+                connection.close()
+        raw.release_conn()
+    
+
@@ -1,99 +1,594 @@
 # -*- coding: utf-8 -*-
 
 """Provides ``ChannelConsumer``, a utility that consumes task instructions from
-  a redis channel and spawns a new (green) thread to perform each task.
+  a redis channel and spawns a new (green) thread to perform each task, and
+  ``ReliableChannelConsumer``, which tracks the instructions it has popped so
+  that they can be reclaimed if the consumer dies.
 """
 
 __all__ = [
     'ChannelConsumer',
+    'ReliableChannelConsumer',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
+import argparse
+import collections
+import gevent
+import json
+import os
+import signal
+import socket
 import threading
 import time
 
+from pyramid.settings import asbool
 from pyramid_redis.hooks import RedisFactory
 
+from torque import model
+from torque import util
+
+from .attempts import AttemptWriter
+from .breaker import CircuitBreaker
+from .client import WebhookClient
 from .main import Bootstrap
+from .metrics import InstrumentPool
+from .metrics import MetricsServer
+from .metrics import REGISTRY
 from .perform import TaskPerformer
+from .resolve import CachingResolver
+from .sampler import StackSampler
+from .supervise import Supervisor
+from .write import StatusWriter
+
+# Pop up to ``ARGV[1]`` instructions from the head of the ``KEYS[1]`` list.
+# If a second key is provided, also move them onto the tail of that list.
+POP_BATCH_SCRIPT = u"""
+    local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #items > 0 then
+        redis.call('LTRIM', KEYS[1], #items, -1)
+        if KEYS[2] then
+            redis.call('RPUSH', KEYS[2], unpack(items))
+        end
+    end
+    return items
+"""
+
+def parse_args(argv=None):
+    """Parse the command line arguments."""
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=1,
+            help='Number of consumer processes to fork.')
+    parser.add_argument('--pool-size', type=int,
+            help='Database connection pool size per process.')
+    parser.add_argument('--max-overflow', type=int,
+            help='Database connection pool overflow per process.')
+    parser.add_argument('--stats-interval', type=float, default=60,
+            help='How often to log the consumers\' aggregated stats.')
+    return parser.parse_args(argv)
 
 class ChannelConsumer(object):
-    """Takes instructions from one or more redis channels. Calls a handle
-      function in a new thread, passing through a flag that the handle
-      function can periodically check to exit.
+    """Takes instructions from one or more redis channels. Uses the handler
+      to acquire the tasks for each batch of instructions in one go and then
+      to perform each acquired task in a new thread, passing through a flag
+      that the handler can periodically check to exit.
+      
+      Pops up to ``batch_size`` instructions per round trip when there's a
+      backlog, only blocking when the channels are empty. At most
+      ``max_in_flight`` tasks are performed at once: whilst that many are in
+      flight, popping pauses until one finishes.
+      
+      When told to ``stop()``, stops popping instructions and gives the
+      tasks in flight up to ``grace`` seconds to finish before clearing
+      the flag. Instructions that were popped but not yet acquired are pushed
+      back onto the head of their channel.
     """
     
-    def __init__(self, redis, channels, delay=0.001, timeout=10, **kwargs):
+    def __init__(self, redis, channels, batch_size=50, timeout=10, grace=30,
+            max_in_flight=1000, **kwargs):
         self.redis = redis
         self.channels = channels
-        self.connect_delay = delay
+        self.batch_size = batch_size
         self.timeout = timeout
+        self.grace = grace
+        self.max_in_flight = max_in_flight
         self.handler = kwargs.get('handler', TaskPerformer())
         self.logger = kwargs.get('logger', logger)
+        self.metrics = kwargs.get('metrics', REGISTRY)
+        self.semaphore_cls = kwargs.get('semaphore_cls',
+                threading.BoundedSemaphore)
         self.sleep = kwargs.get('sleep', time.sleep)
+        self.time = kwargs.get('time', time.time)
         self.thread_cls = kwargs.get('thread_cls', threading.Thread)
         self.flag_cls = kwargs.get('flag_cls', threading.Event)
+        self.statuses = kwargs.get('statuses', model.TASK_STATUSES)
+        self.in_flight = 0
+        self.is_consuming = False
+        self.pop_batch = redis.register_script(POP_BATCH_SCRIPT)
+        self.slots = self.semaphore_cls(max_in_flight)
+        self.stats = collections.Counter()
     
     def start(self):
         self.control_flag = self.flag_cls()
         self.control_flag.set()
+        self.is_idle = self.flag_cls()
+        self.is_idle.set()
+        self.is_consuming = True
         try:
             self.consume()
+            self.drain()
         finally:
             self.control_flag.clear()
     
+    def stop(self):
+        """Stop consuming, e.g.: when sent a ``SIGTERM``."""
+        
+        self.logger.info('Stopping: draining tasks in flight.')
+        self.is_consuming = False
+    
+    def drain(self):
+        """Wait up to ``grace`` seconds for the tasks in flight to finish.
+          Then clear the control flag and give the remainder a moment to
+          update their status.
+        """
+        
+        self.is_idle.wait(self.grace)
+        self.control_flag.clear()
+        self.is_idle.wait(self.timeout)
+    
     def consume(self):
-        """Consume the redis channel ad-infinitum."""
+        """Consume the redis channel until stopped."""
         
-        while True:
+        while self.is_consuming:
+            self.wait_for_slot()
+            if not self.is_consuming:
+                break
             try:
-                return_value = self.redis.blpop(self.channels, timeout=self.timeout)
+                instructions = self.pop(limit=self.max_in_flight -
+                        self.in_flight)
             except Exception as err:
                 self.logger.warn(err, exc_info=True)
                 self.sleep(self.timeout)
             else:
-                if return_value is not None:
-                    channel, data = return_value
-                    self.spawn(data)
-                    self.sleep(self.connect_delay)
+                self.stats['popped'] += len(instructions)
+                if self.is_consuming:
+                    self.dispatch(instructions)
+                else:
+                    self.requeue_many(instructions)
+    
+    def wait_for_slot(self):
+        """Block until fewer than ``max_in_flight`` tasks are in flight."""
+        
+        if self.in_flight >= self.max_in_flight:
+            self.stats['paused'] += 1
+        self.slots.acquire()
+        self.slots.release()
+    
+    def pop(self, limit=None):
+        """Pop a batch of up to ``limit`` instructions from the first channel
+          that has any, returning a list of ``(channel, data)`` tuples. If
+          they're all empty, block until an instruction is available or the
+          timeout expires.
+        """
+        
+        batch_size = self.batch_size
+        if limit is not None:
+            batch_size = max(1, min(batch_size, limit))
+        for channel in self.channels:
+            items = self.pop_batch(keys=[channel], args=[batch_size])
+            if items:
+                return [(channel, data) for data in items]
+        start = self.time()
+        return_value = self.redis.blpop(self.channels, timeout=self.timeout)
+        self.metrics.observe(u'pop_wait_seconds', self.time() - start)
+        if return_value is None:
+            return []
+        return [return_value]
+    
+    def dispatch(self, instructions):
+        """Acquire the tasks for a batch of instructions in a single round
+          trip and perform each acquired task in a new thread. Stale
+          instructions are acknowledged and skipped.
+        """
+        
+        if not instructions:
+            return
+        start = self.time()
+        try:
+            acquired = self.handler.acquire_many([d for _, d in instructions])
+        except Exception as err:
+            self.logger.warn(err, exc_info=True)
+            self.requeue_many(instructions)
+            self.sleep(self.timeout)
+            return
+        self.metrics.observe(u'acquire_seconds', self.time() - start)
+        for channel, data in instructions:
+            handle = acquired.pop(data, None)
+            if handle is None:
+                self.ack(channel, data)
+                self.record(None)
+            else:
+                self.spawn(channel, data, handle)
+    
+    def spawn(self, channel, data, handle):
+        """Perform the acquired task in a new thread, once a slot is free."""
+        
+        self.slots.acquire()
+        self.in_flight += 1
+        self.is_idle.clear()
+        args = (channel, data, handle)
+        thread = self.thread_cls(target=self.perform, args=args)
+        thread.start()
+    
+    def perform(self, channel, data, handle):
+        """Call the handler to perform the task and then acknowledge the
+          instruction. The task has been acquired, so it's performed even if
+          we've since been stopped: the grace period covers it.
+        """
+        
+        try:
+            try:
+                status = self.handler.perform(handle, self.control_flag)
+            finally:
+                self.ack(channel, data)
+            self.record(status)
+        except Exception as err:
+            self.logger.warn(err, exc_info=True)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+            if not self.in_flight:
+                self.is_idle.set()
+    
+    def record(self, status):
+        """Count the outcome of handling an instruction."""
+        
+        for key, value in self.statuses.items():
+            if status == value:
+                self.stats[key] += 1
+                break
+        else:
+            self.stats['skipped'] += 1
+    
+    def requeue(self, channel, data):
+        """Push an instruction back onto the head of its channel."""
+        
+        self.redis.lpush(channel, data)
+    
+    def requeue_many(self, instructions):
+        """Push a batch of popped instructions back, keeping their order."""
+        
+        for channel, data in reversed(instructions):
+            try:
+                self.requeue(channel, data)
+            except Exception as err:
+                self.logger.warn(err, exc_info=True)
+            else:
+                self.stats['requeued'] += 1
+    
+    def ack(self, channel, data):
+        """Popped instructions are gone from the channel, so there's nothing
+          to acknowledge.
+        """
+    
+
+class ReliableChannelConsumer(ChannelConsumer):
+    """Atomically moves each instruction it pops onto a processing list of its
+      own and only removes it once it has been handled.
+      
+      Whilst running, the consumer heartbeats into a sorted set of workers
+      and periodically reaps the processing lists of workers that have
+      stopped heartbeating, pushing their instructions back onto the head of
+      their channels. Requires redis >= 6.2 for ``BLMOVE``.
+    """
+    
+    def __init__(self, redis, channels, heartbeat=2, ttl=10, **kwargs):
+        super(ReliableChannelConsumer, self).__init__(redis, channels, **kwargs)
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        self.worker_id = kwargs.get('worker_id', '{0}:{1}:{2}'.format(
+                socket.gethostname(), os.getpid(),
+                util.generate_random_digest(num_bytes=4)))
     
-    def spawn(self, data):
-        """Handle the ``data`` in a new thread."""
+    def processing_key(self, channel, worker_id=None):
+        if worker_id is None:
+            worker_id = self.worker_id
+        return '{0}:processing:{1}'.format(channel, worker_id)
+    
+    def workers_key(self, channel):
+        return '{0}:workers'.format(channel)
+    
+    def start(self):
+        """Register and start heartbeating before consuming."""
         
-        args = (data, self.control_flag)
-        thread = self.thread_cls(target=self.handler, args=args)
+        self.beat()
+        thread = self.thread_cls(target=self.beat_forever)
+        thread.daemon = True
         thread.start()
+        super(ReliableChannelConsumer, self).start()
+    
+    def beat_forever(self):
+        """Heartbeat and reap dead workers every ``heartbeat`` seconds."""
+        
+        while True:
+            self.sleep(self.heartbeat)
+            try:
+                self.beat()
+                self.reap()
+            except Exception as err:
+                self.logger.warn(err, exc_info=True)
+    
+    def beat(self):
+        """Record that this worker is alive."""
+        
+        now = self.time()
+        for channel in self.channels:
+            self.redis.zadd(self.workers_key(channel), now, self.worker_id)
+    
+    def reap(self):
+        """Push the instructions of workers that haven't heartbeat within the
+          ``ttl`` back onto the head of their channel.
+        """
+        
+        cutoff = self.time() - self.ttl
+        for channel in self.channels:
+            workers_key = self.workers_key(channel)
+            dead = self.redis.zrangebyscore(workers_key, '-inf', cutoff)
+            for worker_id in dead:
+                if worker_id == self.worker_id:
+                    continue
+                key = self.processing_key(channel, worker_id=worker_id)
+                count = 0
+                while self.redis.rpoplpush(key, channel) is not None:
+                    count += 1
+                self.redis.zrem(workers_key, worker_id)
+                if count:
+                    msg = 'Reclaimed {0} instructions from {1}'
+                    self.logger.warn(msg.format(count, worker_id))
+    
+    def pop(self, limit=None):
+        """Move a batch of up to ``limit`` instructions from the first
+          channel that has any onto our processing list. If they're all
+          empty, block on them in turn.
+        """
+        
+        batch_size = self.batch_size
+        if limit is not None:
+            batch_size = max(1, min(batch_size, limit))
+        for channel in self.channels:
+            keys = [channel, self.processing_key(channel)]
+            items = self.pop_batch(keys=keys, args=[batch_size])
+            if items:
+                return [(channel, data) for data in items]
+        timeout = float(self.timeout) / len(self.channels)
+        start = self.time()
+        try:
+            for channel in self.channels:
+                data = self.redis.execute_command('BLMOVE', channel,
+                        self.processing_key(channel), 'LEFT', 'RIGHT', timeout)
+                if data is not None:
+                    return [(channel, data)]
+            return []
+        finally:
+            self.metrics.observe(u'pop_wait_seconds', self.time() - start)
+    
+    def ack(self, channel, data):
+        """Remove the handled instruction from our processing list."""
+        
+        self.redis.lrem(self.processing_key(channel), 1, data)
+    
+    def requeue(self, channel, data):
+        """Atomically move an instruction from our processing list back onto
+          the head of its channel.
+        """
+        
+        pipeline = self.redis.pipeline()
+        pipeline.lrem(self.processing_key(channel), 1, data)
+        pipeline.lpush(channel, data)
+        pipeline.execute()
     
 
 class ConsoleScript(object):
-    """Bootstrap the environment and run the consumer."""
+    """Bootstrap the environment and run the consumer, or, if told to use
+      more than one process, a supervisor that forks consumer processes.
+    """
     
     def __init__(self, **kwargs):
+        self.attempt_writer_cls = kwargs.get('attempt_writer_cls',
+                AttemptWriter)
+        self.breaker_cls = kwargs.get('breaker_cls', CircuitBreaker)
+        self.client_cls = kwargs.get('client_cls', WebhookClient)
         self.consumer_cls = kwargs.get('consumer_cls', ChannelConsumer)
         self.get_redis = kwargs.get('get_redis', RedisFactory())
         self.get_config = kwargs.get('get_config', Bootstrap())
+        self.handle_signal = kwargs.get('handle_signal', gevent.signal)
+        self.instrument_pool = kwargs.get('instrument_pool', InstrumentPool())
+        self.metrics = kwargs.get('metrics', REGISTRY)
+        self.metrics_server_cls = kwargs.get('metrics_server_cls',
+                MetricsServer)
+        self.parse_args = kwargs.get('parse_args', parse_args)
+        self.performer_cls = kwargs.get('performer_cls', TaskPerformer)
+        self.pool_defaults = kwargs.get('pool_defaults', model.DEFAULTS)
+        self.reliable_consumer_cls = kwargs.get('reliable_consumer_cls',
+                ReliableChannelConsumer)
+        self.report_interval = kwargs.get('report_interval', 5)
+        self.resolver_cls = kwargs.get('resolver_cls', CachingResolver)
+        self.sampler_cls = kwargs.get('sampler_cls', StackSampler)
+        self.sleep = kwargs.get('sleep', gevent.sleep)
+        self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.supervisor_cls = kwargs.get('supervisor_cls', Supervisor)
+        self.task_manager_cls = kwargs.get('task_manager_cls', model.TaskManager)
+        self.writer_cls = kwargs.get('writer_cls', StatusWriter)
+    
+    def __call__(self, argv=None):
+        """Parse the command line arguments and either run a consumer in this
+          process or supervise ``--processes`` consumer processes, splitting
+          the db connection pool between them.
+        """
+        
+        args = self.parse_args(argv)
+        
+        # Size the per process db connection pools.
+        settings = {}
+        for key in 'pool_size', 'max_overflow':
+            value = getattr(args, key)
+            if value is None and args.processes > 1:
+                value = max(1, int(self.pool_defaults[key]) // args.processes)
+            if value is not None:
+                settings['sqlalchemy.{0}'.format(key)] = value
+        
+        # Either run in this process or fork and supervise the consumers.
+        if args.processes < 2:
+            return self.run(**settings)
+        supervisor = self.supervisor_cls(self.run, args.processes,
+                settings=settings, stats_interval=args.stats_interval)
+        supervisor.start()
     
-    def __call__(self):
+    def run(self, report_fd=None, slot=0, **settings):
         """Get the configured registry. Unpack the redis client and input
-          channel(s), instantiate and start the consumer.
+          channel(s), instantiate and start the consumer. If supervised, the
+          consumer's ``slot`` offsets the metrics port.
         """
         
         # Get the configured registry.
-        config = self.get_config()
+        config = self.get_config(settings=settings)
         
         # Unpack the redis client and input channels.
         settings = config.get_settings()
         redis_client = self.get_redis(settings, registry=config.registry)
         input_channels = settings.get('torque.redis_channel').strip().split()
         
-        # Instantiate and start the consumer.
-        consumer = self.consumer_cls(redis_client, input_channels)
+        # Instantiate a status writer to group commit the task status
+        # updates from all of the performers.
+        interval = float(settings.get('torque.status_batch_interval'))
+        batch_size = int(settings.get('torque.status_batch_size'))
+        writer = self.writer_cls(interval=interval, batch_size=batch_size)
+        
+        # The registry isn't thread, i.e.: greenlet, local here, so pass the
+        # configured retry schedule to its factories explicitly.
+        due_settings = config.registry.due_settings
+        task_manager = self.task_manager_cls(write_status=writer,
+                due_factory=model.due.DueFactory(settings=due_settings),
+                status_factory=model.due.StatusFactory(settings=due_settings))
+        
+        # Report the hub monitor's block counts and the query profiler's
+        # query counts, if they're running.
+        reporters = []
+        for name in 'hub_monitor', 'query_profiler':
+            reporter = getattr(config.registry, name, None)
+            if reporter is not None:
+                reporters.append(reporter)
+        
+        # Cache the web hook hosts' DNS lookups.
+        resolver = None
+        if asbool(settings.get('torque.dns_cache')):
+            negative_ttl = float(settings.get('torque.dns_negative_ttl'))
+            resolver = self.resolver_cls(
+                    ttl=float(settings.get('torque.dns_ttl')),
+                    negative_ttl=negative_ttl,
+                    max_size=int(settings.get('torque.dns_cache_size')))
+            reporters.append(resolver)
+        
+        # And a web hook client that bounds how much of each response body
+        # is read, shared by the performers so they share its connections.
+        # Its connections, and only its connections, use the resolver.
+        client = self.client_cls(
+                max_body=int(settings.get('torque.webhook_max_body')),
+                max_drain=int(settings.get('torque.webhook_max_drain')),
+                pool_size=int(settings.get('torque.webhook_pool_size')),
+                resolver=resolver)
+        
+        # Unless disabled, with a zero threshold, stop sending to hosts that
+        # are down.
+        breaker = None
+        threshold = int(settings.get('torque.breaker_threshold'))
+        if threshold > 0:
+            reset_timeout = float(settings.get('torque.breaker_reset_timeout'))
+            max_probes = int(settings.get('torque.breaker_probes'))
+            breaker = self.breaker_cls(threshold=threshold,
+                    reset_timeout=reset_timeout, max_probes=max_probes)
+            reporters.append(breaker)
+        
+        # Unless disabled, log each attempt, writing the log in batches.
+        attempt_writer = None
+        if asbool(settings.get('torque.attempt_log')):
+            attempt_writer = self.attempt_writer_cls(
+                    interval=float(settings.get('torque.attempt_interval')),
+                    batch_size=int(settings.get('torque.attempt_batch_size')))
+            reporters.append(attempt_writer)
+        max_retry_after = float(settings.get('torque.max_retry_after'))
+        should_retry = model.due.ShouldRetry(settings=due_settings)
+        handler = self.performer_cls(acquire_task=task_manager, post=client,
+                breaker=breaker, max_retry_after=max_retry_after,
+                should_retry=should_retry, write_attempt=attempt_writer)
+        
+        # Instantiate the consumer -- if configured to be reliable, tracking
+        # the instructions it pops so they can be reclaimed if it dies.
+        pop_batch_size = int(settings.get('torque.pop_batch_size'))
+        grace = float(settings.get('torque.drain_grace'))
+        max_in_flight = int(settings.get('torque.max_in_flight'))
+        if asbool(settings.get('torque.reliable')):
+            heartbeat = float(settings.get('torque.heartbeat_interval'))
+            ttl = float(settings.get('torque.worker_ttl'))
+            consumer = self.reliable_consumer_cls(redis_client,
+                    input_channels, batch_size=pop_batch_size, grace=grace,
+                    max_in_flight=max_in_flight, heartbeat=heartbeat,
+                    ttl=ttl, handler=handler)
+        else:
+            consumer = self.consumer_cls(redis_client, input_channels,
+                    batch_size=pop_batch_size, grace=grace,
+                    max_in_flight=max_in_flight, handler=handler)
+        
+        # If we're being supervised, report our stats.
+        if report_fd is not None:
+            self.spawn(self.report, report_fd, consumer, *reporters)
+        
+        # If configured to, serve metrics.
+        port = settings.get('torque.metrics_port')
+        if port:
+            for reporter in [consumer] + reporters:
+                self.metrics.report(reporter)
+            self.metrics.gauge(u'in_flight', lambda: consumer.in_flight)
+            self.instrument_pool(model.Base.metadata.bind)
+            host = settings.get('torque.metrics_host')
+            server = self.metrics_server_cls(host, int(port) + slot,
+                    registry=self.metrics)
+            server.start()
+        
+        # Profile when sent ``SIGUSR2``.
+        sampler = self.sampler_cls(
+                seconds=float(settings.get('torque.profile_seconds')),
+                output_dir=settings.get('torque.profile_dir') or None)
+        self.handle_signal(signal.SIGUSR2, sampler)
+        
+        # Drain gracefully when terminated and start.
+        self.handle_signal(signal.SIGTERM, consumer.stop)
+        writer.start()
+        if attempt_writer is not None:
+            attempt_writer.start()
         try:
             consumer.start()
         except KeyboardInterrupt:
             pass
+        finally:
+            writer.stop()
+            if attempt_writer is not None:
+                attempt_writer.stop()
+    
+    def report(self, fd, *reporters):
+        """Periodically write the consumer's stats, along with those of
+          any other ``reporters``, to the supervisor.
+        """
+        
+        while True:
+            self.sleep(self.report_interval)
+            stats = collections.Counter()
+            for reporter in reporters:
+                stats.update(reporter.stats)
+            os.write(fd, json.dumps(stats) + '\n')
     
 
 main = ConsoleScript()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``ConsoleScript``, which reports the p50, p95 and p99 seconds
+  that the tasks completed in a time window spent in each stage of their
+  lifecycle, per application::
+  
+      $ torque_latency --hours 24
+"""
+
+__all__ = [
+    'ConsoleScript',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import json
+import sys
+
+from datetime import datetime
+from datetime import timedelta
+
+from torque import model
+from .main import Bootstrap
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+def parse_args(argv=None):
+    """Parse the command line arguments."""
+    
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hours', type=float, default=24,
+            help='Report on the tasks completed in the last HOURS.')
+    parser.add_argument('--app-id', type=int,
+            help='Only report on this application\'s tasks.')
+    parser.add_argument('--json', action='store_true',
+            help='Write a line of JSON per application.')
+    return parser.parse_args(argv)
+
+class ConsoleScript(object):
+    """Bootstrap the environment, get the stats and write them to stdout."""
+    
+    def __init__(self, **kwargs):
+        self.get_config = kwargs.get('get_config', Bootstrap())
+        self.get_stats = kwargs.get('get_stats', model.GetLatencyStats())
+        self.parse_args = kwargs.get('parse_args', parse_args)
+        self.stdout = kwargs.get('stdout', sys.stdout)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+    
+    def __call__(self, argv=None):
+        args = self.parse_args(argv)
+        self.get_config()
+        until = self.utcnow()
+        since = until - timedelta(hours=args.hours)
+        stats = self.get_stats(since, until, app_id=args.app_id,
+                quantiles=QUANTILES)
+        for item in stats:
+            if args.json:
+                self.write_json(item)
+            else:
+                self.write_table(item)
+        return 0
+    
+    def write_json(self, item):
+        """Write the stats, keyed by ``p50`` etc., as a line of JSON."""
+        
+        stages = {}
+        for stage, values in item['stages'].items():
+            stages[stage] = dict((self.label(q), v) for q, v in values.items())
+        data = dict(item, stages=stages)
+        self.stdout.write(json.dumps(data, sort_keys=True) + '\n')
+    
+    def write_table(self, item):
+        """Write a row of seconds per stage."""
+        
+        labels = [self.label(q) for q in QUANTILES]
+        header = u'app {0}: {1} tasks'.format(item['app_id'], item['count'])
+        lines = [header, u'  {0:<10}'.format(u'stage') + u''.join(
+                u'{0:>10}'.format(label) for label in labels)]
+        for stage, _, _ in model.api.LATENCY_STAGES:
+            values = item['stages'].get(stage, {})
+            cells = []
+            for quantile in QUANTILES:
+                value = values.get(quantile)
+                cells.append(u'{0:>10}'.format(u'-' if value is None
+                        else u'{0:.3f}'.format(value)))
+            lines.append(u'  {0:<10}'.format(stage) + u''.join(cells))
+        self.stdout.write(u'\n'.join(lines) + u'\n\n')
+    
+    def label(self, quantile):
+        return u'p{0:g}'.format(quantile * 100)
+    
+
+main = ConsoleScript()
+
+if __name__ == '__main__':
+    sys.exit(main())
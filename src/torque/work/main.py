@@ -21,10 +21,44 @@ logging.basicConfig()
 import os
 from pyramid.config import Configurator
 from torque import model
+from .monitor import HubMonitor
 
 DEFAULTS = {
+    'attempt_batch_size': os.environ.get('TORQUE_ATTEMPT_BATCH_SIZE', 500),
+    'attempt_interval': os.environ.get('TORQUE_ATTEMPT_INTERVAL', 1),
+    'attempt_log': os.environ.get('TORQUE_ATTEMPT_LOG', False),
+    'attempt_partitions_ahead': os.environ.get(
+            'TORQUE_ATTEMPT_PARTITIONS_AHEAD', 2),
+    'attempt_retention_days': os.environ.get('TORQUE_ATTEMPT_RETENTION_DAYS',
+            7),
+    'block_threshold': os.environ.get('TORQUE_BLOCK_THRESHOLD', ''),
+    'breaker_probes': os.environ.get('TORQUE_BREAKER_PROBES', 1),
+    'breaker_reset_timeout': os.environ.get('TORQUE_BREAKER_RESET_TIMEOUT',
+            30),
+    'breaker_threshold': os.environ.get('TORQUE_BREAKER_THRESHOLD', 5),
+    'dns_cache': os.environ.get('TORQUE_DNS_CACHE', True),
+    'dns_cache_size': os.environ.get('TORQUE_DNS_CACHE_SIZE', 1024),
+    'dns_negative_ttl': os.environ.get('TORQUE_DNS_NEGATIVE_TTL', 5),
+    'dns_ttl': os.environ.get('TORQUE_DNS_TTL', 60),
+    'drain_grace': os.environ.get('TORQUE_DRAIN_GRACE', 30),
+    'heartbeat_interval': os.environ.get('TORQUE_HEARTBEAT_INTERVAL', 2),
+    'max_in_flight': os.environ.get('TORQUE_MAX_IN_FLIGHT', 1000),
+    'max_retry_after': os.environ.get('TORQUE_MAX_RETRY_AFTER', 3600),
+    'metrics_host': os.environ.get('TORQUE_METRICS_HOST', '127.0.0.1'),
+    'metrics_port': os.environ.get('TORQUE_METRICS_PORT', ''),
     'mode': os.environ.get('MODE', 'development'),
+    'pop_batch_size': os.environ.get('TORQUE_POP_BATCH_SIZE', 50),
+    'profile_dir': os.environ.get('TORQUE_PROFILE_DIR', ''),
+    'profile_seconds': os.environ.get('TORQUE_PROFILE_SECONDS', 30),
     'redis_channel': os.environ.get('TORQUE_REDIS_CHANNEL', 'torque'),
+    'reliable': os.environ.get('TORQUE_RELIABLE', False),
+    'status_batch_interval': os.environ.get('TORQUE_STATUS_BATCH_INTERVAL',
+            0.005),
+    'status_batch_size': os.environ.get('TORQUE_STATUS_BATCH_SIZE', 100),
+    'webhook_max_body': os.environ.get('TORQUE_WEBHOOK_MAX_BODY', 1024),
+    'webhook_max_drain': os.environ.get('TORQUE_WEBHOOK_MAX_DRAIN', 65536),
+    'webhook_pool_size': os.environ.get('TORQUE_WEBHOOK_POOL_SIZE', 100),
+    'worker_ttl': os.environ.get('TORQUE_WORKER_TTL', 10),
 }
 
 class Bootstrap(object):
@@ -33,6 +67,7 @@ class Bootstrap(object):
     def __init__(self, **kwargs):
         self.configurator_cls = kwargs.get('configurator_cls', Configurator)
         self.default_settings = kwargs.get('default_settings', DEFAULTS)
+        self.monitor_cls = kwargs.get('monitor_cls', HubMonitor)
         self.session = kwargs.get('session', model.Session)
     
     def __call__(self, **kwargs):
@@ -51,6 +86,13 @@ class Bootstrap(object):
         config.include('pyramid_redis')
         config.commit()
         
+        # If configured, monitor the gevent hub for blocking calls.
+        threshold = settings.get('torque.block_threshold')
+        if threshold:
+            monitor = self.monitor_cls(threshold=float(threshold) / 1000)
+            monitor.start()
+            config.registry.hub_monitor = monitor
+        
         # Explicitly remove any db connections.
         self.session.remove()
         
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``Registry``, a utility that collects counters, gauges and
+  latency histograms, ``MetricsServer``, which serves them in the Prometheus
+  text format, and ``InstrumentPool``, which times db connection checkouts.
+  
+  The workers are single threaded gevent processes, so recording a metric is
+  just a dict lookup and an increment -- there are no locks to contend on.
+"""
+
+__all__ = [
+    'Histogram',
+    'InstrumentPool',
+    'MetricsServer',
+    'REGISTRY',
+    'Registry',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import bisect
+import collections
+import gevent.pywsgi
+import time
+
+# Latency buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+        30, 60)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape(value):
+    """Escape a label value."""
+    
+    value = u'{0}'.format(value)
+    return value.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(
+            u'\n', u'\\n')
+
+def format_labels(labels):
+    """Format a tuple of ``(name, value)`` pairs as ``{name="value"}``."""
+    
+    if not labels:
+        return u''
+    pairs = (u'{0}="{1}"'.format(k, escape(v)) for k, v in labels)
+    return u'{{{0}}}'.format(u','.join(pairs))
+
+def format_value(value):
+    """Format a sample value or bucket bound."""
+    
+    if value == float('inf'):
+        return u'+Inf'
+    if isinstance(value, float):
+        return u'{0!r}'.format(value)
+    return u'{0}'.format(value)
+
+class Histogram(object):
+    """Counts observations into cumulative ``buckets``."""
+    
+    __slots__ = ('buckets', 'counts', 'sum')
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+    
+
+class Registry(object):
+    """Collects the metrics for a process. Counters and histograms are keyed
+      by name and a tuple of ``(label, value)`` pairs. Gauges are functions
+      that are called when the metrics are rendered, as are the ``stats``
+      of any registered reporters, which are exported as counters.
+      
+      Each histogram is limited to ``max_series`` label sets, e.g.: so per
+      host latencies can't grow without bound. Observations for any more are
+      recorded with the label values set to ``other``.
+    """
+    
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_series=100, **kwargs):
+        self.buckets = buckets
+        self.max_series = max_series
+        self.prefix = kwargs.get('prefix', u'torque_')
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = {}
+        self.reporters = []
+        self.series = collections.Counter()
+    
+    def inc(self, name, value=1, labels=()):
+        """Increment a counter."""
+        
+        self.counters[(name, labels)] += value
+    
+    def observe(self, name, value, labels=()):
+        """Record an observation, e.g.: a latency in seconds."""
+        
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            if self.series[name] >= self.max_series:
+                labels = tuple((k, u'other') for k, _ in labels)
+                key = (name, labels)
+                histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+                self.series[name] += 1
+        histogram.observe(value)
+    
+    def gauge(self, name, func, labels=()):
+        """Register a function that returns a gauge's current value."""
+        
+        self.gauges[(name, labels)] = func
+    
+    def report(self, reporter):
+        """Export the counts in the ``reporter``'s ``stats``."""
+        
+        self.reporters.append(reporter)
+    
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        
+        lines = []
+        prefix = self.prefix
+        
+        # Counters, including the reporters' stats.
+        counters = collections.Counter(self.counters)
+        for reporter in self.reporters:
+            for key, value in reporter.stats.items():
+                counters[(u'{0}_total'.format(key), ())] += value
+        for name, items in self.group(counters.items()):
+            lines.append(u'# TYPE {0}{1} counter'.format(prefix, name))
+            for labels, value in items:
+                lines.append(u'{0}{1}{2} {3}'.format(prefix, name,
+                        format_labels(labels), format_value(value)))
+        
+        # Gauges.
+        gauges = []
+        for key, func in self.gauges.items():
+            try:
+                gauges.append((key, func()))
+            except Exception as err:
+                logger.warn(err, exc_info=True)
+        for name, items in self.group(gauges):
+            lines.append(u'# TYPE {0}{1} gauge'.format(prefix, name))
+            for labels, value in items:
+                lines.append(u'{0}{1}{2} {3}'.format(prefix, name,
+                        format_labels(labels), format_value(value)))
+        
+        # Histograms, with cumulative bucket counts.
+        for name, items in self.group(self.histograms.items()):
+            lines.append(u'# TYPE {0}{1} histogram'.format(prefix, name))
+            for labels, histogram in items:
+                count = 0
+                bounds = histogram.buckets + (float('inf'),)
+                for bound, bucket_count in zip(bounds, histogram.counts):
+                    count += bucket_count
+                    le = labels + ((u'le', format_value(bound)),)
+                    lines.append(u'{0}{1}_bucket{2} {3}'.format(prefix, name,
+                            format_labels(le), count))
+                lines.append(u'{0}{1}_sum{2} {3!r}'.format(prefix, name,
+                        format_labels(labels), histogram.sum))
+                lines.append(u'{0}{1}_count{2} {3}'.format(prefix, name,
+                        format_labels(labels), count))
+        
+        return u'\n'.join(lines) + u'\n'
+    
+    def group(self, items):
+        """Group ``((name, labels), value)`` items by name, sorted."""
+        
+        groups = collections.defaultdict(list)
+        for (name, labels), value in items:
+            groups[name].append((labels, value))
+        return sorted((k, sorted(v)) for k, v in groups.items())
+    
+
+REGISTRY = Registry()
+
+class MetricsServer(object):
+    """Serves the ``registry``'s metrics at ``GET /metrics`` from a
+      background greenlet.
+    """
+    
+    def __init__(self, host, port, registry=None, **kwargs):
+        self.host = host
+        self.port = port
+        self.registry = REGISTRY if registry is None else registry
+        self.logger = kwargs.get('logger', logger)
+        self.server_cls = kwargs.get('server_cls', gevent.pywsgi.WSGIServer)
+    
+    def __call__(self, environ, start_response):
+        """WSGI application."""
+        
+        if environ.get('PATH_INFO') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found\n']
+        body = self.registry.render().encode('utf-8')
+        headers = [('Content-Type', CONTENT_TYPE),
+                ('Content-Length', str(len(body)))]
+        start_response('200 OK', headers)
+        return [body]
+    
+    def start(self):
+        """Start serving."""
+        
+        self.server = self.server_cls((self.host, self.port), self, log=None)
+        self.server.start()
+        msg = u'Serving metrics on http://{0}:{1}/metrics'
+        self.logger.info(msg.format(self.host, self.port))
+    
+    def stop(self):
+        self.server.stop()
+    
+
+class InstrumentPool(object):
+    """Count and time the checkouts from an engine's connection pool, which
+      includes any time spent waiting for a connection to be returned when
+      the pool is exhausted, and expose the pool's size as gauges.
+    """
+    
+    def __init__(self, registry=None, **kwargs):
+        self.registry = REGISTRY if registry is None else registry
+        self.time = kwargs.get('time', time.time)
+    
+    def __call__(self, engine):
+        pool = engine.pool
+        connect = pool.connect
+        registry = self.registry
+        get_time = self.time
+        def timed_connect():
+            start = get_time()
+            try:
+                return connect()
+            finally:
+                registry.inc(u'db_pool_checkouts_total')
+                registry.observe(u'db_pool_wait_seconds', get_time() - start)
+        pool.connect = timed_connect
+        for name in 'checkedout', 'overflow', 'size':
+            func = getattr(pool, name, None)
+            if func is not None:
+                registry.gauge(u'db_pool_{0}'.format(name), func)
+    
+
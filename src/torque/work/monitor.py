@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``HubMonitor``, a utility that detects when the gevent hub has
+  been blocked, e.g.: by an unpatched C extension call or a slow regex, and
+  logs the stack of the code that was blocking it.
+"""
+
+__all__ = [
+    'HubMonitor',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import gevent
+import gevent.monkey
+import sys
+import time
+import traceback
+
+def get_original(module_name, item_name):
+    """Return an unpatched function, from the originals that gevent saved
+      when it patched the module, or from the module if it isn't patched.
+    """
+    
+    saved = getattr(gevent.monkey, 'saved', {}).get(module_name, {})
+    if item_name in saved:
+        return saved[item_name]
+    return getattr(__import__(module_name), item_name)
+
+class HubMonitor(object):
+    """A greenlet records a heartbeat every ``interval`` seconds. A real,
+      unpatched, thread checks it and, if the hub hasn't run for longer than
+      ``threshold`` seconds, captures the stack of the main thread -- i.e.:
+      of whichever greenlet is blocking -- and counts the block.
+      
+      Logging isn't safe from outside of the hub, as the locks are patched,
+      so the blocks are logged by the heartbeat greenlet once the hub runs
+      again, with how long it was blocked for.
+    """
+    
+    def __init__(self, threshold=0.1, interval=None, **kwargs):
+        self.threshold = threshold
+        self.interval = threshold / 2.0 if interval is None else interval
+        self.current_frames = kwargs.get('current_frames',
+                sys._current_frames)
+        self.get_ident = kwargs.get('get_ident', get_original('thread',
+                'get_ident'))
+        self.logger = kwargs.get('logger', logger)
+        self.sleep = kwargs.get('sleep', gevent.sleep)
+        self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.start_thread = kwargs.get('start_thread', get_original('thread',
+                'start_new_thread'))
+        self.thread_sleep = kwargs.get('thread_sleep', get_original('time',
+                'sleep'))
+        self.time = kwargs.get('time', time.time)
+        self.blocks = collections.deque(maxlen=100)
+        self.is_running = False
+        self.stats = collections.Counter()
+    
+    def start(self):
+        """Start the heartbeat greenlet and the monitoring thread."""
+        
+        self.is_running = True
+        self.hub_ident = self.get_ident()
+        self.last_beat = self.time()
+        self.reported_beat = None
+        self.greenlet = self.spawn(self.beat)
+        self.start_thread(self.watch, ())
+    
+    def stop(self):
+        self.is_running = False
+    
+    def beat(self):
+        """Record a heartbeat, then log any blocks since the last one."""
+        
+        while self.is_running:
+            previous, self.last_beat = self.last_beat, self.time()
+            blocked_for = self.last_beat - previous - self.interval
+            if self.blocks:
+                self.stats['hub_blocked_ms'] += int(blocked_for * 1000)
+            while self.blocks:
+                stack = self.blocks.popleft()
+                msg = u'The gevent hub was blocked for {0:.0f}ms by:\n{1}'
+                self.logger.warn(msg.format(blocked_for * 1000, stack))
+            self.sleep(self.interval)
+    
+    def watch(self):
+        """Runs in a real thread: check the heartbeat every ``interval``."""
+        
+        while self.is_running:
+            self.thread_sleep(self.interval)
+            self.check()
+    
+    def check(self):
+        """If the hub has missed its heartbeat by more than the
+          ``threshold``, record the blocking stack, once per block.
+        """
+        
+        last_beat = self.last_beat
+        if last_beat == self.reported_beat:
+            return
+        if self.time() - last_beat < self.interval + self.threshold:
+            return
+        self.reported_beat = last_beat
+        self.stats['hub_blocked'] += 1
+        frame = self.current_frames().get(self.hub_ident)
+        if frame is None:
+            stack = u'(no stack)'
+        else:
+            stack = u''.join(traceback.format_stack(frame))
+        self.blocks.append(stack)
+    
+
@@ -12,18 +12,33 @@ import logging
 logger = logging.getLogger(__name__)
 
 import gevent
-import requests
+import time
+import urlparse
+
+from datetime import datetime
 
-from torque import backoff
 from torque import model
+from torque.model import due
+from torque.work.client import ParseRetryAfter
+from torque.work.client import WebhookClient
+from torque.work.metrics import REGISTRY
 
 class TaskPerformer(object):
     def __init__(self, **kwargs):
         self.task_manager = kwargs.get('acquire_task', model.TaskManager())
-        self.backoff_cls = kwargs.get('backoff', backoff.Backoff)
-        self.post = kwargs.get('post', requests.post)
+        self.breaker = kwargs.get('breaker', None)
+        self.logger = kwargs.get('logger', logger)
+        self.max_retry_after = kwargs.get('max_retry_after', 3600)
+        self.metrics = kwargs.get('metrics', REGISTRY)
+        self.parse_retry_after = kwargs.get('parse_retry_after',
+                ParseRetryAfter())
+        self.post = kwargs.get('post', None) or WebhookClient()
+        self.should_retry = kwargs.get('should_retry', due.ShouldRetry())
         self.sleep = kwargs.get('sleep', gevent.sleep)
         self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.time = kwargs.get('time', time.time)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.write_attempt = kwargs.get('write_attempt', None)
     
     def __call__(self, instruction, control_flag):
         """Acquire a task, perform it and update its status accordingly."""
@@ -32,54 +47,172 @@ class TaskPerformer(object):
         # get-the-task-and-incr-its-retry-count. This ensures that even if the
         # next instruction off the queue is for the same task, or if a parallel
         # worker has the same instruction, the task will only be acquired once.
-        task_id, retry_count = map(int, instruction.split(':'))
-        task_data = self.task_manager.acquire(task_id, retry_count)
-        if not task_data:
+        task_id, retry_count = self.parse(instruction)
+        handle = self.task_manager.acquire(task_id, retry_count)
+        if handle is None:
             return
+        return self.perform(handle, control_flag)
+    
+    def parse(self, instruction):
+        """Parse an ``id:retry_count`` instruction into a pair of ints."""
+        
+        return tuple(map(int, instruction.split(':')))
+    
+    def acquire_many(self, instructions):
+        """Acquire the tasks for many instructions in a single statement.
+          Returns a dict of ``TaskHandle``s keyed by instruction -- so stale
+          and malformed instructions are simply missing.
+        """
         
-        # Unpack the task data.
+        pairs = {}
+        for instruction in instructions:
+            try:
+                pairs[self.parse(instruction)] = instruction
+            except ValueError:
+                msg = u'Invalid instruction: {0}'.format(instruction)
+                self.logger.warn(msg)
+        handles = self.task_manager.acquire_many(pairs.keys())
+        return dict((pairs[(handle.id, handle.retry_count - 1)], handle)
+                for handle in handles)
+    
+    def perform(self, handle, control_flag):
+        """Perform an acquired task and update its status accordingly."""
+        
+        # Unpack the task data, releasing it from the handle, so the payload
+        # is only held by the request whilst it's being made.
+        task_data, handle.data = handle.data, None
         url = task_data['url']
-        body = task_data['body']
-        timeout = task_data['timeout']
+        
+        # If the host's circuit breaker is open, defer the task rather than
+        # tying up a slot waiting on a host that's down.
+        host = urlparse.urlparse(url).hostname
+        if self.breaker is not None and not self.breaker.allow(host):
+            return self.task_manager.defer(handle, self.breaker.retry_at(host))
+        
         headers = task_data['headers']
         headers['content-type'] = '{0}; charset={1}'.format(
                 task_data['enctype'], task_data['charset'])
         
         # Spawn a POST to the web hook in a greenlet -- so we can monitor
-        # the control flag in case we want to exit whilst waiting.
-        kwargs = dict(data=body, headers=headers, timeout=timeout)
-        greenlet = self.spawn(self.post, url, **kwargs)
+        # the control flag in case we want to exit whilst waiting. Record
+        # when the attempt started and, below, ended on the handle, so the
+        # times are written with the status.
+        handle.started = self.utcnow()
+        greenlet = self.spawn(self.send, url, handle=handle,
+                data=task_data['body'], headers=headers,
+                timeout=handle.timeout)
+        del task_data, headers
         
         # Wait for the request to complete, checking the greenlet's progress
         # with an expoential backoff.
-        response = None
+        status_code = retry_after = None
         delay = 0.1 # secs
-        max_delay = 2 # secs - XXX really this should be the configurable
+        max_delay = 2 # secs - XXX really this should be the configurable
                       # min delay in the due logic's `timeout + min delay`.
                       # The issue being that we could end up checking the
                       # ready max delay after the timout, which means that
                       # the task is likely to be re-queued already.
-        backoff = self.backoff_cls(delay, max_value=max_delay)
         while control_flag.is_set():
             self.sleep(delay)
             if greenlet.ready():
-                response = greenlet.value
+                handle.ended = self.utcnow()
+                status_code, retry_after = greenlet.value or (None, None)
                 break
-            delay = backoff.exponential(1.5) # 0.15, 0.225, 0.3375, ... 2
+            delay = min(delay * 1.5, max_delay) # 0.15, 0.225, 0.3375, ... 2
         
-        # If we didn't get a response, or if the response was not successful,
-        # reschedule it. Note that rescheduling *accelerates* the due date --
-        # doing nothing here would leave the task to be retried anyway, as its
-        # due date was set when the task was aquired.
-        if response is None or response.status_code > 499:
+        # Let the breaker know whether the host responded. If we stopped
+        # waiting, we don't know.
+        if self.breaker is not None and greenlet.ready():
+            if status_code is None or status_code > 499:
+                self.breaker.record_failure(host)
+            else:
+                self.breaker.record_success(host)
+            
+            # If the host asked us to back off, stop sending to it until
+            # it's ready.
+            if retry_after:
+                self.breaker.hold(host, retry_after)
+        
+        # If the response was successful, complete the task. If we didn't get
+        # a response, or if the response status is one that the task's retry
+        # policy retries on (by default any 5xx or 429), reschedule it, when
+        # the response's ``Retry-After`` header asked us to, if it did. Note
+        # that rescheduling *accelerates* the due date -- doing nothing here
+        # would leave the task to be retried anyway, as its due date was set
+        # when the task was aquired. Otherwise, fail it.
+        if status_code is not None and status_code < 202:
+            status = self.task_manager.complete(handle)
+        elif self.should_retry(status_code, policy=handle.retry_policy):
             # XXX what we could also do here are:
             # - set a more informative status flag (even if only descriptive)
             # - noop if the greenlet request timed out
-            status = self.task_manager.reschedule()
-        elif response.status_code > 201:
-            status = self.task_manager.fail()
+            status = self.task_manager.reschedule(handle, delay=retry_after)
         else:
-            status = self.task_manager.complete()
+            status = self.task_manager.fail(handle)
         return status
     
+    def send(self, url, handle=None, **kwargs):
+        """Make the request, returning just the response status code and,
+          for 429 and 503 responses, the number of seconds the ``Retry-After``
+          header asks us to wait (capped at ``max_retry_after``), so the
+          response can be released as soon as it's been received. Logs the
+          start of the body of unsuccessful responses and records the attempt
+          for the task ``handle``.
+        """
+        
+        start = self.time()
+        try:
+            response = self.post(url, **kwargs)
+        except Exception as err:
+            self.record_attempt(url, handle, start, error=err)
+            raise
+        self.record_attempt(url, handle, start, response=response)
+        try:
+            status_code = response.status_code
+            retry_after = None
+            if status_code > 201:
+                msg = u'{0} returned {1}: {2!r}'
+                self.logger.info(msg.format(url, status_code,
+                        getattr(response, 'body', None)))
+            if status_code in (429, 503):
+                retry_after = self.parse_retry_after(response.headers)
+                if retry_after is not None:
+                    retry_after = min(retry_after, self.max_retry_after)
+            return status_code, retry_after
+        finally:
+            response.close()
+    
+    def record_attempt(self, url, handle, start, response=None, error=None):
+        """Record how long the web hook took to respond, by status class
+          (``error`` if it didn't) and by host, and, if we have an attempt
+          writer, log the attempt.
+        """
+        
+        elapsed = self.time() - start
+        status_code = None
+        status_class = u'error'
+        if response is not None:
+            status_code = response.status_code
+            status_class = u'{0}xx'.format(status_code // 100)
+        host = urlparse.urlparse(url).hostname
+        self.metrics.observe(u'webhook_seconds', elapsed,
+                labels=((u'status_class', status_class),))
+        self.metrics.observe(u'webhook_host_seconds', elapsed,
+                labels=((u'host', host),))
+        
+        # Log the attempt, with the start of the body, if any, as text that
+        # postgres can store.
+        if self.write_attempt is None or handle is None:
+            return
+        error_name = None if error is None else type(error).__name__[:64]
+        body = getattr(response, 'body', None)
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        if isinstance(body, unicode):
+            body = body.replace(u'\x00', u'')
+        else:
+            body = None
+        self.write_attempt(handle.id, handle.retry_count, status_code,
+                error_name, elapsed, body or None)
+    
 
@@ -11,11 +11,15 @@ __all__ = [
 import logging
 logger = logging.getLogger(__name__)
 
+import collections
 import time
 
+from pyramid.settings import asbool
 from pyramid_redis.hooks import RedisFactory
 from torque import model
 from .main import Bootstrap
+from .metrics import MetricsServer
+from .metrics import REGISTRY
 
 class RequeuePoller(object):
     """Takes instructions from one or more redis channels. Calls a handle
@@ -30,9 +34,13 @@ class RequeuePoller(object):
         self.redis = redis
         self.channel = channel
         self.interval = interval
+        self.manage_partitions = kwargs.get('manage_partitions', None)
+        self.maintenance_interval = kwargs.get('maintenance_interval', 3600)
+        self.next_maintenance = 0
         self.get_tasks = kwargs.get('get_tasks', model.GetDueTasks())
         self.logger = kwargs.get('logger', logger)
         self.time = kwargs.get('time', time)
+        self.stats = collections.Counter()
     
     def start(self):
         self.poll()
@@ -42,18 +50,40 @@ class RequeuePoller(object):
         
         while True:
             t1 = self.time.time()
+            self.maintain()
             try:
                 tasks = self.get_tasks()
             except Exception as err:
+                self.stats['poll_errors'] += 1
                 self.logger.warn(err, exc_info=True)
             else:
                 for task in tasks:
                     self.enqueue(task)
+                    self.stats['repushed'] += 1
+                self.stats['polls'] += 1
             current_time = self.time.time()
             due_time = t1 + self.interval
             if current_time < due_time:
                 self.time.sleep(due_time - current_time)
     
+    def maintain(self):
+        """Every ``maintenance_interval`` seconds, create the attempt log's
+          upcoming partitions and drop its expired ones.
+        """
+        
+        now = self.time.time()
+        if self.manage_partitions is None or now < self.next_maintenance:
+            return
+        self.next_maintenance = now + self.maintenance_interval
+        try:
+            created, dropped = self.manage_partitions()
+        except Exception as err:
+            self.logger.warn(err, exc_info=True)
+        else:
+            if created or dropped:
+                msg = u'Created partitions {0} and dropped {1}'
+                self.logger.info(msg.format(created, dropped))
+    
     def enqueue(self, task):
         """Push an instruction to re-try the task on the redis channel."""
         
@@ -68,6 +98,11 @@ class ConsoleScript(object):
         self.requeue_cls = kwargs.get('requeue_cls', RequeuePoller)
         self.get_redis = kwargs.get('get_redis', RedisFactory())
         self.get_config = kwargs.get('get_config', Bootstrap())
+        self.metrics = kwargs.get('metrics', REGISTRY)
+        self.metrics_server_cls = kwargs.get('metrics_server_cls',
+                MetricsServer)
+        self.partitions_cls = kwargs.get('partitions_cls',
+                model.ManageAttemptPartitions)
     
     def __call__(self):
         """Get the configured registry. Unpack the redis client and input
@@ -82,8 +117,31 @@ class ConsoleScript(object):
         redis_client = self.get_redis(settings, registry=config.registry)
         channel = settings.get('torque.redis_channel')
         
-        # Instantiate and start the consumer.
-        poller = self.requeue_cls(redis_client, channel)
+        # Instantiate the poller, maintaining the attempt log's partitions
+        # if it's enabled.
+        manage_partitions = None
+        if asbool(settings.get('torque.attempt_log')):
+            ahead = int(settings.get('torque.attempt_partitions_ahead'))
+            retention = int(settings.get('torque.attempt_retention_days'))
+            manage_partitions = self.partitions_cls(days_ahead=ahead,
+                    retention_days=retention)
+        poller = self.requeue_cls(redis_client, channel,
+                manage_partitions=manage_partitions)
+        
+        # If configured to, serve metrics.
+        port = settings.get('torque.metrics_port')
+        if port:
+            self.metrics.report(poller)
+            for name in 'hub_monitor', 'query_profiler':
+                reporter = getattr(config.registry, name, None)
+                if reporter is not None:
+                    self.metrics.report(reporter)
+            server = self.metrics_server_cls(
+                    settings.get('torque.metrics_host'), int(port),
+                    registry=self.metrics)
+            server.start()
+        
+        # Start polling.
         try:
             poller.start()
         except KeyboardInterrupt:
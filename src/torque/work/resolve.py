@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``CachingResolver``, a ``getaddrinfo`` replacement that caches
+  lookups in process, so that posting to the same web hook hosts over and
+  over again doesn't resolve the hostname every time. It's used by the web
+  hook client's connections, rather than installed in the ``socket`` module,
+  so no other lookups are affected.
+"""
+
+__all__ = [
+    'CachingResolver',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import gevent
+import socket
+import time
+
+try: # Use dnspython, if installed, to respect the records' TTLs.
+    import dns.resolver
+except ImportError:
+    dns = None
+
+def is_ip_address(host):
+    """Is the ``host`` an IPv4 or IPv6 address, rather than a name?"""
+    
+    for family in socket.AF_INET, socket.AF_INET6:
+        try:
+            socket.inet_pton(family, host)
+        except (socket.error, TypeError, ValueError):
+            continue
+        return True
+    return False
+
+class CachingResolver(object):
+    """Caches up to ``max_size`` ``getaddrinfo`` results for the record's TTL,
+      capped at ``ttl`` seconds (or for ``ttl`` seconds if the TTL can't be
+      looked up) and failed lookups for ``negative_ttl`` seconds.
+      
+      The record's TTL is looked up in the background, so a miss only waits
+      on the one lookup, and isn't looked up at all for IP addresses.
+      Entries that are used after ``refresh_ratio`` of their TTL has passed
+      are refreshed in the background, so hot hosts never wait on a lookup.
+      Counts hits, misses and refreshes in ``stats``.
+    """
+    
+    def __init__(self, ttl=60, negative_ttl=5, max_size=1024, **kwargs):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.dns_resolver = kwargs.get('dns_resolver',
+                dns.resolver if dns else None)
+        self.create_connection = kwargs.get('create_connection',
+                socket.create_connection)
+        self.getaddrinfo = kwargs.get('getaddrinfo', socket.getaddrinfo)
+        self.logger = kwargs.get('logger', logger)
+        self.refresh_ratio = kwargs.get('refresh_ratio', 0.75)
+        self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.time = kwargs.get('time', time.time)
+        self.cache = collections.OrderedDict()
+        self.refreshing = set()
+        self.stats = collections.Counter()
+    
+    def __call__(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        """Return the cached result, or raise the cached error, if fresh.
+          Otherwise look it up.
+        """
+        
+        key = (host, port, family, socktype, proto, flags)
+        now = self.time()
+        entry = self.cache.pop(key, None)
+        if entry is None or entry[0] < now:
+            self.stats['dns_misses'] += 1
+            return self.resolve(key)
+        
+        # Move the entry to the most recently used end.
+        self.cache[key] = entry
+        expires, refresh_at, result, error = entry
+        if error is not None:
+            self.stats['dns_negative_hits'] += 1
+            raise error
+        self.stats['dns_hits'] += 1
+        if refresh_at < now and key not in self.refreshing:
+            self.refreshing.add(key)
+            self.spawn(self.refresh, key)
+        return result
+    
+    def connect(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+            source_address=None):
+        """Like ``socket.create_connection`` but resolving the host through
+          the cache. Tries each of the host's addresses in turn.
+        """
+        
+        host, port = address
+        error = None
+        for info in self(host, port, 0, socket.SOCK_STREAM):
+            sockaddr = info[4]
+            try:
+                return self.create_connection(sockaddr[:2], timeout,
+                        source_address)
+            except socket.error as err:
+                error = err
+        if error is None:
+            error = socket.error(u'No addresses for {0}'.format(host))
+        raise error
+    
+    def resolve(self, key):
+        """Look up and cache the result for the ``key``."""
+        
+        try:
+            result = self.getaddrinfo(*key)
+        except socket.gaierror as err:
+            self.store(key, None, err, self.negative_ttl)
+            raise
+        self.store(key, result, None, self.ttl)
+        if self.dns_resolver is not None and not is_ip_address(key[0]):
+            self.spawn(self.update_ttl, key, result)
+        return result
+    
+    def update_ttl(self, key, result):
+        """Shorten a new entry's expiry to its record's TTL, if it's still
+          the cached entry.
+        """
+        
+        ttl = self.get_ttl(key[0])
+        entry = self.cache.get(key)
+        if ttl < self.ttl and entry is not None and entry[2] is result:
+            self.store(key, result, None, ttl)
+    
+    def refresh(self, key):
+        """Look up a cached entry again before it expires. If the lookup
+          fails, the entry is left to expire.
+        """
+        
+        try:
+            result = self.getaddrinfo(*key)
+            self.store(key, result, None, self.get_ttl(key[0]))
+        except Exception as err:
+            self.stats['dns_refresh_errors'] += 1
+            self.logger.info(err, exc_info=True)
+        else:
+            self.stats['dns_refreshes'] += 1
+        finally:
+            self.refreshing.discard(key)
+    
+    def store(self, key, result, error, ttl):
+        """Cache the ``result`` or ``error``, evicting the least recently
+          used entries if the cache is full.
+        """
+        
+        now = self.time()
+        entry = (now + ttl, now + ttl * self.refresh_ratio, result, error)
+        self.cache.pop(key, None)
+        self.cache[key] = entry
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.stats['dns_evictions'] += 1
+    
+    def get_ttl(self, host):
+        """Return the TTL of the host's address record, capped at ``ttl``."""
+        
+        if self.dns_resolver is None or is_ip_address(host):
+            return self.ttl
+        try:
+            answer = self.dns_resolver.query(host, 'A')
+        except Exception: # E.g.: a name from /etc/hosts.
+            return self.ttl
+        return max(1, min(answer.rrset.ttl, self.ttl))
+    
+
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``StackSampler``, a sampling profiler that, when triggered, e.g.:
+  by sending a consumer process ``SIGUSR2``, records the stacks of its
+  greenlets for a number of seconds and writes them to a collapsed stack
+  file that ``flamegraph.pl`` or speedscope can render::
+  
+      $ kill -USR2 <pid>
+      $ flamegraph.pl /tmp/torque-<pid>-<timestamp>.collapsed > hot.svg
+  
+  Nothing runs until the profiler is triggered, so it adds no overhead
+  whilst inactive.
+"""
+
+__all__ = [
+    'StackSampler',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import gc
+import gevent
+import greenlet
+import os
+import sys
+import tempfile
+import time
+
+from .monitor import get_original
+
+class StackSampler(object):
+    """Samples for ``seconds`` once called. A real, unpatched, thread samples
+      the stack of whichever greenlet is running every ``interval`` seconds,
+      under a ``running`` root frame. These are the on CPU hot paths. A
+      greenlet samples the stacks of every other, suspended, greenlet every
+      ``greenlet_interval`` seconds, under a ``waiting`` root frame. These
+      show what the greenlets are waiting on.
+      
+      The two roots are sampled at different rates, so compare frames within
+      a root, rather than across them.
+    """
+    
+    def __init__(self, seconds=30, interval=0.005, greenlet_interval=0.25,
+            output_dir=None, **kwargs):
+        self.seconds = seconds
+        self.interval = interval
+        self.greenlet_interval = greenlet_interval
+        self.output_dir = output_dir or tempfile.gettempdir()
+        self.current_frames = kwargs.get('current_frames',
+                sys._current_frames)
+        self.get_ident = kwargs.get('get_ident', get_original('thread',
+                'get_ident'))
+        self.get_objects = kwargs.get('get_objects', gc.get_objects)
+        self.getpid = kwargs.get('getpid', os.getpid)
+        self.logger = kwargs.get('logger', logger)
+        self.sleep = kwargs.get('sleep', gevent.sleep)
+        self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.start_thread = kwargs.get('start_thread', get_original('thread',
+                'start_new_thread'))
+        self.thread_sleep = kwargs.get('thread_sleep', get_original('time',
+                'sleep'))
+        self.time = kwargs.get('time', time.time)
+        self.is_running = False
+        self.labels = {}
+    
+    def __call__(self):
+        """Start sampling, unless already sampling."""
+        
+        if self.is_running:
+            self.logger.warn(u'Already profiling.')
+            return
+        self.is_running = True
+        self.is_sampling_running = True
+        self.running = collections.Counter()
+        self.waiting = collections.Counter()
+        self.hub_ident = self.get_ident()
+        self.until = self.time() + self.seconds
+        msg = u'Profiling for {0} seconds.'
+        self.logger.warn(msg.format(self.seconds))
+        self.start_thread(self.sample_running, ())
+        return self.spawn(self.sample_waiting)
+    
+    def sample_running(self):
+        """Runs in a real thread: sample the running greenlet's stack."""
+        
+        try:
+            while self.time() < self.until:
+                frame = self.current_frames().get(self.hub_ident)
+                if frame is not None:
+                    self.running[self.collapse(frame)] += 1
+                self.thread_sleep(self.interval)
+        finally:
+            self.is_sampling_running = False
+    
+    def sample_waiting(self):
+        """Sample the suspended greenlets' stacks, then, once the thread has
+          finished, write the profile.
+        """
+        
+        try:
+            while self.time() < self.until:
+                for obj in self.get_objects():
+                    if not isinstance(obj, greenlet.greenlet):
+                        continue
+                    frame = obj.gr_frame
+                    if frame is not None:
+                        self.waiting[self.collapse(frame)] += 1
+                self.sleep(self.greenlet_interval)
+            while self.is_sampling_running:
+                self.sleep(self.interval)
+            path = self.write()
+        except Exception as err:
+            self.logger.warn(err, exc_info=True)
+        else:
+            self.logger.warn(u'Wrote profile to {0}'.format(path))
+        finally:
+            self.is_running = False
+    
+    def collapse(self, frame):
+        """Return the ``frame``'s stack as ``;`` separated labels, from the
+          outermost frame in.
+        """
+        
+        labels = []
+        while frame is not None:
+            labels.append(self.label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+        return u';'.join(labels)
+    
+    def label(self, code):
+        """Label a function by its name, file and line, caching the label."""
+        
+        label = self.labels.get(code)
+        if label is None:
+            filename = code.co_filename.split(os.sep)[-2:]
+            label = u'{0} ({1}:{2})'.format(code.co_name, u'/'.join(filename),
+                    code.co_firstlineno).replace(u';', u':')
+            self.labels[code] = label
+        return label
+    
+    def write(self):
+        """Write the counts in the collapsed stack format and return the
+          file's path.
+        """
+        
+        filename = u'torque-{0}-{1}.collapsed'.format(self.getpid(),
+                int(self.time()))
+        path = os.path.join(self.output_dir, filename)
+        with open(path, 'w') as f:
+            for root, counts in (u'running', self.running), (u'waiting',
+                    self.waiting):
+                for stack, count in sorted(counts.items()):
+                    line = u'{0};{1} {2}\n'.format(root, stack, count)
+                    f.write(line.encode('utf-8'))
+        return path
+    
+
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``Supervisor``, a utility that pre-forks a number of gevent
+  consumer processes, restarts them when they die and aggregates the stats
+  that they report.
+"""
+
+__all__ = [
+    'Supervisor',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import gevent
+import json
+import os
+import select
+import signal
+import time
+
+from torque import backoff
+
+class Supervisor(object):
+    """Forks ``num_processes`` children that each call ``target(report_fd,
+      slot, **settings)``, where ``settings`` are the per-child settings,
+      ``slot`` is the child's index and ``report_fd`` is the write end of a
+      pipe that the child can periodically write a line of JSON encoded stats
+      to.
+      
+      Restarts children that die, backing off if they die straight away.
+      When sent a ``SIGTERM`` (or interrupted), forwards ``SIGTERM`` to the
+      children, so they drain, and waits for them to exit. Forwards
+      ``SIGUSR2`` to the children, so they all profile.
+    """
+    
+    def __init__(self, target, num_processes, settings=None, **kwargs):
+        self.target = target
+        self.num_processes = num_processes
+        self.settings = settings or {}
+        self.backoff_cls = kwargs.get('backoff', backoff.Backoff)
+        self.close = kwargs.get('close', os.close)
+        self.fork_process = kwargs.get('fork_process', os.fork)
+        self.handle_signal = kwargs.get('handle_signal', gevent.signal)
+        self.kill = kwargs.get('kill', os.kill)
+        self.logger = kwargs.get('logger', logger)
+        self.max_delay = kwargs.get('max_delay', 30)
+        self.min_uptime = kwargs.get('min_uptime', 5)
+        self.pipe = kwargs.get('pipe', os.pipe)
+        self.read = kwargs.get('read', os.read)
+        self.select = kwargs.get('select', select.select)
+        self.sleep = kwargs.get('sleep', gevent.sleep)
+        self.stats_interval = kwargs.get('stats_interval', 60)
+        self.time = kwargs.get('time', time.time)
+        self.waitpid = kwargs.get('waitpid', os.waitpid)
+        self.children = {}
+        self.is_stopping = False
+        self.stats = {}
+        self.retired_stats = collections.Counter()
+    
+    def start(self):
+        """Fork the children and supervise them until stopped."""
+        
+        self.sigterm = self.handle_signal(signal.SIGTERM, self.stop)
+        self.sigusr2 = self.handle_signal(signal.SIGUSR2, self.profile)
+        for slot in range(self.num_processes):
+            self.fork(slot, self.backoff_cls(1, max_value=self.max_delay))
+        try:
+            self.supervise()
+        except KeyboardInterrupt:
+            self.stop()
+            self.supervise()
+    
+    def stop(self):
+        """Tell the children to drain and exit."""
+        
+        self.is_stopping = True
+        for pid in self.children:
+            try:
+                self.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    
+    def profile(self):
+        """Tell the children to profile themselves."""
+        
+        for pid in self.children:
+            try:
+                self.kill(pid, signal.SIGUSR2)
+            except OSError:
+                pass
+    
+    def fork(self, slot, delay):
+        """Fork a child process into the ``slot`` provided."""
+        
+        read_fd, write_fd = self.pipe()
+        pid = self.fork_process()
+        if pid == 0: # In the child.
+            self.close(read_fd)
+            self.sigterm.cancel()
+            self.sigusr2.cancel()
+            exit_code = 0
+            try:
+                self.target(report_fd=write_fd, slot=slot, **self.settings)
+            except KeyboardInterrupt:
+                pass
+            except Exception as err:
+                self.logger.error(err, exc_info=True)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.close(write_fd)
+        self.children[pid] = (slot, read_fd, self.time(), delay)
+        self.stats[pid] = {}
+        self.logger.info('Forked consumer {0} in slot {1}'.format(pid, slot))
+    
+    def supervise(self):
+        """Read stats and reap (and, unless stopping, restart) children until
+          they've all exited.
+        """
+        
+        next_report = self.time() + self.stats_interval
+        while self.children:
+            self.read_stats(timeout=1)
+            self.reap()
+            if self.time() > next_report:
+                self.report()
+                next_report = self.time() + self.stats_interval
+        self.report()
+    
+    def read_stats(self, timeout):
+        """Store the latest line of stats that each child has written."""
+        
+        fds = dict((v[1], pid) for pid, v in self.children.items())
+        try:
+            readable, _, _ = self.select(fds.keys(), [], [], timeout)
+        except select.error: # Interrupted by a signal.
+            return
+        for fd in readable:
+            data = self.read(fd, 65536)
+            lines = [line for line in data.splitlines() if line.strip()]
+            if lines:
+                try:
+                    self.stats[fds[fd]] = json.loads(lines[-1])
+                except ValueError:
+                    pass
+    
+    def reap(self):
+        """Wait on any children that have exited, restarting them unless we're
+          stopping.
+        """
+        
+        while self.children:
+            try:
+                pid, status = self.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            if pid not in self.children:
+                continue
+            slot, read_fd, started, delay = self.children.pop(pid)
+            self.close(read_fd)
+            self.retired_stats.update(self.stats.pop(pid, {}))
+            if self.is_stopping:
+                continue
+            msg = 'Consumer {0} in slot {1} exited with status {2}'
+            self.logger.warn(msg.format(pid, slot, status))
+            if self.time() - started > self.min_uptime:
+                delay = self.backoff_cls(1, max_value=self.max_delay)
+            else:
+                self.sleep(delay.value)
+                delay.exponential()
+            self.fork(slot, delay)
+    
+    def report(self):
+        """Log the stats aggregated across all of the children."""
+        
+        totals = collections.Counter(self.retired_stats)
+        for stats in self.stats.values():
+            totals.update(stats)
+        items = sorted(totals.items())
+        summary = u', '.join(u'{0}={1}'.format(k, v) for k, v in items)
+        self.logger.warn(u'{0} consumers: {1}'.format(len(self.children),
+                summary))
+    
+
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``StatusWriter``, a utility that collects task status updates
+  from concurrent performers and group commits them.
+"""
+
+__all__ = [
+    'StatusWriter',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import gevent
+import gevent.event
+
+from torque import model
+
+class StatusWriter(object):
+    """Collects ``(id, retry_count, status, due, started, ended)`` updates,
+      i.e.: with the times the attempt started and ended, for up to
+      ``interval`` seconds or ``batch_size`` items and writes them using a
+      single statement. Callers block until the batch containing their update
+      has been written and are told whether their task was updated.
+    """
+    
+    def __init__(self, interval=0.005, batch_size=100, **kwargs):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.event_cls = kwargs.get('event_cls', gevent.event.Event)
+        self.logger = kwargs.get('logger', logger)
+        self.result_cls = kwargs.get('result_cls', gevent.event.AsyncResult)
+        self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.update_tasks = kwargs.get('update_tasks', model.UpdateTasks())
+        self.is_running = False
+        self.pending = []
+    
+    def __call__(self, task_id, retry_count, status, due, started=None,
+            ended=None):
+        """Queue the update and wait for it to be written."""
+        
+        row = (task_id, retry_count, status, due, started, ended)
+        
+        # If we're not running, write straight away.
+        if not self.is_running:
+            return task_id in self.write([row])
+        
+        # Otherwise add to the pending batch, signalling the writer.
+        result = self.result_cls()
+        self.pending.append((row, result))
+        self.has_pending.set()
+        if len(self.pending) >= self.batch_size:
+            self.is_full.set()
+        return result.get()
+    
+    def start(self):
+        """Start writing in a background greenlet."""
+        
+        self.has_pending = self.event_cls()
+        self.is_full = self.event_cls()
+        self.is_running = True
+        self.greenlet = self.spawn(self.run)
+    
+    def stop(self):
+        """Stop, flushing any pending updates."""
+        
+        self.is_running = False
+        self.has_pending.set()
+        self.is_full.set()
+        self.greenlet.join()
+    
+    def run(self):
+        """Wait for an update, give the batch ``interval`` seconds to fill up
+          and then flush it.
+        """
+        
+        while self.is_running:
+            self.has_pending.wait()
+            self.has_pending.clear()
+            if len(self.pending) < self.batch_size:
+                self.is_full.wait(self.interval)
+            self.is_full.clear()
+            self.flush()
+        self.flush()
+    
+    def flush(self):
+        """Write the pending batch and confirm each update."""
+        
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        updated = self.write([row for row, _ in batch])
+        for row, result in batch:
+            result.set(row[0] in updated)
+    
+    def write(self, rows):
+        """Write the rows, returning the set of updated task ids. If the write
+          fails, the tasks are left to be retried when they fall due.
+        """
+        
+        try:
+            return self.update_tasks(rows)
+        except Exception as err:
+            self.logger.warn(err, exc_info=True)
+            return set()
+    
+